@@ -1,6 +1,8 @@
 from Structure import *
+import EventChainKernel
+from Profiling import regions
 
-# import time
+import time
 
 epsilon = 1e-8
 
@@ -13,6 +15,7 @@ class EventType(Enum):
 
 
 class Event:
+    __slots__ = ('event_type', 'other_sphere')
 
     def __init__(self, event_type: EventType, other_sphere: Sphere):
         """
@@ -28,6 +31,7 @@ class Event:
 
 
 class Step:
+    __slots__ = ('sphere', 'total_step', 'current_step', 'direction', 'boundaries', 'lift', 'wall_events', 'event')
 
     def __init__(self, sphere: Sphere, total_step, direction: Direction, boundaries,
                  current_step=np.nan):
@@ -39,103 +43,246 @@ class Step:
         :param direction: of the step
         :type boundaries: list
         """
+        self.event = Event(EventType.FREE, [])  # returned by every next_event, see reset
+        self.reset(sphere, total_step, direction, boundaries, current_step)
+
+    def reset(self, sphere, total_step, direction: Direction, boundaries, current_step=np.nan):
+        """
+        Start a new chain with the same Step object, same as creating a new Step. Loops over many chains reuse a single
+        Step and its Event instead of allocating them for every chain.
+        """
         self.sphere = sphere
         self.total_step = total_step
         self.current_step = current_step
         self.direction = direction
         self.boundaries = boundaries
+        self.lift = 0.0  # sum over the collisions of the chain of the distance along direction from sphere to other
+        self.wall_events = 0
+        return self
 
-    def next_event(self, other_spheres, cut_off=float('inf')):
+    def next_event(self, other_spheres, cut_off=float('inf'), shifted=False):
         """
         Returns the next Event object to be handle, such as perform the step and decide the next event
         :param other_spheres: other spheres which sphere might collide
+        :param shifted: other_spheres are the periodic images sphere might collide with, such as the Ghost spheres of
+        Event2DCells, so no cyclic images are searched. The Event has the Sphere of a Ghost collided.
         :return: Event object containing the information about the event about to happen after the step, such as step
-        size or step type (wall free or boundary), and the current step
+        size or step type (wall free or boundary), and the current step. It is self.event, overwritten by the next call.
         """
         sphere, total_step, direction = self.sphere, self.total_step, self.direction
         min_dist_to_wall = Metric.dist_to_wall(sphere, total_step, direction, self.boundaries)
         closest_sphere_dist, closest_sphere = Metric.dist_to_collision(sphere, other_spheres, total_step, direction,
-                                                                       self.boundaries, cut_off)
-        case = np.argmin([min_dist_to_wall, closest_sphere_dist, total_step, self.current_step])
-        if case == 0:  # it hits a wall
-            self.current_step = min_dist_to_wall
-            return Event(EventType.WALL, [])
-        if case == 1:  # it hits another sphere
-            self.current_step = closest_sphere_dist
-            return Event(EventType.COLLISION, closest_sphere)
-        if case == 2:  # it hits nothing, both min_dist_to_wall and closest_sphere_dist are inf
-            self.current_step = total_step
-            return Event(EventType.FREE, [])
-        else:  # total_step > current_step
-            return Event(EventType.PASS, [])  # do not update step.current_step, because next step is PASS and he
-            # would not actually perform total step
+                                                                       None if shifted else self.boundaries, cut_off)
+        if type(closest_sphere) == Ghost:
+            closest_sphere = closest_sphere.sphere
+        event = self.event
+        # the first of the smallest, as np.argmin([min_dist_to_wall, closest_sphere_dist, total_step, current_step])
+        event.event_type, event.other_sphere, step = EventType.WALL, [], min_dist_to_wall  # it hits a wall
+        if closest_sphere_dist < step:  # it hits another sphere
+            event.event_type, event.other_sphere, step = EventType.COLLISION, closest_sphere, closest_sphere_dist
+        if total_step < step:  # it hits nothing, both min_dist_to_wall and closest_sphere_dist are inf
+            event.event_type, event.other_sphere, step = EventType.FREE, [], total_step
+        if self.current_step < step:  # total_step > current_step
+            event.event_type, event.other_sphere = EventType.PASS, []  # do not update step.current_step, because next
+            # step is PASS and he would not actually perform total step
+        else:
+            self.current_step = step
+        return event
 
 
 class Event2DCells(ArrayOfCells):
 
-    def __init__(self, edge, n_rows, n_columns, l_z):
+    def __init__(self, edge, n_rows, n_columns, l_z, edge_y=None):
         """
         Construct a 2 dimension default choice list of empty cells (without spheres), with constant edge
         :param n_rows: number of rows in the array of cells
         :param n_columns: number of columns in the array of cells
-        :param edge: constant edge size of all cells is assumed and needs to be declared
+        :param edge: constant edge size of all cells is assumed and needs to be declared. It is the x edge of the cells
+        if edge_y is given.
+        :param edge_y: y edge of rectangular cells, None for square cells
         """
+        edge_y = edge if edge_y is None else edge_y
         l_x = edge * n_columns
-        l_y = edge * n_rows
-        cells = [[[] for _ in range(n_columns)] for _ in range(n_rows)]
-        for i in range(n_rows):
-            for j in range(n_columns):
-                site = (edge * j, edge * i)
-                cells[i][j] = Cell(site, [edge, edge], ind=(i, j))
-                cells[i][j].spheres = []
-        boundaries = [l_x, l_y, l_z]
-        super().__init__(2, boundaries, cells=cells)
-        self.edge = edge
-        self.l_x = l_x
-        self.l_y = l_y
-        self.l_z = l_z
+        l_y = edge_y * n_rows
+        with no_gc():
+            cells = [[[] for _ in range(n_columns)] for _ in range(n_rows)]
+            for i in range(n_rows):
+                for j in range(n_columns):
+                    site = (edge * j, edge_y * i)
+                    cells[i][j] = Cell(site, [edge, edge_y], ind=(i, j))
+                    cells[i][j].spheres = []
+            boundaries = [l_x, l_y, l_z]
+            super().__init__(2, boundaries, cells=cells)
+            self.edge = edge
+            self.edge_y = edge_y
+            self.l_x = l_x
+            self.l_y = l_y
+            self.l_z = l_z
+            self.update_stencils()
+
+    def update_stencils(self):
+        """
+        Cache, for every cell and direction, the cells perform_total_step scans for collisions. Should be called
+        whenever n_rows, n_columns or the system size change.
+        The cells of a stencil across the periodic boundaries are ghost cells of a one cell halo around the system,
+        holding Ghost copies of the spheres of the cell on the other side already shifted by the system size, so the
+        collision search uses plain geometry with a single image of every sphere. The ghosts are kept up to date by
+        append_sphere and remove_sphere, see update_halo.
+        """
+        with no_gc():
+            self.flat_cells = [c for row in self.cells for c in row]
+            self.halo = {}  # (flat index, wx, wy) -> ghost cell
+            self.cell_ghosts = [[] for _ in self.flat_cells]  # flat index -> [(ghost cell, (wx, wy))]
+            self.stencils = []
+            for stencil, wraps in zip(ArrayOfCells.direction_stencils(self.n_rows, self.n_columns),
+                                      ArrayOfCells.direction_stencil_wraps(self.n_rows, self.n_columns)):
+                self.stencils.append([[self._image_cell(k, tuple(w), create=True) for k, w in
+                                       zip(row, row_wraps)] for row, row_wraps in zip(stencil.tolist(),
+                                                                                       wraps.tolist())])
+            self.update_halo()
+
+    def _image_cell(self, k, wrap, create=False):
+        """
+        :param k: flat index of a cell
+        :param wrap: (wx, wy) of its image, see ArrayOfCells.direction_stencil_wraps
+        :param create: add the image to the halo if it is not there yet
+        :return: the cell itself if wrap is (0, 0), and otherwise its ghost cell. Images beyond the halo, which only
+        long marching steps reach, are built on the fly.
+        """
+        if wrap == (0, 0):
+            return self.flat_cells[k]
+        ghost_cell = self.halo.get((k,) + wrap)
+        if ghost_cell is None:
+            cell = self.flat_cells[k]
+            i, j = cell.ind[:2]
+            ghost_cell = Cell((cell.site[0] + wrap[0] * self.l_x, cell.site[1] + wrap[1] * self.l_y), cell.edges,
+                              ind=(i + wrap[1] * self.n_rows, j + wrap[0] * self.n_columns))
+            ghost_cell.spheres = [Ghost(sphere, wrap, self.boundaries) for sphere in cell.spheres]
+            if create:
+                self.halo[(k,) + wrap] = ghost_cell
+                self.cell_ghosts[k].append((ghost_cell, wrap))
+        return ghost_cell
+
+    def update_halo(self):
+        """
+        Rebuild all the Ghost spheres of the halo, needed after spheres are moved outside perform_total_step
+        """
+        with no_gc():
+            for k, cell in enumerate(self.flat_cells):
+                for ghost_cell, wrap in self.cell_ghosts[k]:
+                    ghost_cell.spheres = [Ghost(sphere, wrap, self.boundaries) for sphere in cell.spheres]
+
+    def remove_sphere(self, sphere, cell=None):
+        """
+        Remove sphere from its cell, and its ghosts from the halo
+        :param cell: the cell of sphere, default cell_of_sphere
+        """
+        cell = self.cell_of_sphere(sphere) if cell is None else cell
+        cell.remove_sphere(sphere)
+        for ghost_cell, _ in self.cell_ghosts[cell.ind[0] * self.n_columns + cell.ind[1]]:
+            ghosts = ghost_cell.spheres
+            for n in range(len(ghosts)):
+                if ghosts[n].sphere is sphere:
+                    del ghosts[n]
+                    break
 
     def cell_of_sphere(self, sphere):
-        return self.cells[int(np.floor(sphere.center[1] / self.edge))][int(np.floor(sphere.center[0] / self.edge))]
+        return self.cells[int(np.floor(sphere.center[1] / self.edge_y))][int(np.floor(sphere.center[0] / self.edge))]
+
+    def occupancy(self):
+        """
+        :return: centers in the order of all_spheres, and for every sphere the flat index of its cell and its position
+        inside the cell, enough to rebuild the exact same state with load_occupancy
+        """
+        if self.all_spheres == []:
+            self.update_all_spheres()
+        place = {id(s): (k, slot) for k, c in enumerate(self.flat_cells) for slot, s in enumerate(c.spheres)}
+        sphere_cell, sphere_slot = zip(*[place[id(s)] for s in self.all_spheres])
+        return np.array(self.all_centers, dtype=float), np.array(sphere_cell), np.array(sphere_slot)
+
+    def load_occupancy(self, centers, sphere_cell, sphere_slot, rad):
+        """
+        Fill the empty cells with spheres at known cells and positions, as returned by occupancy, without binning
+        """
+        self.all_spheres = [Sphere(tuple(c), rad) for c in centers]
+        for sphere_id in np.lexsort((sphere_slot, sphere_cell)):
+            self.flat_cells[sphere_cell[sphere_id]].append(self.all_spheres[sphere_id])
+        self.update_halo()
 
     def append_sphere(self, spheres):
         if type(spheres) != list:
             assert type(spheres) == Sphere
-            spheres = [spheres]
+            cell = self.cell_of_sphere(spheres)
+            cell.append(spheres)
+            for ghost_cell, wrap in self.cell_ghosts[cell.ind[0] * self.n_columns + cell.ind[1]]:
+                ghost_cell.spheres.append(Ghost(spheres, wrap, self.boundaries))
+            return cell
+        # bin all the spheres at once, same as cell_of_sphere
+        xy = np.array([sphere.center[:2] for sphere in spheres], dtype=float).reshape((-1, 2))
+        ks = ((np.floor(xy[:, 1] / self.edge_y).astype(int) % self.n_rows) * self.n_columns + np.floor(
+            xy[:, 0] / self.edge).astype(int) % self.n_columns).tolist()
         cells = []
-        for sphere in spheres:
-            cell = self.cell_of_sphere(sphere)
-            cell.append(sphere)
+        for sphere, k in zip(spheres, ks):
+            cell = self.flat_cells[k]
+            cell.spheres.append(sphere)
             cells.append(cell)
+            for ghost_cell, wrap in self.cell_ghosts[k]:
+                ghost_cell.spheres.append(Ghost(sphere, wrap, self.boundaries))
         if len(cells) == 1:
             return cells[0]
         return cells
 
-    def maximal_free_step(self, i, j, step: Step):
+    def maximal_free_step(self, i, j, step: Step, bands=1):
         """
         Returns the maximal free step allowed so the sphere would pass between the cells, without overlapping outside
         the new cell
         :type step: Step
+        :param bands: number of cells ahead of cell (i,j) the sphere may go into, see marching_cells
         :return: the corresponding maximal free step allowed
         """
         if step.direction.dim == 2:
             return float('inf')
         else:
             return float(
-                self.cells[i][j].site[step.direction.dim] + 2 * self.edge - 2 * step.sphere.rad - step.sphere.center[
-                    step.direction.dim])
+                self.cells[i][j].site[step.direction.dim] + (bands + 1) * self.cells[i][j].edges[step.direction.dim] -
+                2 * step.sphere.rad - step.sphere.center[step.direction.dim])
+
+    def marching_cells(self, i, j, step: Step, bands=None):
+        """
+        Cells the sphere of step in cell (i,j) might collide with in its next event. An x or y step marches along the
+        row (column) of the sphere over as many cells as the total step left needs, so passing between cells does not
+        make a PASS event. Only steps longer than the system still pass, after n_columns-1 (n_rows-1) cells.
+        :type step: Step
+        :param bands: number of cells to march ahead, None for as many as the total step left needs
+        :return: list of the cells, ghost cells across the boundaries, and the maximal free step allowed inside them
+        """
+        dim = step.direction.dim
+        if dim == 2:
+            return self.stencils[2][i * self.n_columns + j], float('inf')
+        if bands == 1:
+            return self.stencils[dim][i * self.n_columns + j], self.maximal_free_step(i, j, step)
+        cell = self.cells[i][j]
+        if bands is None:
+            bands = ArrayOfCells.marching_bands(step.sphere.center[dim] - cell.site[dim], step.total_step,
+                                                2 * step.sphere.rad, cell.edges[dim],
+                                                self.n_columns if dim == 0 else self.n_rows)
+        cells, wraps = ArrayOfCells.marching_stencil(i, j, self.n_rows, self.n_columns, dim, bands)
+        return [self._image_cell(k, tuple(w)) for k, w in zip(cells.tolist(), wraps.tolist())], \
+            self.maximal_free_step(i, j, step, bands)
 
-    def perform_total_step(self, i, j, step: Step, draw=None, record_displacements=False):
+    def perform_total_step(self, i, j, step: Step, draw=None, record_displacements=False, telemetry=None):
         """
         Perform step for all the spheres, starting from sphere inside cell
         :param i: indices of the cell containing the sphere trying to make a move
         :param j: indices of the cell containing the sphere trying to make a move
         :type step: Step
         :type draw: WriteOrLoad
+        :param telemetry: Telemetry counting the events and the candidate spheres of every event
         """
         if record_displacements:
             displacements = 0
             # init_time = time.time()  # use record displacement as debug mode switch
+        transfer_region, search_region = regions('cell transfer', 'collision search')
 
         while step.total_step > 0:
             # if time.time() - init_time > 10:
@@ -151,42 +298,40 @@ class Event2DCells(ArrayOfCells):
                 draw.dump_spheres(self.all_centers, img_name)
 
             sphere, direction, cell = step.sphere, step.direction, self.cells[i][j]
-            cell.remove_sphere(sphere)
+            with transfer_region:
+                self.remove_sphere(sphere, cell)
 
-            other_spheres = [s for s in cell.spheres]
-
-            def add(c):
-                for s in c.spheres:
-                    other_spheres.append(s)
-
-            ip1, jp1, im1, jm1 = ArrayOfCells.cyclic_indices(i, j, self.n_rows, self.n_columns)
-            if direction.dim == 0:
-                for c in [self.cells[ip1][j], self.cells[ip1][jp1], self.cells[i][jp1],
-                          self.cells[im1][jp1], self.cells[im1][j]]:
-                    add(c)
-            else:
-                if direction.dim == 1:
-                    for c in [self.cells[i][jm1], self.cells[ip1][jm1], self.cells[ip1][j],
-                              self.cells[ip1][jp1], self.cells[i][jp1]]:
-                        add(c)
-                else:
-                    for c in [self.cells[ip1][jm1], self.cells[ip1][j], self.cells[ip1][jp1], self.cells[i][jp1],
-                              self.cells[i][jm1], self.cells[im1][jm1], self.cells[im1][j], self.cells[im1][jp1]]:
-                        add(c)
-            step.current_step = self.maximal_free_step(i, j, step)
-            event = step.next_event(other_spheres, cut_off=self.edge)  # updates step.current_step
+            with search_region:
+                # the neighboring cells first, most events happen in them and the candidates are costly to gather
+                cells, step.current_step = self.marching_cells(i, j, step, bands=1)
+                other_spheres = [s for c in cells for s in c.spheres]
+                event = step.next_event(other_spheres, shifted=True)  # updates step.current_step
+                candidates = len(other_spheres)
+                if event.event_type == EventType.PASS:
+                    cells, current_step = self.marching_cells(i, j, step)
+                    if current_step > step.current_step:
+                        step.current_step = current_step
+                        other_spheres = [s for c in cells for s in c.spheres]
+                        event = step.next_event(other_spheres, shifted=True)
+                        candidates += len(other_spheres)
+            if telemetry is not None:
+                telemetry.event(event.event_type, candidates)
             step.sphere.perform_step(direction, step.current_step, self.boundaries)
             step.total_step = step.total_step - step.current_step
             if record_displacements:
                 displacements += 1
-            new_cell = self.append_sphere(sphere)
+            with transfer_region:
+                new_cell = self.append_sphere(sphere)
             i, j = new_cell.ind[:2]
             if event.event_type == EventType.COLLISION:
+                dx = event.other_sphere.center[direction.dim] - sphere.center[direction.dim]
+                step.lift += direction.sgn * dx if direction.dim == 2 else dx % self.boundaries[direction.dim]
                 step.sphere = event.other_sphere
                 i, j = self.cell_of_sphere(step.sphere).ind[:2]
                 continue
             if event.event_type == EventType.WALL:
-                step.direction.sgn = -1 * step.direction.sgn
+                step.wall_events += 1
+                step.direction = step.direction.opposite()
                 continue
             if event.event_type == EventType.PASS:
                 continue
@@ -201,26 +346,30 @@ class Event2DCells(ArrayOfCells):
         :param n_col: same, each triangular lattice has n_col columns
         :param rad: not a list, a single number of the same radius for all spheres
         """
+        centers = self.AF_triangular_centers(n_row, n_col, rad)
+        with no_gc():
+            self.append_sphere([Sphere(c, rad) for c in centers.tolist()])
+        self.update_all_spheres()
+        assert self.legal_configuration()
+
+    def AF_triangular_centers(self, n_row, n_col, rad):
+        """
+        :return: (n_row*n_col,3) centers of generate_spheres_in_AF_triangular_structure, the lower triangular lattice
+        and then the upper one
+        """
         assert type(rad) != list, "list of different rads is not supported for initial condition AF triangular"
         l_x, l_y, l_z = self.boundaries
         assert n_row % 2 == 0, "n_row should be even for anti-ferromagnetic triangular Initial conditions"
         ay = 2 * l_y / n_row
-        spheres_down = ArrayOfCells.spheres_in_triangular(int(n_row / 2), n_col, rad, l_x, l_y)
-        spheres_up = ArrayOfCells.spheres_in_triangular(int(n_row / 2), n_col, rad, l_x, l_y)
+        down = ArrayOfCells.triangular_centers(int(n_row / 2), n_col, rad, l_x, l_y)
+        up = ArrayOfCells.triangular_centers(int(n_row / 2), n_col, rad, l_x, l_y)
         dz_max = np.sqrt(max((2 * rad) ** 2 - (2.0 / 3.0 * ay) ** 2, 0))
         dr_max = (self.l_z / 2 - rad - dz_max / 2) / 2  # by two to not have coincidence collision
-        for s in spheres_down:
-            assert type(s) == Sphere
-            cx, cy = s.center[:2]
-            s.center = [cx, cy, rad + dr_max * np.random.random()]
-        for s in spheres_up:
-            assert type(s) == Sphere
-            cx, cy = s.center[:2]
-            s.center = [cx, cy + ay * 2.0 / 3, l_z - rad - dr_max * np.random.random()]
-            s.box_it(self.boundaries)
-        self.append_sphere(spheres_down + spheres_up)
-        self.update_all_spheres()
-        assert self.legal_configuration()
+        down[:, 2] = rad + dr_max * np.random.random(len(down))
+        up[:, 1] = up[:, 1] + ay * 2.0 / 3
+        up[:, 2] = l_z - rad - dr_max * np.random.random(len(up))
+        up %= np.array(self.boundaries)  # box_it
+        return np.concatenate((down, up))
 
     def generate_spheres_in_AF_square(self, n_sp_row, n_sp_col, rad):
         """
@@ -228,25 +377,50 @@ class Event2DCells(ArrayOfCells):
         :param n_spheres_per_cell: number of total sphere in each cell
         :param rad: not a list, a single number of the same radius for all spheres
         """
+        centers = self.AF_square_centers(n_sp_row, n_sp_col, rad)
+        with no_gc():
+            self.append_sphere([Sphere(c, rad) for c in centers.tolist()])
+        self.update_all_spheres()
+        assert self.legal_configuration()
+
+    def AF_square_centers(self, n_sp_row, n_sp_col, rad):
+        """
+        :return: (n_sp_row*n_sp_col,3) centers of generate_spheres_in_AF_square, row by row
+        """
         assert type(rad) != list, "list of different rads is not supported for initial condition AF triangular"
         sig = 2 * rad
         ax, ay = self.l_x / n_sp_col, self.l_y / n_sp_row
         a = min(ax, ay)
         assert a ** 2 + (self.l_z - sig) ** 2 > sig ** 2 and 4 * a ** 2 > sig ** 2, \
             "Can not create so many spheres in the AF square lattice"
-        spheres = []
         dz_max = np.sqrt(max(sig ** 2 - a ** 2, 0))
         dr_max = self.l_z / 2 - rad - dz_max / 2  # by two to not have coincidence collision
-        for i in range(n_sp_row):
-            for j in range(n_sp_col):
-                sign = (-1) ** (i + j)
-                r = rad + 100 * epsilon
-                dr = np.random.random() * dr_max
-                x, y, z = (j + 1 / 2) * ax, (i + 1 / 2) * ay, sign * (r + dr) + self.l_z * (1 - sign) / 2
-                spheres.append(Sphere([x, y, z], rad))
-        self.append_sphere(spheres)
-        self.update_all_spheres()
-        assert self.legal_configuration()
+        i, j = np.divmod(np.arange(n_sp_row * n_sp_col), n_sp_col)
+        sign = 1 - 2 * ((i + j) % 2)  # (-1) ** (i + j)
+        r = rad + 100 * epsilon
+        dr = np.random.random(len(i)) * dr_max
+        return np.stack([(j + 1 / 2) * ax, (i + 1 / 2) * ay, sign * (r + dr) + self.l_z * (1 - sign) / 2], axis=1)
+
+    def resample_z(self, sphere, rng=random):
+        """
+        Heat bath move in z: redraw the height of sphere uniformly among all the heights it can have without overlap,
+        keeping its x and y, see Metric.allowed_z_intervals. Unlike a z chain it can move a sphere past a neighbor above
+        or below it, which flips the up and down states of the AF lattices quickly.
+        :type sphere: Sphere
+        :param rng: the random module, a random.Random or a np.random.Generator
+        :return: the new height of sphere
+        """
+        cell = self.cell_of_sphere(sphere)
+        # the cell and its 8 neighbors, ghost cells across the boundaries, hold every sphere closer than sig in xy
+        others = [s.center for c in self.stencils[2][cell.ind[0] * self.n_columns + cell.ind[1]] for s in c.spheres if
+                  s is not sphere]
+        intervals = Metric.allowed_z_intervals(sphere.center, sphere.rad, others, self.l_z)
+        if len(intervals) == 0:  # touching within the margin, stay
+            return sphere.center[2]
+        self.remove_sphere(sphere, cell)
+        sphere.center[2] = Metric.uniform_in_intervals(intervals, rng.random())
+        self.append_sphere(sphere)  # and its ghosts
+        return sphere.center[2]
 
     def scale_xy(self, factor):
         """
@@ -256,12 +430,14 @@ class Event2DCells(ArrayOfCells):
         :return:
         """
         self.edge *= factor
+        self.edge_y *= factor
         self.l_x *= factor
         self.l_y *= factor
         # not self.l_z
         self.boundaries[0] *= factor
         self.boundaries[1] *= factor
         # not self.boundaries[2]
+        spheres = []
         for i in range(len(self.cells)):
             for j in range(len(self.cells[i])):
                 c = self.cells[i][j]
@@ -269,78 +445,725 @@ class Event2DCells(ArrayOfCells):
                 c.edges = [e * factor for e in c.edges]  # cell is 2D
                 for s in c.spheres:
                     s.center = [s.center[0] * factor, s.center[1] * factor, s.center[2]]
+                spheres += c.spheres
+                c.spheres = []
+        self.update_stencils()  # the ghost cells are shifted by the new system size
+        # rounding can move a center on the face of its cell to the neighbor cell of cell_of_sphere
+        self.append_sphere(spheres)
+        self.update_all_spheres()
+        assert self.legal_configuration(), "Scaling failed, illegal configuration"
+
+    def scale_z(self, factor):
+        """
+        Scale the z separations of the spheres and the free height l_z-2*rad by factor, keeping the bottom wall in place
+        :param factor: factor<1 means lower walls
+        """
+        rad = self.all_spheres[0].rad
+        for s in self.all_spheres:
+            s.center = [s.center[0], s.center[1], rad + factor * (s.center[2] - rad)]
+        self.l_z = 2 * rad + factor * (self.l_z - 2 * rad)
+        self.boundaries[2] = self.l_z
+        self.update_halo()
         assert self.legal_configuration(), "Scaling failed, illegal configuration"
 
+    def regrid(self, n_rows, n_columns):
+        """
+        Replace the cells by n_rows x n_columns cells over the same boundaries, and bin the spheres into them
+        """
+        spheres = self.all_spheres
+        assert min(self.l_x / n_columns, self.l_y / n_rows) > 2 * spheres[0].rad, "Cells should be wider than a sphere"
+        new_arr = Event2DCells(edge=self.l_x / n_columns, n_rows=n_rows, n_columns=n_columns, l_z=self.l_z,
+                               edge_y=self.l_y / n_rows)
+        self.cells = new_arr.cells
+        self.n_rows, self.n_columns, self.edge, self.edge_y = n_rows, n_columns, new_arr.edge, new_arr.edge_y
+        self.update_stencils()
+        self.append_sphere(spheres)
+        self.update_all_spheres()
+
     def quench(self, desired_rho):
         """
-        Moving spheres far from the boundary conditions andclosing the boundary conditions until the
-        density becomes dest_rho. If dest_rho is larger then current rho we simply scale.
-        Quite similiar to Simulated Annealing, and the method name could be annealing as well. As formally I simply
-        rapidly change the boundaries in order to get the desiered density, with no equilibration in the proccess,
-        simulated Annealing is a bit more specific then that, I chose the name quench.
+        Compress xy until the density becomes desired_rho, see compress. If desired_rho is smaller then current rho we
+        simply scale.
         :param desired_rho: density destination
         """
-        spheres = self.all_spheres
-        N = len(spheres)
-        rho = N * ((2 * spheres[0].rad) ** 3) / (self.l_x * self.l_y * self.l_z)
-        while rho < desired_rho:  # we need to compress
-            min_x, i_min_x = min((s.center[0] - s.rad, i_sp) for (i_sp, s) in enumerate(spheres))
-            max_x, i_max_x = max((s.center[0] + s.rad, i_sp) for (i_sp, s) in enumerate(spheres))
-            min_y, i_min_y = min((s.center[1] - s.rad, i_sp) for (i_sp, s) in enumerate(spheres))
-            max_y, i_max_y = max((s.center[1] + s.rad, i_sp) for (i_sp, s) in enumerate(spheres))
-            new_lx = max_x - min_x
-            new_ly = max_y - min_y
-            if new_lx < self.l_x or new_ly < self.l_y:  # we have some space to squizz
-                vec_to_zero = np.array([0.0, 0.0])
-                if new_lx < self.l_x:
-                    vec_to_zero[0] = -min_x
-                    self.l_x = new_lx
-                if new_ly < self.l_y:
-                    vec_to_zero[1] = -min_y
-                    self.l_y = new_ly
-                all_spheres = self.translate(vec_to_zero)  # emptied all spheres from self
-                self.boundaries = [self.l_x, self.l_y, self.l_z]
-                self.n_rows, self.n_columns = int(np.ceil(self.l_y / self.edge)), int(np.ceil(self.l_x / self.edge))
-                for i_sp in range(len(all_spheres)):
-                    all_spheres[i_sp].box_it(self.boundaries)
-                self.append_sphere(all_spheres)
-                assert self.legal_configuration()
-            else:  # we must move spheres around before squizzing
-                indices = [i_min_y, i_min_x, i_max_y, i_max_x]
-                for i_sp, direction in zip(indices, Direction.directions()):
-                    sphere = self.all_spheres[i_sp]
-                    # total_step = 10 * sphere.rad
-                    total_step = sphere.rad / 2
-                    step = Step(sphere, total_step, direction, self.boundaries)
-                    cell = self.append_sphere(sphere)
-                    i, j = cell.ind[:2]
-                    self.perform_total_step(i, j, step)
-            rho = N * ((2 * self.all_spheres[0].rad) ** 3) / (self.l_x * self.l_y * self.l_z)
+        rad = self.all_spheres[0].rad
+        rho = len(self.all_spheres) * ((2 * rad) ** 3) / (self.l_x * self.l_y * self.l_z)
         if rho > desired_rho:
-            factor = np.sqrt(rho / desired_rho)  # >= 1
-            self.scale_xy(factor)
+            self.scale_xy(np.sqrt(rho / desired_rho))  # >= 1
+            return
+        assert compress(self, desired_rho=desired_rho, max_seconds=None), "Quench to rho=" + str(
+            desired_rho) + " failed"
 
     def z_quench(self, desired_lz):
-        assert_exit = False
-        while self.l_z > desired_lz:
-            min_z, i_min_z = min((s.center[2] - s.rad, i_sp) for (i_sp, s) in enumerate(self.all_spheres))
-            for s in self.all_spheres:
-                s.center[2] -= min_z
-            max_z, i_max_z = max((s.center[2] + s.rad, i_sp) for (i_sp, s) in enumerate(self.all_spheres))
-            if max_z < desired_lz:
-                max_z = desired_lz
-                assert_exit = True
-            self.l_z = max_z
-            self.boundaries = [self.l_x, self.l_y, self.l_z]
-            if assert_exit: return
-            sp_down, sp_up = self.all_spheres[i_min_z], self.all_spheres[i_max_z]
-            total_step = sp_up.rad / 2
-            for direction in Direction.directions()[0:2]:
-                step_sp_down = Step(sp_down, total_step, direction, self.boundaries)
-                step_sp_up = Step(sp_up, total_step, direction if direction.dim != 2 else Direction.directions()[-1],
-                                  self.boundaries)
-                cell_down, cell_up = self.append_sphere(sp_down), self.append_sphere(sp_up)
-                id, jd = cell_down.ind[:2]
-                self.perform_total_step(id, jd, step_sp_down)
-                iu, ju = cell_up.ind[:2]
-                self.perform_total_step(iu, ju, step_sp_up)
+        """
+        Lower the walls until l_z becomes desired_lz, see compress
+        """
+        assert compress(self, desired_lz=desired_lz, max_seconds=None), "zQuench to lz=" + str(desired_lz) + " failed"
+
+
+class ArrayEvent2DCells:
+
+    def __init__(self, edge, n_rows, n_columns, l_z, rad=1.0, capacity=4, jit=False, edge_y=None):
+        """
+        Structure of arrays alternative to Event2DCells. Sphere centers are kept in one contiguous (N,3) float64 array,
+        and every cell holds a fixed capacity row of integer sphere ids. Spheres are identified by their stable index
+        in centers instead of by Sphere objects, so Step.sphere is an int for this backend.
+        Cells are never left full, capacity grows as soon as a cell is filled.
+        :param edge: constant edge size of all cells, the x edge if edge_y is given
+        :param n_rows: number of rows in the array of cells
+        :param n_columns: number of columns in the array of cells
+        :param l_z: distance between the two rigid walls
+        :param rad: radius of all the spheres, list of different rads is not supported
+        :param capacity: initial number of slots in each cell, doubled whenever a cell is full
+        :param jit: run chains in EventChainKernel, should be True only if EventChainKernel.jit_available
+        :param edge_y: y edge of rectangular cells, None for square cells
+        """
+        self.dim = 2
+        self.edge = edge
+        self.edge_y = edge if edge_y is None else edge_y
+        self.n_rows = n_rows
+        self.n_columns = n_columns
+        self.l_x = edge * n_columns
+        self.l_y = self.edge_y * n_rows
+        self.l_z = l_z
+        self.boundaries = [self.l_x, self.l_y, l_z]
+        self.rad = rad
+        self.centers = np.zeros((0, 3))
+        self.sphere_cell = np.zeros(0, dtype=np.int64)  # flat cell index k=i*n_columns+j of every sphere
+        self.sphere_slot = np.zeros(0, dtype=np.int64)  # position of the sphere inside cell_spheres[k]
+        self.cell_spheres = np.full((n_rows * n_columns, capacity), -1, dtype=np.int64)
+        self.cell_count = np.zeros(n_rows * n_columns, dtype=np.int64)
+        self.stencils = ArrayOfCells.direction_stencils(n_rows, n_columns)
+        self.stencil_wraps = ArrayOfCells.direction_stencil_wraps(n_rows, n_columns)
+        self.jit = jit
+
+    @classmethod
+    def from_cells(cls, arr: Event2DCells, capacity=4):
+        """
+        Copy the configuration of an Event2DCells instance into a new array backed instance
+        :type arr: Event2DCells
+        """
+        arr.update_all_spheres()
+        new_arr = cls(arr.edge, arr.n_rows, arr.n_columns, arr.l_z, rad=arr.all_spheres[0].rad, capacity=capacity,
+                      edge_y=arr.edge_y)
+        new_arr.boundaries = [b for b in arr.boundaries]
+        new_arr.l_x, new_arr.l_y = arr.l_x, arr.l_y
+        new_arr.append_sphere(arr.all_centers)
+        return new_arr
+
+    @property
+    def n_spheres(self):
+        return len(self.centers)
+
+    @property
+    def cut_off(self):
+        """
+        :return: distance from the boundaries within which cyclic images of a sphere are candidates for collision, see
+        Metric.dist_to_collision_batch
+        """
+        return max(self.edge, self.edge_y)
+
+    @property
+    def all_centers(self):
+        """
+        :return: (N,3) array of all the centers, row n is the center of sphere id n. It is a view, not a copy.
+        """
+        return self.centers
+
+    def cell_ind(self, center):
+        """
+        :return: flat index k=i*n_columns+j of the cell the center belongs to
+        """
+        i = int(np.floor(center[1] / self.edge_y)) % self.n_rows
+        j = int(np.floor(center[0] / self.edge)) % self.n_columns
+        return i * self.n_columns + j
+
+    def cells_ind(self, centers):
+        """
+        Same as cell_ind, for an (M,3) array of centers
+        """
+        i = np.floor(centers[:, 1] / self.edge_y).astype(np.int64) % self.n_rows
+        j = np.floor(centers[:, 0] / self.edge).astype(np.int64) % self.n_columns
+        return i * self.n_columns + j
+
+    def cell_of_sphere(self, sphere):
+        """
+        :param sphere: sphere id
+        :return: (i, j) indices of the cell holding the sphere
+        """
+        return divmod(int(self.sphere_cell[sphere]), self.n_columns)
+
+    def _grow(self):
+        capacity = self.cell_spheres.shape[1]
+        extra = np.full((len(self.cell_spheres), capacity), -1, dtype=np.int64)
+        self.cell_spheres = np.concatenate((self.cell_spheres, extra), axis=1)
+
+    def _insert(self, sphere, k):
+        slot = self.cell_count[k]
+        self.cell_spheres[k, slot] = sphere
+        self.cell_count[k] = slot + 1
+        self.sphere_cell[sphere] = k
+        self.sphere_slot[sphere] = slot
+        if self.cell_count[k] == self.cell_spheres.shape[1]:
+            self._grow()
+
+    def _bulk_insert(self, spheres, ks):
+        """
+        Same state as calling _insert(sphere, k) for every sphere in order, in a few array operations
+        :param spheres: ids of the spheres
+        :param ks: flat index of the cell of every sphere
+        """
+        if len(spheres) == 0:
+            return
+        order = np.argsort(ks, kind='stable')
+        new_count = np.bincount(ks, minlength=len(self.cell_count))
+        first = np.cumsum(new_count) - new_count
+        slots = np.empty(len(ks), dtype=np.int64)
+        slots[order] = np.arange(len(ks)) - first[ks[order]]  # rank of the sphere among the new ones of its cell
+        slots += self.cell_count[ks]
+        self.cell_count += new_count
+        while self.cell_spheres.shape[1] <= self.cell_count.max():
+            self._grow()
+        self.cell_spheres[ks, slots] = spheres
+        self.sphere_cell[spheres] = ks
+        self.sphere_slot[spheres] = slots
+
+    def _remove(self, sphere):
+        """
+        Remove sphere from its cell by moving the last sphere of the cell into its slot
+        """
+        k, slot = self.sphere_cell[sphere], self.sphere_slot[sphere]
+        last = self.cell_count[k] - 1
+        moved = self.cell_spheres[k, last]
+        self.cell_spheres[k, slot] = moved
+        self.sphere_slot[moved] = slot
+        self.cell_spheres[k, last] = -1
+        self.cell_count[k] = last
+
+    def append_sphere(self, spheres):
+        """
+        Add new spheres to the simulation and bin them into their cells
+        :param spheres: a single center, (M,3) array of centers, Sphere object or list of Sphere objects
+        :return: ids of the new spheres
+        """
+        if isinstance(spheres, Sphere):
+            spheres = [spheres]
+        if len(spheres) > 0 and isinstance(spheres[0], Sphere):
+            spheres = [s.center for s in spheres]
+        new_centers = np.array(spheres, dtype=float).reshape((-1, 3))
+        first = self.n_spheres
+        self.centers = np.concatenate((self.centers, new_centers))
+        self.sphere_cell = np.concatenate((self.sphere_cell, np.zeros(len(new_centers), dtype=np.int64)))
+        self.sphere_slot = np.concatenate((self.sphere_slot, np.zeros(len(new_centers), dtype=np.int64)))
+        ids = np.arange(first, self.n_spheres)
+        self._bulk_insert(ids, self.cells_ind(new_centers))
+        return ids
+
+    def occupancy(self):
+        """
+        :return: centers, and for every sphere the flat index of its cell and its slot inside the cell
+        """
+        return self.centers, self.sphere_cell, self.sphere_slot
+
+    def load_occupancy(self, centers, sphere_cell, sphere_slot, rad=None):
+        """
+        Replace all the spheres by spheres at known cells and slots, as returned by occupancy, without binning
+        """
+        self.centers = np.array(centers, dtype=float).reshape((-1, 3))
+        self.sphere_cell = np.array(sphere_cell, dtype=np.int64)
+        self.sphere_slot = np.array(sphere_slot, dtype=np.int64)
+        self.cell_count = np.bincount(self.sphere_cell, minlength=self.n_rows * self.n_columns).astype(np.int64)
+        capacity = self.cell_spheres.shape[1]
+        while capacity <= self.cell_count.max():
+            capacity *= 2
+        self.cell_spheres = np.full((self.n_rows * self.n_columns, capacity), -1, dtype=np.int64)
+        self.cell_spheres[self.sphere_cell, self.sphere_slot] = np.arange(len(self.centers))
+
+    def rebin(self):
+        """
+        Recalculate the cell occupancy of all spheres, needed after spheres are moved outside perform_total_step
+        """
+        self.cell_spheres[:] = -1
+        self.cell_count[:] = 0
+        self._bulk_insert(np.arange(self.n_spheres), self.cells_ind(self.centers))
+
+    def neighbor_spheres(self, i, j, direction: Direction):
+        """
+        :return: ids of the spheres in the cells of stencils[direction.dim] of cell (i,j), the cell and its neighbors a
+        sphere in it moving in direction might collide with, see ArrayOfCells.direction_stencils
+        """
+        members = self.cell_spheres[self.stencils[direction.dim][i * self.n_columns + j]].ravel()
+        return members[members >= 0]
+
+    def dist_to_collision(self, sphere, other_spheres, total_step, direction: Direction, shifts=None):
+        """
+        Same as Metric.dist_to_collision, for sphere ids
+        :param shifts: (len(other_spheres),2) xy shifts of the periodic image of every other sphere to collide with,
+        the ghost copies of Event2DCells, so no cyclic images are searched. None for cyclic images.
+        :return: distance for collision and the id of the sphere collided, (inf, -1) if there is no collision
+        """
+        other_centers, boundaries = self.centers[other_spheres], self.boundaries
+        if shifts is not None:
+            other_centers[:, :2] += shifts
+            boundaries = None
+        closest_sphere_dist, k = Metric.dist_to_collision_batch(self.centers[sphere], self.rad, other_centers,
+                                                                self.rad, total_step, direction, boundaries,
+                                                                self.cut_off)
+        return closest_sphere_dist, (other_spheres[k] if k >= 0 else -1)
+
+    def dist_to_wall(self, sphere, total_step, direction: Direction):
+        """
+        Same as Metric.dist_to_wall, for sphere id
+        """
+        if direction.dim != 2:
+            return float('inf')
+        z = self.centers[sphere, 2]
+        t = self.l_z - z - self.rad - epsilon if direction.sgn == +1 else z - self.rad - epsilon
+        return t if t < total_step else float('inf')
+
+    def maximal_free_step(self, i, j, step: Step, bands=1):
+        """
+        Same as Event2DCells.maximal_free_step
+        """
+        if step.direction.dim == 2:
+            return float('inf')
+        edge = self.edge if step.direction.dim == 0 else self.edge_y
+        site = edge * (j if step.direction.dim == 0 else i)
+        return float(site + (bands + 1) * edge - 2 * self.rad - self.centers[step.sphere, step.direction.dim])
+
+    def marching_cells(self, i, j, step: Step):
+        """
+        Same as Event2DCells.marching_cells, with the wraps of the cells instead of ghost cells
+        :return: flat indices of the cells, (wx, wy) of the image of every cell, see
+        ArrayOfCells.direction_stencil_wraps, and the maximal free step allowed inside them
+        """
+        dim = step.direction.dim
+        if dim == 2:
+            k = i * self.n_columns + j
+            return self.stencils[2][k], self.stencil_wraps[2][k], float('inf')
+        edge = self.edge if dim == 0 else self.edge_y
+        bands = ArrayOfCells.marching_bands(self.centers[step.sphere, dim] - edge * (j if dim == 0 else i),
+                                            step.total_step, 2 * self.rad, edge,
+                                            self.n_columns if dim == 0 else self.n_rows)
+        cells, wraps = ArrayOfCells.marching_stencil(i, j, self.n_rows, self.n_columns, dim, bands)
+        return cells, wraps, self.maximal_free_step(i, j, step, bands)
+
+    def next_event(self, step: Step, other_spheres, shifts=None):
+        """
+        Same as Step.next_event, for sphere ids. Updates step.current_step.
+        :param shifts: see dist_to_collision
+        :return: Event, with other_sphere being the id of the sphere collided
+        """
+        sphere, total_step, direction = step.sphere, step.total_step, step.direction
+        min_dist_to_wall = self.dist_to_wall(sphere, total_step, direction)
+        closest_sphere_dist, closest_sphere = self.dist_to_collision(sphere, other_spheres, total_step, direction,
+                                                                     shifts)
+        event = step.event
+        event.event_type, event.other_sphere, current_step = EventType.WALL, -1, min_dist_to_wall
+        if closest_sphere_dist < current_step:
+            event.event_type, event.other_sphere = EventType.COLLISION, closest_sphere
+            current_step = closest_sphere_dist
+        if total_step < current_step:
+            event.event_type, event.other_sphere, current_step = EventType.FREE, -1, total_step
+        if step.current_step < current_step:
+            event.event_type, event.other_sphere = EventType.PASS, -1
+        else:
+            step.current_step = current_step
+        return event
+
+    def perform_total_step(self, i, j, step: Step, record_displacements=False, telemetry=None):
+        """
+        Perform step for all the spheres, starting from sphere inside cell. Same as Event2DCells.perform_total_step,
+        with step.sphere being a sphere id.
+        :param i: indices of the cell containing the sphere trying to make a move
+        :param j: indices of the cell containing the sphere trying to make a move
+        :type step: Step
+        :param telemetry: Telemetry counting the events and the candidate spheres of every event
+        """
+        if self.jit:
+            return EventChainKernel.perform_total_step(self, step, record_displacements, telemetry)
+        if record_displacements:
+            displacements = 0
+        transfer_region, search_region = regions('cell transfer', 'collision search')
+        while step.total_step > 0:
+            sphere, direction = step.sphere, step.direction
+            with transfer_region:
+                self._remove(sphere)
+            with search_region:
+                cells, wraps, step.current_step = self.marching_cells(i, j, step)
+                other_spheres = self.cell_spheres[cells].ravel()
+                other_spheres = other_spheres[other_spheres >= 0]
+                # the images of the ghost cells of Event2DCells, the spheres of a cell fill its first slots
+                shifts = np.repeat(wraps * (self.l_x, self.l_y), self.cell_count[cells], axis=0)
+                event = self.next_event(step, other_spheres, shifts)  # updates step.current_step
+            if telemetry is not None:
+                telemetry.event(event.event_type, len(other_spheres))
+            c = self.centers[sphere]
+            c[direction.dim] += direction.sgn * step.current_step if direction.dim == 2 else step.current_step
+            c[direction.dim] %= self.boundaries[direction.dim]
+            step.total_step = step.total_step - step.current_step
+            if record_displacements:
+                displacements += 1
+            with transfer_region:
+                k = self.cell_ind(c)
+                self._insert(sphere, k)
+            i, j = divmod(k, self.n_columns)
+            if event.event_type == EventType.COLLISION:
+                dx = self.centers[event.other_sphere, direction.dim] - c[direction.dim]
+                step.lift += direction.sgn * dx if direction.dim == 2 else dx % self.boundaries[direction.dim]
+                step.sphere = event.other_sphere
+                i, j = self.cell_of_sphere(step.sphere)
+                continue
+            if event.event_type == EventType.WALL:
+                step.wall_events += 1
+                step.direction = step.direction.opposite()
+                continue
+            if event.event_type == EventType.PASS:
+                continue
+            if event.event_type == EventType.FREE:
+                if record_displacements: return displacements
+                return
+
+    def legal_configuration(self, sample=None):
+        """
+        :param sample: check overlaps only for sample random spheres, see Metric.overlaps
+        :return: True if there are no overlapping spheres, all spheres are between the walls and all spheres are in
+        the right cell
+        """
+        c, rad = self.centers, self.rad
+        if np.any(c[:, 2] - rad < -epsilon) or np.any(c[:, 2] + rad > self.l_z + epsilon):
+            return False
+        assert np.all(self.sphere_cell == self.cells_ind(c)), "sphere is missing from cell"
+        pairs, _ = Metric.overlaps(c, rad, self.boundaries, sample=sample)
+        return len(pairs) == 0
+
+    def resample_z(self, sphere, rng=random):
+        """
+        Same as Event2DCells.resample_z, for sphere id
+        """
+        k = self.sphere_cell[sphere]
+        cells = self.stencils[2][k]
+        others = self.cell_spheres[cells].ravel()
+        valid = others >= 0
+        centers = self.centers[others[valid]]
+        # the images of the ghost cells of Event2DCells, the spheres of a cell fill its first slots
+        centers[:, :2] += np.repeat(self.stencil_wraps[2][k] * (self.l_x, self.l_y), self.cell_count[cells], axis=0)
+        intervals = Metric.allowed_z_intervals(self.centers[sphere], self.rad, centers[others[valid] != sphere],
+                                               self.l_z)
+        if len(intervals) > 0:
+            self.centers[sphere, 2] = Metric.uniform_in_intervals(intervals, rng.random())
+        return float(self.centers[sphere, 2])
+
+    def scale_xy(self, factor):
+        """
+        Same as Event2DCells.scale_xy
+        :param factor: factor>1 means bigger simulation and cells
+        """
+        self.edge *= factor
+        self.edge_y *= factor
+        self.l_x *= factor
+        self.l_y *= factor
+        self.boundaries[0] *= factor
+        self.boundaries[1] *= factor
+        self.centers[:, :2] *= factor
+        self.rebin()
+        assert self.legal_configuration(), "Scaling failed, illegal configuration"
+
+    def scale_z(self, factor):
+        """
+        Same as Event2DCells.scale_z
+        """
+        self.centers[:, 2] = self.rad + factor * (self.centers[:, 2] - self.rad)
+        self.l_z = 2 * self.rad + factor * (self.l_z - 2 * self.rad)
+        self.boundaries[2] = self.l_z
+        assert self.legal_configuration(), "Scaling failed, illegal configuration"
+
+    def regrid(self, n_rows, n_columns):
+        """
+        Same as Event2DCells.regrid
+        """
+        assert min(self.l_x / n_columns, self.l_y / n_rows) > 2 * self.rad, "Cells should be wider than a sphere"
+        self.n_rows, self.n_columns, self.edge, self.edge_y = n_rows, n_columns, self.l_x / n_columns, self.l_y / n_rows
+        self.cell_spheres = np.full((n_rows * n_columns, self.cell_spheres.shape[1]), -1, dtype=np.int64)
+        self.cell_count = np.zeros(n_rows * n_columns, dtype=np.int64)
+        self.stencils = ArrayOfCells.direction_stencils(n_rows, n_columns)
+        self.stencil_wraps = ArrayOfCells.direction_stencil_wraps(n_rows, n_columns)
+        self.rebin()
+
+
+class ECMCEngine:
+
+    def __init__(self, arr, xy_total_step, z_total_step, telemetry=None, pressure=None, heat_bath_ratio=0.0):
+        """
+        Runs batches of event chains on arr with no I/O, for drivers such as run_sim, run_ensemble, compress and
+        analyze_efficiency to compose. Every chain starts from a uniformly random sphere in one of the directions x, y,
+        +z and -z, as the main loop of run_sim always did.
+        :type arr: Event2DCells or ArrayEvent2DCells
+        :param xy_total_step: total step of the x and y chains
+        :param z_total_step: total step of the +z and -z chains
+        :param telemetry: Telemetry counting the events, candidates and times of every chain, None for no telemetry
+        :param pressure: PressureEstimator counting every chain, None for no estimate
+        :param heat_bath_ratio: heat bath z moves of random spheres per chain, see resample_z. They are interleaved
+        with the chains of run, one after every 1/heat_bath_ratio chains (or heat_bath_ratio after every chain), and
+        are not counted as chains. 0 for ECMC chains only.
+        """
+        self.arr = arr
+        self.is_array = isinstance(arr, ArrayEvent2DCells)
+        self.total_steps = [xy_total_step, xy_total_step, z_total_step, z_total_step]  # x,y,+z,-z
+        self.telemetry = telemetry
+        self.pressure = pressure
+        self.step = Step(None, 0.0, Direction.directions()[0], arr.boundaries)  # reset for every chain
+        self.chains = 0  # chains performed so far
+        self.events = 0  # events of these chains, the displacements of run_sim
+        self.heat_bath_ratio = heat_bath_ratio
+        self.heat_bath_moves = 0
+        self.volume_moves, self.accepted_volume_moves = 0, 0
+        self._heat_bath_due = 0.0  # heat bath moves owed to the chains performed so far
+
+    @staticmethod
+    def default_total_steps(N, h, rho_H, rad=1):
+        """
+        :return: xy_total_step and z_total_step of run_sim when they are not tuned
+        """
+        a_free = (1 / rho_H - np.pi / 6) ** (1 / 3) * 2 * rad  # ((V-N*4/3*pi*r^3)/N)^(1/3)
+        return a_free * np.sqrt(N), h * (2 * rad) * np.pi / 15  # irrational for the spheres to cover most of z
+
+    @staticmethod
+    def default_max_log_change(N, beta_p, rho_H):
+        """
+        Initial max_log_change of volume_move, sized so about a third of the expansions are accepted: the log acceptance
+        of an expansion d is -(betaP*V/sig^3-N-1)*d with V/sig^3=N/rhoH. At most 1/sqrt(N), the scale of the
+        fluctuations of ln(V), for pressures close to the ideal gas.
+        """
+        return min(1 / np.sqrt(N), 3 / max(abs(beta_p * N / rho_H - N - 1), 1))
+
+    @property
+    def n_spheres(self):
+        return self.arr.n_spheres if self.is_array else len(self.arr.all_spheres)
+
+    def chain(self, sphere, d, total_step=None):
+        """
+        Perform a single chain
+        :param sphere: index of the sphere, its id for ArrayEvent2DCells and its position in all_spheres for
+        Event2DCells
+        :param d: index of the direction in Direction.directions(), 0,1,2,3 for x,y,+z,-z
+        :param total_step: total step of the chain, default total_steps[d]
+        :return: number of events of the chain
+        """
+        arr, step = self.arr, self.step
+        if self.is_array:
+            i_cell, j_cell = arr.cell_of_sphere(sphere)
+        else:
+            sphere = arr.all_spheres[sphere]
+            i_cell, j_cell = arr.cell_of_sphere(sphere).ind[:2]
+        total_step = self.total_steps[d] if total_step is None else total_step
+        step.reset(sphere, total_step, Direction.directions()[d], arr.boundaries)
+        if self.telemetry is None:
+            events = arr.perform_total_step(i_cell, j_cell, step, record_displacements=True)
+        else:
+            chain_time = time.perf_counter()
+            events = arr.perform_total_step(i_cell, j_cell, step, record_displacements=True, telemetry=self.telemetry)
+            self.telemetry.chain(events, time.perf_counter() - chain_time)
+        if self.pressure is not None:
+            self.pressure.chain(step, total_step)
+        self.chains += 1
+        self.events += events
+        return events
+
+    def resample_z(self, sphere, rng=random):
+        """
+        Heat bath move in z of a single sphere, see Event2DCells.resample_z
+        :param sphere: index of the sphere, as in chain
+        :return: the new height of the sphere
+        """
+        self.heat_bath_moves += 1
+        return self.arr.resample_z(sphere if self.is_array else self.arr.all_spheres[sphere], rng)
+
+    def volume_move(self, beta_p, max_log_change, rng=random):
+        """
+        Box rescale move of the NPT ensemble at fixed l_z: scale x and y of the box and of all the centers by
+        f=exp(d/2), with d uniform in [-max_log_change, max_log_change] so ln(V) changes by d. It is accepted with
+        probability min(1, exp(-betaP*dV+(N+1)*d)) if no spheres overlap after it, which for expansions always holds.
+        Cells are merged with fit_cells_to_scale if they would become narrower than a sphere.
+        :param beta_p: target pressure in units of kT/sig^3, as in PressureEstimator
+        :param rng: the random module, a random.Random or a np.random.Generator
+        :return: True if the move was accepted
+        """
+        arr = self.arr
+        rad = arr.rad if self.is_array else arr.all_spheres[0].rad
+        sig = 2 * rad
+        self.volume_moves += 1
+        d = (2 * rng.random() - 1) * max_log_change
+        log_acceptance = self.volume_log_acceptance(beta_p, d)
+        if log_acceptance < 0 and rng.random() >= np.exp(log_acceptance):
+            return False
+        factor = float(np.exp(d / 2))
+        if factor < 1:
+            # pairs closer in xy than sig/factor would overlap, see Metric.compression_factors
+            pairs, _, _ = Metric.compression_factors(arr.all_centers, rad, arr.boundaries, xy=True, min_factor=factor)
+            if len(pairs) > 0 or factor < fit_cells_to_scale(arr, factor, sig):
+                return False
+        arr.scale_xy(factor)
+        self.accepted_volume_moves += 1
+        return True
+
+    def volume_log_acceptance(self, beta_p, d):
+        """
+        Log of the acceptance of volume_move changing ln(V) by d, before the overlap check. The move back from the new
+        box, by -d, has the opposite log acceptance, which is detailed balance for the symmetric proposal of d.
+        """
+        rad = self.arr.rad if self.is_array else self.arr.all_spheres[0].rad
+        volume = self.arr.l_x * self.arr.l_y * self.arr.l_z
+        return -beta_p / (2 * rad) ** 3 * volume * np.expm1(d) + (self.n_spheres + 1) * d
+
+    def _heat_bath(self, rng):
+        self._heat_bath_due += self.heat_bath_ratio
+        while self._heat_bath_due >= 1:
+            self._heat_bath_due -= 1
+            if isinstance(rng, np.random.Generator):
+                self.resample_z(int(rng.integers(0, self.n_spheres)), rng)
+            else:
+                self.resample_z(rng.randint(0, self.n_spheres - 1), rng)
+
+    def run(self, n_chains, rng=random, directions=(0, 1, 2, 3)):
+        """
+        Perform n_chains chains of random spheres and directions. On ArrayEvent2DCells with the compiled kernel, and
+        without telemetry, pressure or heat bath which need every chain, the whole batch runs in
+        EventChainKernel.chains.
+        :param rng: the random module or a random.Random draw the sphere and then the direction of every chain with
+        randint, the draws of run_sim which are saved in its checkpoints. A np.random.Generator draws all the spheres
+        and then all the directions with integers, as run_ensemble.
+        :param directions: indices in Direction.directions() to draw the directions from
+        :return: number of events of the chains
+        """
+        n_spheres, events, heat_bath = self.n_spheres, 0, self.heat_bath_ratio > 0
+        if isinstance(rng, np.random.Generator):
+            spheres = rng.integers(0, n_spheres, size=n_chains).tolist()
+            ds = [directions[d] for d in rng.integers(0, len(directions), size=n_chains).tolist()]
+        elif heat_bath:  # the heat bath draws come between the draws of the chains
+            for _ in range(n_chains):
+                sphere = rng.randint(0, n_spheres - 1)
+                events += self.chain(sphere, directions[rng.randint(0, len(directions) - 1)])
+                self._heat_bath(rng)
+            return events
+        else:
+            spheres, ds = [], []
+            for _ in range(n_chains):
+                spheres.append(rng.randint(0, n_spheres - 1))
+                ds.append(directions[rng.randint(0, len(directions) - 1)])
+        if self.is_array and self.arr.jit and not heat_bath and self.telemetry is None and self.pressure is None:
+            events = EventChainKernel.run_chains(self.arr, spheres, [Direction.directions()[d] for d in ds],
+                                                 [self.total_steps[d] for d in ds])
+            self.chains += n_chains
+            self.events += events
+            return events
+        for sphere, d in zip(spheres, ds):
+            events += self.chain(sphere, d)
+            if heat_bath:
+                self._heat_bath(rng)
+        return events
+
+    def sweep(self, rng=random):
+        """
+        Perform a sweep, N chains, see run
+        :return: number of events of the chains
+        """
+        return self.run(self.n_spheres, rng)
+
+
+def fit_cells_to_scale(arr, factor, sig):
+    """
+    Merge the cells of arr with regrid, rows and columns independently, into the finest grid whose cells stay wider
+    than a sphere after scale_xy(factor). Nothing is changed if the cells of arr already do.
+    :type arr: Event2DCells or ArrayEvent2DCells
+    :return: the smallest factor arr can be scaled by with its grid
+    """
+    edge_factor = (sig + 100 * epsilon) / min(arr.edge, arr.edge_y)  # cells should stay wider than a sphere
+    if factor < edge_factor:
+        n_rows = max(1, min(arr.n_rows, int(arr.l_y * factor / (sig + 100 * epsilon))))
+        n_columns = max(1, min(arr.n_columns, int(arr.l_x * factor / (sig + 100 * epsilon))))
+        if (n_rows, n_columns) != (arr.n_rows, arr.n_columns):
+            arr.regrid(n_rows, n_columns)
+            edge_factor = (sig + 100 * epsilon) / min(arr.edge, arr.edge_y)
+    return edge_factor
+
+
+def compress(arr, desired_rho=None, desired_lz=None, sweep_chains=None, xy_total_step=None, z_total_step=None,
+             blocking_pairs=None, min_factor=0.9, max_seconds=3600, log=None):
+    """
+    Compress arr to density desired_rho and height desired_lz. Every cycle runs sweep_chains ECMC chains, and then
+    rescales z (l_z-2*rad) and xy (l_x and l_y) by the smallest legal factors from Metric.compression_factors, but not
+    below what is needed to reach the targets. The spheres of the blocking_pairs pairs which limited the rescale are
+    then pushed apart by short chains. The cells are merged with regrid when they are about to become smaller than a
+    sphere diameter.
+    :type arr: Event2DCells or ArrayEvent2DCells
+    :param desired_rho: target N*sig^3/(l_x*l_y*l_z), None to keep l_x and l_y
+    :param desired_lz: target distance between the walls, None to keep l_z
+    :param sweep_chains: random chains every cycle, default N/10
+    :param xy_total_step: total step of the random x and y chains, default a sphere diameter
+    :param z_total_step: total step of the random z chains, default as in run_sim for the current height
+    :param blocking_pairs: number of pairs pushed apart after every rescale, default N/20
+    :param min_factor: smallest factor of a single rescale
+    :param max_seconds: stop after max_seconds even if the targets were not reached, None for no limit
+    :param log: file to print a line per cycle to, None for no log
+    :return: True if the targets were reached
+    """
+    is_array = isinstance(arr, ArrayEvent2DCells)
+    if not is_array:
+        arr.update_all_spheres()
+    rad = arr.rad if is_array else arr.all_spheres[0].rad
+    sig = 2 * rad
+    N = len(arr.all_centers)
+    sweep_chains = max(N // 10, 1) if sweep_chains is None else sweep_chains
+    blocking_pairs = max(N // 20, 1) if blocking_pairs is None else blocking_pairs
+    xy_total_step = sig if xy_total_step is None else xy_total_step
+
+    engine = ECMCEngine(arr, xy_total_step, z_total_step)
+
+    initial_time = time.time()
+    cycle = 0
+    while True:
+        rho = N * sig ** 3 / (arr.l_x * arr.l_y * arr.l_z)
+        lz_reached = desired_lz is None or arr.l_z <= desired_lz * (1 + epsilon)
+        # lowering the walls also raises the density, so the xy target is the area at the desired height
+        l_z_final = arr.l_z if desired_lz is None else desired_lz
+        area_target = None if desired_rho is None else N * sig ** 3 / (desired_rho * l_z_final)
+        rho_reached = area_target is None or arr.l_x * arr.l_y <= area_target * (1 + epsilon)
+        if lz_reached and rho_reached:
+            return True
+        if max_seconds is not None and time.time() - initial_time > max_seconds:
+            if log is not None:
+                print("compress stopped after " + str(cycle) + " cycles, rho_H=" + str(rho) + ", l_z=" + str(
+                    arr.l_z), file=log, flush=True)
+            return False
+        if z_total_step is None:
+            engine.total_steps[2:] = [max(arr.l_z / sig - 1, epsilon) * sig * np.pi / 15] * 2
+        engine.run(sweep_chains)
+        z_factor, xy_factor = 1.0, 1.0
+        if not lz_reached:
+            pairs, dr, factors = Metric.compression_factors(arr.all_centers, rad, arr.boundaries, xy=False,
+                                                            min_factor=min_factor)
+            z_factor = max(np.max(factors, initial=min_factor), (desired_lz - sig) / (arr.l_z - sig))
+            if z_factor < 1:
+                arr.scale_z(z_factor)
+            for k in np.argsort(-factors)[:blocking_pairs]:
+                upper, lower = pairs[k] if dr[k, 2] < 0 else pairs[k][::-1]
+                engine.chain(upper, 2, rad / 2)
+                engine.chain(lower, 3, rad / 2)
+        if not rho_reached:
+            pairs, dr, factors = Metric.compression_factors(arr.all_centers, rad, arr.boundaries, xy=True,
+                                                            min_factor=min_factor)
+            xy_factor = max(np.max(factors, initial=min_factor), np.sqrt(area_target / (arr.l_x * arr.l_y)))
+            xy_factor = max(xy_factor, fit_cells_to_scale(arr, xy_factor, sig))
+            if xy_factor < 1:
+                arr.scale_xy(xy_factor)
+            for k in np.argsort(-factors)[:blocking_pairs]:
+                dim = int(np.argmax(np.abs(dr[k, :2])))
+                # only positive xy steps are supported, so the sphere ahead moves away
+                engine.chain(pairs[k][1] if dr[k, dim] > 0 else pairs[k][0], dim, rad / 2)
+        cycle += 1
+        if log is not None:
+            print("compress cycle " + str(cycle) + ": rho_H=" + str(N * sig ** 3 / (arr.l_x * arr.l_y * arr.l_z)) +
+                  ", l_z=" + str(arr.l_z) + ", xy_factor=" + str(xy_factor) + ", z_factor=" + str(z_factor) +
+                  ", cells=" + str(arr.n_rows) + "x" + str(arr.n_columns) + ", seconds=" + str(
+                time.time() - initial_time), file=log, flush=True)
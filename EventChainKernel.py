@@ -0,0 +1,310 @@
+import numpy as np
+import warnings
+
+try:
+    from numba import njit
+
+    jit_available = True
+except ImportError:  # numba is optional, without it ArrayEvent2DCells.perform_total_step is used
+    jit_available = False
+
+
+    def njit(*args, **kwargs):
+        if len(args) == 1 and callable(args[0]):
+            return args[0]
+        return lambda f: f
+
+epsilon = 1e-8
+FREE, COLLISION, WALL, PASS = 0, 1, 2, 3
+
+
+@njit(cache=True)
+def _cell_ind(x, y, edge, edge_y, n_rows, n_columns):
+    return (int(np.floor(y / edge_y)) % n_rows) * n_columns + int(np.floor(x / edge)) % n_columns
+
+
+@njit(cache=True)
+def _remove(sphere, cell_spheres, cell_count, sphere_cell, sphere_slot):
+    k, slot = sphere_cell[sphere], sphere_slot[sphere]
+    last = cell_count[k] - 1
+    moved = cell_spheres[k, last]
+    cell_spheres[k, slot] = moved
+    sphere_slot[moved] = slot
+    cell_spheres[k, last] = -1
+    cell_count[k] = last
+
+
+@njit(cache=True)
+def _insert(sphere, k, cell_spheres, cell_count, sphere_cell, sphere_slot):
+    slot = cell_count[k]
+    cell_spheres[k, slot] = sphere
+    cell_count[k] = slot + 1
+    sphere_cell[sphere] = k
+    sphere_slot[sphere] = slot
+
+
+@njit(cache=True)
+def chain(centers, cell_spheres, cell_count, sphere_cell, sphere_slot, stencils, stencil_wraps, owned, sphere, dim,
+          sgn, total_step, l_x, l_y, l_z, edge, edge_y, n_columns, rad, stats):
+    """
+    Run a whole event chain over the array backed state of ArrayEvent2DCells: collision search, lifting, cell transfer
+    and boxing, exactly as ArrayEvent2DCells.perform_total_step. The arrays are updated in place.
+    stencils is the tuple of ArrayOfCells.direction_stencils arrays, of which only the z stencil is used since x and y
+    steps march along the cells as in ArrayOfCells.marching_stencil. The march stops at the first band of cells beyond
+    the closest collision found, so fewer candidates are scanned than in the python implementations, with the same
+    events. edge and edge_y are the x and y edges of the cells.
+    stencil_wraps is the tuple of ArrayOfCells.direction_stencil_wraps arrays. Every candidate is taken at the periodic
+    image of its cell, as the ghost cells of Event2DCells, so the geometry is plain with a single image per candidate.
+    No cell may be full when the kernel is called. The kernel returns as soon as a cell becomes full, also when this is
+    the last event of the chain, so the caller can grow cell_spheres before the next call.
+    x and y steps may also go backwards, sgn=-1, as in the sweeps of ParallelECMC, the python implementations only step
+    forwards in x and y.
+    :param owned: boolean array over the flat cells, spheres in cells that are not owned are frozen: a collision with
+    one of them is a WALL event, the direction is reversed without lifting. All True except in ParallelECMC.
+    :param stats: int64 array of 5 counters, incremented by the number of FREE, COLLISION, WALL and PASS events and of
+    the candidate spheres scanned
+    :return: active sphere, sgn of its direction, total step left (>0 only if interrupted), the number of events, the
+    lift, see Step.lift, and True if a cell is full
+    """
+    n_rows = cell_count.shape[0] // n_columns
+    capacity = cell_spheres.shape[1]
+    sig_sq = (2 * rad) ** 2
+    events = 0
+    lift = 0.0
+    while total_step > 0:
+        k = sphere_cell[sphere]
+        _remove(sphere, cell_spheres, cell_count, sphere_cell, sphere_slot)
+        x1, y1, z1 = centers[sphere, 0], centers[sphere, 1], centers[sphere, 2]
+        i, j = k // n_columns, k % n_columns
+        closest_dist, closest = np.inf, -1
+        if dim == 2:
+            current_step = np.inf
+            if sgn == 1:
+                wall = l_z - z1 - rad - epsilon
+            else:
+                wall = z1 - rad - epsilon
+            if not wall < total_step:
+                wall = np.inf
+            stencil, wraps = stencils[2][k], stencil_wraps[2][k]
+            for c in range(len(stencil)):
+                kc = stencil[c]
+                s_x, s_y = wraps[c, 0] * l_x, wraps[c, 1] * l_y
+                stats[4] += cell_count[kc]
+                for s in range(cell_count[kc]):
+                    other = cell_spheres[kc, s]
+                    dz = (centers[other, 2] - z1) * sgn
+                    if dz <= 0:
+                        continue
+                    dx, dy = (centers[other, 0] + s_x) - x1, (centers[other, 1] + s_y) - y1
+                    discriminant = sig_sq - dy * dy - dx * dx
+                    if discriminant <= 0:
+                        continue
+                    dist = dz - np.sqrt(discriminant)
+                    if dist <= total_step and dist < closest_dist:
+                        closest_dist, closest = dist, other
+        else:
+            wall = np.inf
+            if dim == 0:
+                edge_dim, n_dim, ind, l_dim, l_across = edge, n_columns, j, l_x, l_y
+            else:
+                edge_dim, n_dim, ind, l_dim, l_across = edge_y, n_rows, i, l_y, l_x
+            site = edge_dim * ind
+            pos, across_pos = centers[sphere, dim], centers[sphere, 1 - dim]
+            # same as ArrayOfCells.marching_bands and marching_stencil, back is the distance behind the sphere to the
+            # edge of its cell, so spheres q cells ahead are at least q * edge_dim - back ahead
+            back = pos - site if sgn == 1 else site + edge_dim - pos
+            bands = max(1, min(int(np.ceil((total_step + 2 * rad + back) / edge_dim)) - 1, n_dim - 1))
+            if sgn == 1:
+                current_step = site + (bands + 1) * edge_dim - 2 * rad - pos
+            else:
+                current_step = (bands + 1) * edge_dim - 2 * rad - back
+            stencil, wraps = stencils[dim][k], stencil_wraps[dim][k]  # the first two bands forwards, in the same order
+            for c in range(3 * (bands + 1)):
+                q, a = c // 3, c % 3
+                # spheres q cells ahead are at least this far, so the closest collision found so far is the first one
+                if a == 0 and q > 0:
+                    if sgn == 1:
+                        if closest_dist < site + q * edge_dim - pos - 2 * rad - epsilon:
+                            break
+                    elif closest_dist < q * edge_dim - back - 2 * rad - epsilon:
+                        break
+                if c < 6 and sgn == 1:
+                    kc = stencil[c]
+                    w_dim, w_across = wraps[c, dim], wraps[c, 1 - dim]
+                else:
+                    a = a if a < 2 else -1  # the line of motion and its two neighbors across it
+                    if dim == 0:
+                        kc = ((i + a) % n_rows) * n_columns + (j + sgn * q) % n_columns
+                        w_dim, w_across = (j + sgn * q) // n_columns, (i + a) // n_rows
+                    else:
+                        kc = ((i + sgn * q) % n_rows) * n_columns + (j + a) % n_columns
+                        w_dim, w_across = (i + sgn * q) // n_rows, (j + a) // n_columns
+                s_dim, s_across = w_dim * l_dim, w_across * l_across
+                stats[4] += cell_count[kc]
+                for s in range(cell_count[kc]):
+                    other = cell_spheres[kc, s]
+                    dx = sgn * ((centers[other, dim] + s_dim) - pos)
+                    # dist >= dx - 2 * rad, skip the spheres too far ahead without changing the result
+                    if dx <= 0 or dx - 2 * rad > total_step or dx - 2 * rad >= closest_dist:
+                        continue
+                    dz = centers[other, 2] - z1
+                    sig_xy_sq = sig_sq - dz * dz
+                    if sig_xy_sq <= 0:
+                        continue
+                    dy = (centers[other, 1 - dim] + s_across) - across_pos
+                    discriminant = sig_xy_sq - dy * dy
+                    if discriminant <= 0:
+                        continue
+                    dist = dx - np.sqrt(discriminant)
+                    if dist <= total_step and dist < closest_dist:
+                        closest_dist, closest = dist, other
+        # the first of the smallest of wall, collision, total_step and current_step, as in Step.next_event
+        event, step = WALL, wall
+        if closest_dist < step:
+            event, step = COLLISION, closest_dist
+        if total_step < step:
+            event, step = FREE, total_step
+        if current_step < step:
+            event, step = PASS, current_step
+        if event == COLLISION and not owned[sphere_cell[closest]]:
+            event = WALL
+        if dim == 2:
+            centers[sphere, 2] = (z1 + sgn * step) % l_z
+        elif dim == 0:
+            centers[sphere, 0] = (x1 + sgn * step) % l_x
+        else:
+            centers[sphere, 1] = (y1 + sgn * step) % l_y
+        total_step -= step
+        events += 1
+        stats[event] += 1
+        k_new = _cell_ind(centers[sphere, 0], centers[sphere, 1], edge, edge_y, n_rows, n_columns)
+        _insert(sphere, k_new, cell_spheres, cell_count, sphere_cell, sphere_slot)
+        full = cell_count[k_new] == capacity
+        if event == COLLISION:
+            dx = centers[closest, dim] - centers[sphere, dim]
+            if dim == 2:
+                lift += sgn * dx
+            elif dim == 0:
+                lift += (sgn * dx) % l_x
+            else:
+                lift += (sgn * dx) % l_y
+            sphere = closest
+        elif event == WALL:
+            sgn = -sgn
+        elif event == FREE:
+            return sphere, sgn, 0.0, events, lift, full
+        if full:
+            return sphere, sgn, total_step, events, lift, True
+    return sphere, sgn, total_step, events, lift, False
+
+
+@njit(cache=True)
+def chains(centers, cell_spheres, cell_count, sphere_cell, sphere_slot, stencils, stencil_wraps, owned, spheres, dims,
+           sgns, total_steps, l_x, l_y, l_z, edge, edge_y, n_columns, rad, stats):
+    """
+    Run the chains of spheres[c] in direction dims[c], sgns[c] with total step total_steps[c] one after the other in a
+    single call, each as chain does. Returns early as soon as a cell is full, as chain.
+    :return: number of chains finished, number of events, and the active sphere, sgn and total step left of the next
+    chain if it was interrupted (total step left 0 if it was not), and True if a cell is full
+    """
+    events = 0
+    for c in range(len(spheres)):
+        sphere, sgn, total_step, chain_events, lift, full = chain(centers, cell_spheres, cell_count, sphere_cell,
+                                                                  sphere_slot, stencils, stencil_wraps, owned,
+                                                                  spheres[c], dims[c], sgns[c], total_steps[c], l_x,
+                                                                  l_y, l_z, edge, edge_y, n_columns, rad, stats)
+        events += chain_events
+        if full:
+            if total_step > 0:
+                return c, events, sphere, sgn, total_step, True
+            return c + 1, events, sphere, sgn, 0.0, True
+    return len(spheres), events, -1, 1, 0.0, False
+
+
+def run_chains(arr, spheres, directions, total_steps):
+    """
+    Same as perform_total_step for a whole batch of chains, run in compiled calls of chains instead of one call per
+    chain, so no python code runs between the chains
+    :type arr: ArrayEvent2DCells
+    :param spheres: ids of the first spheres of the chains
+    :param directions: Direction of every chain
+    :param total_steps: total step of every chain
+    :return: number of events of the chains
+    """
+    spheres = np.array(spheres, dtype=np.int64)
+    dims = np.array([d.dim for d in directions], dtype=np.int64)
+    sgns = np.array([d.sgn for d in directions], dtype=np.int64)
+    total_steps = np.array(total_steps, dtype=np.float64)
+    stats = np.zeros(5, dtype=np.int64)
+    owned = np.ones(len(arr.cell_count), dtype=np.bool_)
+    start, events = 0, 0
+    while start < len(spheres):
+        finished, batch_events, sphere, sgn, total_step, full = chains(
+            arr.centers, arr.cell_spheres, arr.cell_count, arr.sphere_cell, arr.sphere_slot, tuple(arr.stencils),
+            tuple(arr.stencil_wraps), owned, spheres[start:], dims[start:], sgns[start:], total_steps[start:],
+            float(arr.l_x), float(arr.l_y), float(arr.l_z), float(arr.edge), float(arr.edge_y), arr.n_columns,
+            float(arr.rad), stats)
+        events += batch_events
+        start += finished
+        if full:
+            arr._grow()
+        if total_step > 0:  # continue the interrupted chain from where it stopped
+            spheres[start], sgns[start], total_steps[start] = sphere, sgn, total_step
+    return events
+
+
+def perform_total_step(arr, step, record_displacements=False, telemetry=None):
+    """
+    Same as ArrayEvent2DCells.perform_total_step, running the chain in the compiled kernel. Without numba the kernel is
+    interpreted, which is much slower than ArrayEvent2DCells.perform_total_step, so select_backend never falls back to
+    it.
+    :type arr: ArrayEvent2DCells
+    :type step: Step
+    :type telemetry: Telemetry
+    """
+    displacements = 0
+    stats = np.zeros(5, dtype=np.int64)
+    owned = np.ones(len(arr.cell_count), dtype=np.bool_)
+    while step.total_step > 0:
+        sphere, sgn, total_step, events, lift, full = chain(arr.centers, arr.cell_spheres, arr.cell_count,
+                                                            arr.sphere_cell, arr.sphere_slot, tuple(arr.stencils),
+                                                            tuple(arr.stencil_wraps), owned, int(step.sphere),
+                                                            step.direction.dim, step.direction.sgn,
+                                                            float(step.total_step), float(arr.l_x), float(arr.l_y),
+                                                            float(arr.l_z), float(arr.edge), float(arr.edge_y),
+                                                            arr.n_columns, float(arr.rad), stats)
+        step.sphere, step.total_step = sphere, total_step
+        if sgn != step.direction.sgn:
+            step.direction = step.direction.opposite()
+        step.lift += lift
+        displacements += events
+        if full:  # interrupted, or ended, with a full cell
+            arr._grow()
+    step.wall_events += int(stats[WALL])
+    if telemetry is not None:
+        telemetry.kernel_events(stats)
+    if record_displacements:
+        return displacements
+
+
+def select_backend(backend, array=False):
+    """
+    :param backend: 'python' for Event2DCells, 'array' for ArrayEvent2DCells or 'numba' for ArrayEvent2DCells with the
+    compiled kernel
+    :param array: the caller runs only on ArrayEvent2DCells, as ensembles and parallel sweeps do, so 'python' means
+    'array'
+    :return: the backend actually used. Without numba, 'numba' falls back to 'python', since the interpreted
+    ArrayEvent2DCells.perform_total_step is slower than Event2DCells, or to 'array' if array is True.
+    """
+    if backend not in ['python', 'array', 'numba']:
+        raise ValueError("backend should be one of python, array, numba. Got: " + str(backend))
+    if array and backend == 'python':
+        backend = 'array'
+    if backend == 'numba' and not jit_available:
+        if array:
+            warnings.warn("numba is not installed, falling back to the interpreted ArrayEvent2DCells, which is slower "
+                          "than the compiled kernel")
+            return 'array'
+        warnings.warn("numba is not installed, falling back to the python backend (Event2DCells)")
+        return 'python'
+    return backend
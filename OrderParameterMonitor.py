@@ -0,0 +1,99 @@
+import os
+
+from EventChainActions import *
+from Profiling import profiled_region
+
+
+class OrderParameterMonitor:
+
+    def __init__(self, output_dir, N, neighbor_cutoff=None):
+        """
+        Lightweight order parameters of a running simulation, computed from the cell lists and appended as one line
+        per measurement to output_dir/monitors:
+        m_stag: global staggered z-magnetization |sum_k s_k exp(i q.r_k)|/N, with the spins s=(z-lz/2)/(lz/2-rad) as
+        in MagneticTopologicalCorr and q the ordering wave vector of the AF square lattice of sqrt(N)xsqrt(N) spheres
+        af_fraction: fraction of the neighbor pairs which are on opposite sides of the middle of the slab
+        psi_4, psi_6: |mean_k psi_n(k)| with psi_n(k) the mean of exp(i n theta) over the xy bonds of sphere k
+        Neighbors are spheres in the 9 cells around the sphere with xy distance smaller than neighbor_cutoff.
+        :param output_dir: simulation folder, None to only return the measurements
+        :param N: number of spheres
+        :param neighbor_cutoff: xy distance of neighbors, default 1.2 lattice constants which is between the first and
+        second shells of the square lattice. Should not be larger than the edge of the cells.
+        """
+        self.path = os.path.join(output_dir, 'monitors') if output_dir is not None else None
+        self.N = N
+        self.neighbor_cutoff = neighbor_cutoff
+        if self.path is not None and not os.path.exists(self.path):
+            with open(self.path, 'w') as f:
+                f.write('# iteration m_stag af_fraction psi_4 psi_6\n')
+
+    @staticmethod
+    def cell_lists(arr):
+        """
+        :type arr: Event2DCells or ArrayEvent2DCells
+        :return: (N,3) centers, flat cell of every sphere and (n_cells, capacity) spheres of every cell padded with -1
+        """
+        if isinstance(arr, ArrayEvent2DCells):
+            return arr.centers, arr.sphere_cell, arr.cell_spheres
+        centers = np.array(arr.all_centers, dtype=float)
+        sphere_cell = (np.floor(centers[:, 1] / arr.edge_y).astype(int) % arr.n_rows) * arr.n_columns + np.floor(
+            centers[:, 0] / arr.edge).astype(int) % arr.n_columns
+        order = np.argsort(sphere_cell, kind='stable')
+        count = np.bincount(sphere_cell, minlength=arr.n_rows * arr.n_columns)
+        first = np.cumsum(count) - count
+        cell_spheres = np.full((len(count), max(count.max(), 1)), -1, dtype=int)
+        cell_spheres[sphere_cell[order], np.arange(len(order)) - first[sphere_cell[order]]] = order
+        return centers, sphere_cell, cell_spheres
+
+    def neighbor_bonds(self, arr):
+        """
+        :return: (i, j, dx, dy) of all the ordered neighbor pairs, j is a neighbor of i at xy distance (dx, dy)
+        """
+        centers, sphere_cell, cell_spheres = OrderParameterMonitor.cell_lists(arr)
+        l_x, l_y = arr.boundaries[:2]
+        cutoff = self.neighbor_cutoff
+        if cutoff is None:
+            cutoff = 1.2 * np.sqrt(l_x * l_y / len(centers))
+        cutoff = min(cutoff, arr.edge, arr.edge_y)
+        stencil = ArrayOfCells.direction_stencils(arr.n_rows, arr.n_columns)[2]  # the cell and its 8 neighbors
+        candidates = cell_spheres[stencil[sphere_cell]].reshape((len(centers), -1))
+        i = np.repeat(np.arange(len(centers)), candidates.shape[1])
+        j = candidates.ravel()
+        valid = (j >= 0) & (j != i)
+        i, j = i[valid], j[valid]
+        l = np.array([l_x, l_y])
+        dxy = (centers[j, :2] - centers[i, :2] + l / 2) % l - l / 2  # shortest path through cyclic boundaries
+        near = dxy[:, 0] ** 2 + dxy[:, 1] ** 2 < cutoff ** 2
+        return i[near], j[near], dxy[near, 0], dxy[near, 1]
+
+    @profiled_region('monitors')
+    def measure(self, arr, iteration=None):
+        """
+        Calculate the order parameters of arr, and append them to the log if iteration is given
+        :type arr: Event2DCells or ArrayEvent2DCells
+        :return: dict of the order parameters
+        """
+        centers = np.array(arr.all_centers, dtype=float)
+        rad = arr.rad if isinstance(arr, ArrayEvent2DCells) else arr.all_spheres[0].rad
+        l_x, l_y, l_z = arr.boundaries
+        spins = (centers[:, 2] - l_z / 2) / (l_z / 2 - rad)
+        n_side = np.sqrt(self.N)
+        q = np.pi * n_side * np.array([1 / l_x, 1 / l_y])
+        m_stag = np.abs(np.sum(spins * np.exp(1j * centers[:, :2] @ q))) / len(centers)
+        i, j, dx, dy = self.neighbor_bonds(arr)
+        up = spins > 0
+        af_fraction = np.mean(up[i] != up[j]) if len(i) > 0 else np.nan
+        theta = np.arctan2(dy, dx)
+        n_bonds = np.bincount(i, minlength=len(centers))
+        has_bonds = n_bonds > 0
+        result = {'m_stag': float(m_stag), 'af_fraction': float(af_fraction)}
+        for n in [4, 6]:
+            psi_k = np.bincount(i, weights=np.cos(n * theta), minlength=len(centers)) + 1j * np.bincount(
+                i, weights=np.sin(n * theta), minlength=len(centers))
+            psi_k = psi_k[has_bonds] / n_bonds[has_bonds]
+            result['psi_' + str(n)] = float(np.abs(np.mean(psi_k))) if len(psi_k) > 0 else np.nan
+        if self.path is not None and iteration is not None:
+            with open(self.path, 'a') as f:
+                f.write(str(iteration) + ' ' + ' '.join(
+                    str(result[k]) for k in ['m_stag', 'af_fraction', 'psi_4', 'psi_6']) + '\n')
+        return result
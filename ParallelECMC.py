@@ -0,0 +1,149 @@
+import multiprocessing as mp
+from multiprocessing import shared_memory
+
+from EventChainActions import *
+import EventChainKernel
+
+_shared_names = ['centers', 'cell_spheres', 'cell_count', 'sphere_cell', 'sphere_slot']
+_worker_arr = None  # the ArrayEvent2DCells view on shared memory, one per worker process
+_worker_blocks = []
+
+
+def _attach(arr, buffers):
+    """
+    Point the arrays of arr to the shared memory blocks
+    :type arr: ArrayEvent2DCells
+    :param buffers: dict from array name to (SharedMemory name, shape, dtype)
+    :return: the SharedMemory objects, which must be kept alive as long as arr is used
+    """
+    blocks = []
+    for name, (shm_name, shape, dtype) in buffers.items():
+        shm = shared_memory.SharedMemory(name=shm_name)
+        setattr(arr, name, np.ndarray(shape, dtype=dtype, buffer=shm.buf))
+        blocks.append(shm)
+    return blocks
+
+
+def _init_worker(arr, buffers):
+    global _worker_arr, _worker_blocks
+    _worker_arr = arr
+    _worker_blocks = _attach(arr, buffers)
+
+
+def _sweep(task):
+    """
+    Perform n_chains chains of spheres inside the owned lines of cells of one domain, in the compiled kernel with the
+    spheres of the other cells frozen, see EventChainKernel.chain
+    :param task: (axis, owned lines, n_chains, xy and z total steps, seed)
+    :return: number of events
+    """
+    axis, lines, n_chains, (xy_total_step, z_total_step), seed = task
+    arr = _worker_arr
+    rng = np.random.default_rng(seed)
+    cell_lines = np.arange(arr.n_rows * arr.n_columns)
+    cell_lines = cell_lines // arr.n_columns if axis == 0 else cell_lines % arr.n_columns
+    owned = np.isin(cell_lines, lines)
+    # spheres never leave their line of cells, so the owned spheres are the same during the whole sweep
+    owned_spheres = np.nonzero(owned[arr.sphere_cell])[0]
+    if len(owned_spheres) == 0:
+        return 0
+    spheres = rng.choice(owned_spheres, size=n_chains)
+    d = rng.integers(0, 4, size=n_chains)  # +axis, -axis, +z, -z
+    dims = np.array([axis, axis, 2, 2], dtype=np.int64)[d]
+    sgns = np.array([1, -1, 1, -1], dtype=np.int64)[d]
+    total_steps = np.array([xy_total_step, xy_total_step, z_total_step, z_total_step])[d]
+    stats = np.zeros(5, dtype=np.int64)
+    finished, events, _, _, _, full = EventChainKernel.chains(
+        arr.centers, arr.cell_spheres, arr.cell_count, arr.sphere_cell, arr.sphere_slot, tuple(arr.stencils),
+        tuple(arr.stencil_wraps), owned, spheres, dims, sgns, total_steps, float(arr.l_x), float(arr.l_y),
+        float(arr.l_z), float(arr.edge), float(arr.edge_y), arr.n_columns, float(arr.rad), stats)
+    assert not full, "A cell is full, the shared cells can not grow"
+    return events
+
+
+class ParallelECMC:
+
+    def __init__(self, arr: ArrayEvent2DCells, n_workers, xy_total_step, z_total_step, seed=None):
+        """
+        Domain decomposed ECMC over n_workers processes sharing the state of arr, running the compiled kernel.
+        Every sweep splits the cells into n_workers strips, of rows for sweeps of x chains or of columns for sweeps of
+        y chains, z chains are mixed into both. The last line of cells of every strip is a frozen halo separating the
+        domains. x chains never move a sphere out of its row and z chains never move a sphere out of its cell, so the
+        spheres of a domain stay in it. A collision with a frozen sphere is a lift-free wall, as the z walls: the chain
+        goes on in the reversed direction, see EventChainKernel.chain.
+        Stationarity: the axis and the random offset of the strips are drawn independently of the configuration, and
+        given the strips the frozen spheres are fixed hard obstacles, so it is enough that every domain leaves the
+        uniform measure of its own spheres invariant. Its chains are drawn with a uniform owned sphere and with +d and
+        -d equally likely with the same total step, d the axis or z. A chain moves the spheres by translations, so it
+        preserves the volume, and it is undone by the chain of its last active sphere in the reversed direction with the
+        same total step, also through the reflections off walls and frozen spheres. The chains of a domain thus satisfy
+        detailed balance, as the +-x chains of Bernard, Krauth and Wilson, and no chain is ever rejected. The domains
+        move disjoint spheres and only read the frozen spheres, so they run concurrently.
+        The state of arr is moved to shared memory until close is called.
+        :type arr: ArrayEvent2DCells
+        :param n_workers: number of processes, every strip should be at least 3 lines of cells
+        :param xy_total_step: total step of x and y chains
+        :param z_total_step: total step of z chains
+        :param seed: seed of rng, from which the workers are seeded every sweep, None for fresh entropy
+        """
+        if not EventChainKernel.jit_available:
+            raise ValueError("ParallelECMC runs the compiled kernel, which requires numba")
+        assert min(arr.n_rows, arr.n_columns) >= 3 * n_workers, "Too many workers for " + str(
+            arr.n_rows) + "x" + str(arr.n_columns) + " cells, every domain should be at least 3 lines of cells"
+        self.arr = arr
+        self.n_workers = n_workers
+        self.total_steps = (xy_total_step, z_total_step)
+        self.rng = np.random.default_rng(seed)  # its bit_generator.state is saved in checkpoints
+        self.events = 0
+        # a cell can not hold more spheres than fit in its volume, so cells never need to grow in the workers
+        sig = 2 * arr.rad
+        max_in_cell = int(np.ceil((arr.edge + sig) * (arr.edge_y + sig) * arr.l_z / (np.pi / 6 * sig ** 3)))
+        while arr.cell_spheres.shape[1] <= max_in_cell:
+            arr._grow()
+        self.blocks, buffers = [], {}
+        for name in _shared_names:
+            a = getattr(arr, name)
+            shm = shared_memory.SharedMemory(create=True, size=max(a.nbytes, 1))
+            shared = np.ndarray(a.shape, dtype=a.dtype, buffer=shm.buf)
+            shared[...] = a
+            setattr(arr, name, shared)
+            self.blocks.append(shm)
+            buffers[name] = (shm.name, a.shape, a.dtype)
+        self.pool = mp.Pool(n_workers, initializer=_init_worker, initargs=(arr, buffers))
+
+    def sweep(self, n_chains):
+        """
+        Perform n_chains chains, divided between the domains
+        :return: number of events
+        """
+        axis = int(self.rng.integers(0, 2))  # 0: strips of rows for x chains, 1: strips of columns for y chains
+        n_lines = self.arr.n_rows if axis == 0 else self.arr.n_columns
+        offset = int(self.rng.integers(0, n_lines))
+        bounds = np.linspace(0, n_lines, self.n_workers + 1).astype(int)
+        seeds = self.rng.integers(0, 2 ** 63, size=self.n_workers)
+        tasks = []
+        for w in range(self.n_workers):
+            lines = (np.arange(bounds[w], bounds[w + 1] - 1) + offset) % n_lines  # last line is the frozen halo
+            n_w = n_chains // self.n_workers + (1 if w < n_chains % self.n_workers else 0)
+            tasks.append((axis, lines, n_w, self.total_steps, int(seeds[w])))
+        events = sum(self.pool.map(_sweep, tasks))
+        self.events += events
+        return events
+
+    def close(self):
+        """
+        Stop the workers and move the state of arr back from shared memory
+        """
+        self.pool.close()
+        self.pool.join()
+        for name, shm in zip(_shared_names, self.blocks):
+            setattr(self.arr, name, np.array(getattr(self.arr, name)))
+            shm.close()
+            shm.unlink()
+        self.blocks = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
@@ -0,0 +1,109 @@
+import os
+
+from EventChainActions import *
+
+
+class PressureEstimator:
+    columns = ['iteration', 'chains', 'rho_H', 'betaP_xy', 'betaP_zz', 'xy_displacement', 'xy_lift', 'z_displacement',
+               'wall_events']
+
+    def __init__(self, output_dir, N, block_chains):
+        """
+        Equation of state from the chains of run_sim, written as one line per block of block_chains chains to
+        output_dir/pressure. Pressures are in units of kT/sig^3, with the volume l_x*l_y*l_z of rhoH.
+        betaP_xy: from the lifts of the x and y chains, betaP=rho*(1+sum(lift)/sum(displacement)), where every chain
+        is displaced total_step in all and lift is the distance along the chain from the sphere which stopped to the
+        sphere it lifted to, see Step.lift
+        betaP_zz: from the wall events of the z chains, which is the contact theorem, betaP=(N/(l_x*l_y))*wall
+        events/sum(displacement)
+        :param output_dir: simulation folder, None to only accumulate the blocks in memory
+        :param N: number of spheres
+        :param block_chains: chains in a block, the error bars are the standard errors of the means of the blocks so
+        blocks should be longer than the correlation time of the pressure
+        """
+        self.path = os.path.join(output_dir, 'pressure') if output_dir is not None else None
+        self.N = N
+        self.block_chains = block_chains
+        self.blocks = []
+        self.reset()
+        if self.path is not None and not os.path.exists(self.path):
+            with open(self.path, 'w') as f:
+                f.write('# ' + ' '.join(PressureEstimator.columns) + '\n')
+
+    def reset(self):
+        self.chains = 0
+        self.xy_displacement, self.xy_lift = 0.0, 0.0
+        self.z_displacement, self.wall_events = 0.0, 0
+
+    def chain(self, step, total_step):
+        """
+        Count a chain after perform_total_step finished it
+        :type step: Step
+        :param total_step: the total step the chain started with
+        """
+        self.chains += 1
+        if step.direction.dim == 2:
+            self.z_displacement += total_step
+            self.wall_events += step.wall_events
+        else:
+            self.xy_displacement += total_step
+            self.xy_lift += step.lift
+
+    def block_done(self):
+        return self.chains >= self.block_chains
+
+    def flush(self, arr, iteration=None):
+        """
+        Close the current block, append it to the file if iteration is given and reset the counters
+        :type arr: Event2DCells or ArrayEvent2DCells
+        :return: dict of the block, see columns
+        """
+        l_x, l_y, l_z = arr.boundaries
+        rho = self.N / (l_x * l_y * l_z)
+        rad = arr.rad if isinstance(arr, ArrayEvent2DCells) else arr.all_spheres[0].rad
+        sig = 2 * rad
+        block = {'iteration': iteration, 'chains': self.chains, 'rho_H': rho * sig ** 3,
+                 'betaP_xy': rho * sig ** 3 * (1 + self.xy_lift / self.xy_displacement) if self.xy_displacement > 0
+                 else np.nan,
+                 'betaP_zz': self.N / (l_x * l_y) * sig ** 3 * self.wall_events / self.z_displacement if
+                 self.z_displacement > 0 else np.nan,
+                 'xy_displacement': self.xy_displacement, 'xy_lift': self.xy_lift,
+                 'z_displacement': self.z_displacement, 'wall_events': self.wall_events}
+        self.blocks.append(block)
+        if self.path is not None and iteration is not None:
+            with open(self.path, 'a') as f:
+                f.write(' '.join(str(block[c]) for c in PressureEstimator.columns) + '\n')
+        self.reset()
+        return block
+
+    @staticmethod
+    def summary(blocks):
+        """
+        :param blocks: list of blocks as returned by flush or load
+        :return: dict with the mean and standard error of the mean over the blocks of betaP_xy and betaP_zz, and the
+        number of blocks
+        """
+        result = {'blocks': len(blocks)}
+        for name in ['betaP_xy', 'betaP_zz']:
+            values = np.array([b[name] for b in blocks], dtype=float)
+            values = values[np.isfinite(values)]
+            result[name] = float(np.mean(values)) if len(values) > 0 else np.nan
+            result[name + '_err'] = float(np.std(values, ddof=1) / np.sqrt(len(values))) if len(
+                values) > 1 else np.nan
+        return result
+
+    @staticmethod
+    def load(output_dir):
+        """
+        :return: list of the blocks in output_dir/pressure, of all the runs of the simulation
+        """
+        path = os.path.join(output_dir, 'pressure')
+        if not os.path.exists(path):
+            return []
+        blocks = []
+        with open(path) as f:
+            for line in f:
+                if line.startswith('#') or not line.strip():
+                    continue
+                blocks.append({c: float(v) for c, v in zip(PressureEstimator.columns, line.split())})
+        return blocks
@@ -0,0 +1,129 @@
+import contextlib
+import cProfile
+import functools
+import io
+import os
+import pstats
+import sys
+import time
+
+# opt in with the environment variable ECMC_PROFILE=1 or the argument --profile of the entry points
+enabled = os.environ.get('ECMC_PROFILE', '0') not in ['', '0']
+_regions = {}  # region name -> [entries, timed entries, seconds]
+_sample_every = max(int(os.environ.get('ECMC_PROFILE_SAMPLE', '1')), 1)
+_null_region = contextlib.nullcontext()
+
+
+class _Region:
+
+    def __init__(self, name):
+        self.name = name
+        self.stat = _regions.setdefault(name, [0, 0, 0.0])
+        self.initial_time = None
+
+    def __enter__(self):
+        self.stat[0] += 1
+        if (self.stat[0] - 1) % _sample_every == 0:
+            self.initial_time = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if self.initial_time is not None:
+            self.stat[1] += 1
+            self.stat[2] += time.perf_counter() - self.initial_time
+            self.initial_time = None
+
+
+def region(name):
+    """
+    Wall clock timer around a named region, with region('collision search'): ...
+    Only every ECMC_PROFILE_SAMPLE-th entry of a region is timed, and the total is estimated from them. Does nothing
+    if profiling is not enabled.
+    """
+    if not enabled:
+        return _null_region
+    return _Region(name)
+
+
+def regions(*names):
+    """
+    The timers of region for every name, to be bound once outside a hot loop and entered in it, as
+    transfer, search = regions('cell transfer', 'collision search') once per chain. Without profiling they are all the
+    same no-op context, so the loop neither checks enabled nor creates timers.
+    """
+    return tuple(region(name) for name in names)
+
+
+def profiled_region(name):
+    """
+    Decorator timing every call of the function as region name
+    """
+
+    def decorator(f):
+        @functools.wraps(f)
+        def wrapper(*args, **kwargs):
+            with region(name):
+                return f(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def regions_summary():
+    """
+    :return: text table of the regions, sorted by estimated total time
+    """
+    rows = []
+    for name, (entries, timed, seconds) in _regions.items():
+        estimate = seconds * entries / timed if timed > 0 else 0.0
+        rows.append((estimate, name, entries, timed))
+    lines = ["region, entries, timed entries, estimated seconds"]
+    for estimate, name, entries, timed in sorted(rows, reverse=True):
+        lines.append(name + ", " + str(entries) + ", " + str(timed) + ", " + str(estimate))
+    return "\n".join(lines)
+
+
+class Profiler:
+
+    def __init__(self, output_dir, name, top=30, enable=None):
+        """
+        cProfile and the region timers around a block, with Profiler(output_dir, 'run_sim'): ...
+        On exit, also by sys.exit, writes output_dir/name.pstats and a summary of the top functions by cumulative time
+        and of the regions to output_dir/name_profile.txt. Does nothing if profiling is not enabled.
+        :param output_dir: where to write the files, created if it does not exist at exit
+        :param top: number of functions in the summary
+        :param enable: True to enable profiling regardless of ECMC_PROFILE, None to follow it
+        """
+        global enabled
+        if enable:
+            enabled = True
+        self.output_dir = os.path.abspath(output_dir)
+        self.name = name
+        self.top = top
+        self.profile = cProfile.Profile() if enabled else None
+
+    def __enter__(self):
+        if self.profile is not None:
+            _regions.clear()
+            self.profile.enable()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if self.profile is None:
+            return
+        self.profile.disable()
+        if not os.path.exists(self.output_dir):
+            os.makedirs(self.output_dir)
+        self.profile.dump_stats(os.path.join(self.output_dir, self.name + '.pstats'))
+        text = io.StringIO()
+        pstats.Stats(self.profile, stream=text).sort_stats('cumulative').print_stats(self.top)
+        with open(os.path.join(self.output_dir, self.name + '_profile.txt'), 'w') as f:
+            f.write(regions_summary() + "\n\n" + text.getvalue())
+
+
+def profile_requested():
+    """
+    :return: True if --profile is one of the arguments of the process, or ECMC_PROFILE is set
+    """
+    return enabled or '--profile' in sys.argv[1:]
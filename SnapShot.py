@@ -1,11 +1,16 @@
 import copy
 import cv2
+import json
 import matplotlib.pyplot as plt
 import numpy as np
 import os
+import queue
 import re
 import scipy.io as sio
-from EventChainActions import Step
+import sys
+import threading
+from EventChainActions import Step, Event2DCells, ArrayEvent2DCells
+from Profiling import profiled_region
 from Structure import *
 
 
@@ -107,20 +112,216 @@ class WriteOrLoad:
         cv2.destroyAllWindows()
         video.release()
 
-    def save_Input(self, rad, rho_H, edge, n_row, n_col):
+    def save_Input(self, rad, rho_H, edge, n_row, n_col, edge_y=None):
+        """
+        :param edge_y: y edge of rectangular cells, in which case edge is the x edge. None for square cells.
+        """
         file_name = os.path.join(self.output_dir, 'Input_parameters_from_python.mat')
         l_x, l_y, l_z = self.boundaries
-        sio.savemat(file_name, {'rad': float(rad), 'Lx': l_x, 'Ly': l_y,
-                                'H': float(l_z), 'rho_H': rho_H, 'edge': edge, 'n_row': n_row, 'n_col': n_col})
+        dictionary = {'rad': float(rad), 'Lx': l_x, 'Ly': l_y, 'H': float(l_z), 'rho_H': rho_H, 'edge': edge,
+                      'n_row': n_row, 'n_col': n_col}
+        if edge_y is not None:
+            dictionary['edge_y'] = edge_y
+        sio.savemat(file_name, dictionary)
+
+    def update_Input(self, **kwargs):
+        """
+        Add or overwrite entries of Input_parameters_from_python.mat, for example tuned total steps
+        """
+        file_name = os.path.join(self.output_dir, 'Input_parameters_from_python.mat')
+        dictionary = {k: v for k, v in sio.loadmat(file_name).items() if not k.startswith('__')}
+        dictionary.update(kwargs)
+        sio.savemat(file_name, dictionary)
+
+    def load_edge_y(self):
+        """
+        :return: y edge of the cells, which is edge for simulations with square cells
+        """
+        dictionary = sio.loadmat(os.path.join(self.output_dir, 'Input_parameters_from_python.mat'))
+        return dictionary['edge_y'][0][0] if 'edge_y' in dictionary else dictionary['edge'][0][0]
+
+    def load_total_steps(self):
+        """
+        :return: xy_total_step, z_total_step saved by update_Input, or None if they were never saved
+        """
+        dictionary = sio.loadmat(os.path.join(self.output_dir, 'Input_parameters_from_python.mat'))
+        if 'xy_total_step' not in dictionary or 'z_total_step' not in dictionary:
+            return None
+        return dictionary['xy_total_step'][0][0], dictionary['z_total_step'][0][0]
+
+    @property
+    def checkpoint_path(self):
+        return os.path.join(self.output_dir, 'checkpoint.npz')
+
+    @profiled_region('I/O')
+    def save_checkpoint(self, arr, iteration, rng_state):
+        """
+        Save everything needed to continue the simulation exactly: centers, cell occupancy, iteration counter and the
+        state of the random stream. The file is written to a temporary file which is then renamed, so a killed job
+        leaves either the old or the new checkpoint but never a broken one.
+        :type arr: Event2DCells or ArrayEvent2DCells
+        :param rng_state: random.getstate(), or the bit_generator.state of a np.random.Generator
+        """
+        centers, sphere_cell, sphere_slot = arr.occupancy()
+        if isinstance(rng_state, dict):
+            rng = {'rng_bit_generator_state': json.dumps(rng_state)}
+        else:
+            version, mt, gauss_next = rng_state
+            rng = {'rng_version': version, 'rng_mt': np.array(mt, dtype=np.int64),
+                   'rng_gauss_next': np.nan if gauss_next is None else gauss_next}
+        rad = arr.rad if isinstance(arr, ArrayEvent2DCells) else arr.all_spheres[0].rad
+        tmp_path = self.checkpoint_path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            np.savez(f, centers=centers, sphere_cell=sphere_cell, sphere_slot=sphere_slot, iteration=iteration,
+                     boundaries=np.array(arr.boundaries), edge=arr.edge, edge_y=arr.edge_y, n_rows=arr.n_rows,
+                     n_columns=arr.n_columns, rad=rad, **rng)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.checkpoint_path)
+
+    def checkpoint_iteration(self):
+        """
+        :return: the iteration of the saved checkpoint, -1 if there is no checkpoint
+        """
+        if not os.path.exists(self.checkpoint_path):
+            return -1
+        with np.load(self.checkpoint_path) as data:
+            return int(data['iteration'])
+
+    def load_checkpoint(self, backend='python'):
+        """
+        :param backend: 'python' builds an Event2DCells, anything else an ArrayEvent2DCells
+        :return: array of cells in the exact state of the checkpoint, the iteration and the state of the random stream,
+        for random.setstate or the bit_generator.state of a np.random.Generator as it was saved
+        """
+        with np.load(self.checkpoint_path) as data:
+            l_x, l_y, l_z = data['boundaries']
+            edge, n_rows, n_columns, rad = float(data['edge']), int(data['n_rows']), int(data['n_columns']), float(
+                data['rad'])
+            edge_y = float(data['edge_y']) if 'edge_y' in data else edge
+            if backend == 'python':
+                arr = Event2DCells(edge=edge, n_rows=n_rows, n_columns=n_columns, l_z=l_z, edge_y=edge_y)
+            else:
+                arr = ArrayEvent2DCells(edge=edge, n_rows=n_rows, n_columns=n_columns, l_z=l_z, rad=rad, edge_y=edge_y)
+            arr.boundaries = [l_x, l_y, l_z]
+            arr.l_x, arr.l_y = l_x, l_y
+            arr.load_occupancy(data['centers'], data['sphere_cell'], data['sphere_slot'], rad)
+            if 'rng_bit_generator_state' in data:
+                return arr, int(data['iteration']), json.loads(str(data['rng_bit_generator_state']))
+            gauss_next = float(data['rng_gauss_next'])
+            rng_state = (int(data['rng_version']), tuple(int(x) for x in data['rng_mt']),
+                         None if np.isnan(gauss_next) else gauss_next)
+            return arr, int(data['iteration']), rng_state
+
+    @property
+    def trajectory_path(self):
+        return os.path.join(self.output_dir, 'trajectory.bin')
+
+    @property
+    def trajectory_index_path(self):
+        return os.path.join(self.output_dir, 'trajectory.idx')
+
+    @staticmethod
+    def _read_index(path):
+        """
+        :return: int64 array of shape (n, 2) of the whole entries of the index file path, a torn entry at its end is
+        left out
+        """
+        if not os.path.exists(path):
+            return np.zeros((0, 2), dtype=np.int64)
+        entries = np.fromfile(path, dtype=np.uint8)
+        return entries[:len(entries) - len(entries) % 16].view(np.int64).reshape((-1, 2))
+
+    def trajectory_index(self):
+        """
+        :return: int64 array of shape (n_frames, 2), the realization and number of spheres of every frame in
+        trajectory.bin, in the order the frames were appended
+        """
+        return self._read_index(self.trajectory_index_path)
+
+    @profiled_region('I/O')
+    def append_frame(self, centers, realization):
+        """
+        Append the centers of realization to trajectory.bin as raw float64, and then its entry to trajectory.idx. The
+        index is written only after the frame is flushed, so an interrupted write leaves at most a tail of
+        trajectory.bin which is not indexed, or a torn entry at the end of trajectory.idx, both overwritten by the next
+        frame.
+        :param centers: (N,3) centers
+        :param realization: iteration number the frame is saved under, as the names of the old text files
+        """
+        centers = np.ascontiguousarray(centers, dtype=np.float64).reshape((-1, 3))
+        index = self.trajectory_index()
+        offset = 8 * 3 * int(np.sum(index[:, 1]))
+        with open(self.trajectory_path, 'r+b' if os.path.exists(self.trajectory_path) else 'wb') as f:
+            f.seek(offset)
+            f.write(centers.tobytes())
+            f.truncate()
+            f.flush()
+            os.fsync(f.fileno())
+        with open(self.trajectory_index_path, 'r+b' if os.path.exists(self.trajectory_index_path) else 'wb') as f:
+            f.seek(16 * len(index))
+            f.write(np.array([realization, len(centers)], dtype=np.int64).tobytes())
+            f.truncate()
+
+    def trajectory(self):
+        """
+        :return: read only np.memmap of shape (n_frames, N, 3) over trajectory.bin, frames in the order of
+        trajectory_index, None if there are no frames
+        """
+        index = self.trajectory_index()
+        if len(index) == 0:
+            return None
+        n_spheres = index[0, 1]
+        assert np.all(index[:, 1] == n_spheres), "Frames with different number of spheres in " + self.trajectory_path
+        return np.memmap(self.trajectory_path, dtype=np.float64, mode='r', shape=(len(index), n_spheres, 3))
+
+    @property
+    def ring_path(self):
+        return os.path.join(self.output_dir, 'ring.bin')
+
+    @property
+    def ring_index_path(self):
+        return os.path.join(self.output_dir, 'ring.idx')
+
+    def ring_index(self):
+        """
+        :return: int64 array of shape (ring_size, 2), the realization and number of spheres of the frame in every slot
+        of ring.bin, realization -1 for an empty slot
+        """
+        return self._read_index(self.ring_index_path)
+
+    @profiled_region('I/O')
+    def write_ring_frame(self, centers, realization, slot, ring_size):
+        """
+        Overwrite slot of the ring buffer ring.bin with the centers of realization. The slot is marked empty in
+        ring.idx while it is written.
+        """
+        centers = np.ascontiguousarray(centers, dtype=np.float64).reshape((-1, 3))
+        if len(self.ring_index()) != ring_size:
+            np.full((ring_size, 2), -1, dtype=np.int64).tofile(self.ring_index_path)
+        with open(self.ring_index_path, 'r+b') as f_idx, open(
+                self.ring_path, 'r+b' if os.path.exists(self.ring_path) else 'wb') as f:
+            f_idx.seek(16 * slot)
+            f_idx.write(np.array([-1, len(centers)], dtype=np.int64).tobytes())
+            f_idx.flush()
+            f.seek(slot * centers.nbytes)
+            f.write(centers.tobytes())
+            f.flush()
+            f_idx.seek(16 * slot)
+            f_idx.write(np.array([realization, len(centers)], dtype=np.int64).tobytes())
 
     def realizations(self):
+        """
+        :return: realizations saved in trajectory.bin, in the ring buffer or as numbered text files, from last to first
+        """
         if not os.path.exists(self.output_dir):
             raise ValueError("No folder found: " + self.output_dir)
         files = os.listdir(self.output_dir)
-        numbered_files = [int(f) for f in files if re.findall("^\d+$", f)]
+        numbered_files = set(int(f) for f in files if re.findall("^\d+$", f))
+        numbered_files.update(int(r) for r in self.trajectory_index()[:, 0])
+        numbered_files.update(int(r) for r in self.ring_index()[:, 0] if r >= 0)
         if len(numbered_files) > 0:
-            numbered_files.sort(reverse=True)
-            return numbered_files
+            return sorted(numbered_files, reverse=True)
         else:
             Warning("No realizations found")
             if os.path.exists(os.path.join(self.output_dir, 'Initial Conditions')):
@@ -128,10 +329,47 @@ class WriteOrLoad:
             else:
                 raise ValueError("No file center found at folder: " + self.output_dir)
 
+    @profiled_region('I/O')
+    def load_spheres(self, realization):
+        """
+        :param realization: realization number, 0 for the initial conditions
+        :return: (N,3) centers of realization, read from trajectory.bin if it is there and from its text file if not
+        """
+        if realization == 0:
+            return np.loadtxt(os.path.join(self.output_dir, 'Initial Conditions'))
+        index = self.trajectory_index()
+        frames = np.nonzero(index[:, 0] == int(realization))[0]
+        if len(frames) > 0:
+            return np.array(self.trajectory()[frames[-1]])
+        ring_index = self.ring_index()
+        slots = np.nonzero(ring_index[:, 0] == int(realization))[0]
+        if len(slots) > 0:
+            n_spheres = ring_index[slots[0], 1]
+            ring = np.memmap(self.ring_path, dtype=np.float64, mode='r', shape=(len(ring_index), n_spheres, 3))
+            return np.array(ring[slots[0]])
+        return np.loadtxt(os.path.join(self.output_dir, str(realization)))
+
     def last_spheres(self):
         file_ind = self.realizations()[0]
-        sp_name = str(self.realizations()[0]) if file_ind > 0 else 'Initial Conditions'
-        return np.loadtxt(os.path.join(self.output_dir, sp_name)), file_ind
+        return self.load_spheres(file_ind), file_ind
+
+    def convert_to_trajectory(self, remove_files=False):
+        """
+        Append the numbered text realizations which are not in trajectory.bin yet, from first to last
+        :param remove_files: delete every text file after its frame is written
+        :return: number of frames converted
+        """
+        in_trajectory = set(int(r) for r in self.trajectory_index()[:, 0])
+        files = [int(f) for f in os.listdir(self.output_dir) if re.findall("^\d+$", f)]
+        converted = 0
+        for realization in sorted(files):
+            file_path = os.path.join(self.output_dir, str(realization))
+            if realization not in in_trajectory:
+                self.append_frame(np.loadtxt(file_path), realization)
+                converted += 1
+            if remove_files:
+                os.remove(file_path)
+        return converted
 
     def load_Input(self):
         file_name = os.path.join(self.output_dir, 'Input_parameters_from_python.mat')
@@ -140,3 +378,94 @@ class WriteOrLoad:
             dictionary['Lx'][0][0], dictionary['Ly'][0][0], dictionary['H'][0][0], dictionary['rad'][0][0], \
             dictionary['rho_H'][0][0], dictionary['edge'][0][0], dictionary['n_row'][0][0], dictionary['n_col'][0][0]
         return l_x, l_y, l_z, rad, rho_H, edge, n_row, n_col
+
+
+class TimeSeriesRecorder:
+
+    def __init__(self, files_interface: WriteOrLoad, interval, keep_every=10, ring_size=100, max_queue=16):
+        """
+        Record configurations of a running simulation every interval chains, without blocking it. Every frame is
+        written to the ring buffer ring.bin holding the last ring_size frames, and every keep_every-th frame is also
+        appended to trajectory.bin for good, so disk usage grows keep_every times slower than the number of frames.
+        The frames are written by a background thread, record only copies the centers.
+        :param files_interface: WriteOrLoad of the simulation folder
+        :param interval: chains between frames, K*N for a frame every K sweeps
+        :param keep_every: thinning of the frames kept in trajectory.bin
+        :param ring_size: number of frames in the ring buffer
+        :param max_queue: number of frames waiting to be written before record waits for the writer
+        """
+        self.files_interface = files_interface
+        self.interval = interval
+        self.keep_every = keep_every
+        self.ring_size = ring_size
+        ring_index = files_interface.ring_index()
+        if len(ring_index) == ring_size and np.any(ring_index[:, 0] >= 0):
+            self.slot = (int(np.argmax(ring_index[:, 0])) + 1) % ring_size  # continue after the newest frame
+        else:
+            self.slot = 0
+        self.frames = queue.Queue(maxsize=max_queue)
+        self.error = None
+        self.writer = threading.Thread(target=self._write, daemon=True)
+        self.writer.start()
+
+    def due(self, last_iteration, iteration):
+        """
+        :return: True if a frame should be recorded after the chains from last_iteration to iteration
+        """
+        return iteration // self.interval > last_iteration // self.interval
+
+    def record(self, centers, realization):
+        """
+        Queue a copy of centers to be written as realization
+        """
+        if self.error is not None:
+            raise self.error
+        keep = (realization // self.interval) % self.keep_every == 0
+        self.frames.put((np.array(centers, dtype=np.float64), realization, keep))
+
+    def _write(self):
+        while True:
+            frame = self.frames.get()
+            if frame is None:
+                return
+            centers, realization, keep = frame
+            try:
+                self.files_interface.write_ring_frame(centers, realization, self.slot, self.ring_size)
+                self.slot = (self.slot + 1) % self.ring_size
+                if keep:
+                    self.files_interface.append_frame(centers, realization)
+            except Exception as err:
+                self.error = err
+                return
+
+    def close(self):
+        """
+        Wait for all the queued frames to be written
+        """
+        if self.writer.is_alive():
+            self.frames.put(None)
+            self.writer.join()
+        if self.error is not None:
+            raise self.error
+
+
+def convert_simulation_results(prefix='./simulation_results/', remove_files=False):
+    """
+    Convert the numbered text realizations of every simulation folder in prefix, including replica folders of
+    ensembles, to trajectory.bin
+    """
+    for sim_name in sorted(os.listdir(prefix)):
+        sim_path = os.path.join(prefix, sim_name)
+        if not os.path.isdir(sim_path):
+            continue
+        sim_paths = [sim_path] + [os.path.join(sim_path, d) for d in sorted(os.listdir(sim_path)) if
+                                  d.startswith('replica_') and os.path.isdir(os.path.join(sim_path, d))]
+        for path in sim_paths:
+            if not os.path.exists(os.path.join(path, 'Input_parameters_from_python.mat')):
+                continue
+            converted = WriteOrLoad(path).convert_to_trajectory(remove_files=remove_files)
+            print(path + ": converted " + str(converted) + " realizations")
+
+
+if __name__ == "__main__":
+    convert_simulation_results(*sys.argv[1:2], remove_files='--remove' in sys.argv[2:])
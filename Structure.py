@@ -1,13 +1,33 @@
+import contextlib
 import copy
+import gc
 import numpy as np
 import random
 from enum import Enum
 import warnings
+from scipy.spatial import cKDTree
 
 epsilon = 1e-8
 
 
+@contextlib.contextmanager
+def no_gc():
+    """
+    Pause the cyclic garbage collector, with no_gc(): ... around the construction of many cells and spheres, which
+    otherwise triggers repeated full collections over all the objects already created
+    """
+    was_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        yield
+    finally:
+        if was_enabled:
+            gc.enable()
+
+
 class Direction:
+    __slots__ = ('dim', 'sgn')
+
     def __init__(self, dim, sgn=1):
         self.dim = dim
         if dim == 2:
@@ -23,10 +43,25 @@ class Direction:
 
     @staticmethod
     def directions():
-        return [Direction(0), Direction(1), Direction(2, 1), Direction(2, -1)]
+        """
+        :return: the x, y, +z and -z directions. They are singletons shared by all the steps, so they should never be
+        changed, see opposite.
+        """
+        return _directions
+
+    def opposite(self):
+        """
+        :return: the singleton direction of the z step reflected by a wall
+        """
+        assert self.dim == 2, "Only z steps are reflected, xy steps are positive"
+        return _directions[3 if self.sgn == 1 else 2]
+
+
+_directions = (Direction(0), Direction(1), Direction(2, 1), Direction(2, -1))
 
 
 class Sphere:
+    __slots__ = ('center', 'rad')
 
     def __init__(self, center, rad):
         """
@@ -49,8 +84,10 @@ class Sphere:
         Put the sphere inside the boundaries of the simulation, usefull for cyclic boundary conditions
         :type boundaries: list
         """
+        center = self.center
         try:
-            self.center = [x % e for x, e in zip(self.center, boundaries)]
+            for d in range(len(center)):  # in place, a chain moves spheres many times
+                center[d] %= boundaries[d]
         except RuntimeWarning:
             print(RuntimeWarning)
 
@@ -60,6 +97,20 @@ class Sphere:
         self.box_it(boundaries)
 
 
+class Ghost(Sphere):
+    __slots__ = ('sphere',)
+
+    def __init__(self, sphere: Sphere, wrap, boundaries):
+        """
+        Periodic image of sphere, kept in the halo of Event2DCells so collision searches need no cyclic images
+        :param wrap: (wx, wy), the image is shifted by wx*l_x in x and wy*l_y in y
+        :type boundaries: list
+        """
+        c = sphere.center
+        super().__init__((c[0] + wrap[0] * boundaries[0], c[1] + wrap[1] * boundaries[1], c[2]), sphere.rad)
+        self.sphere = sphere
+
+
 class BoundaryType(Enum):
     WALL = "RigidWall"
     CYCLIC = "CyclicBoundaryConditions"
@@ -108,53 +159,81 @@ class Metric:
     def dist_to_collision(sphere1, other_spheres, total_step, direction: Direction, boundaries, cut_off=float('inf')):
         """
         Distance sphere1 would need to go in direction in order to collide with sphere2
-        It is not implemented in the most efficient way,  because for cyclic xy we copy sphere2 8 times (for all
-        cyclic boundaries) and then check for collision.
+        For cyclic xy every sphere2 is checked against all the relevant cyclic images, see
+        Metric.dist_to_collision_batch.
         It is implemented only for steps smaller then system size.
         :param sphere1: sphere about to move
         :type sphere1: Sphere
-        :param sphere2: potential for collision
-        :type sphere2: Sphere
+        :param other_spheres: potential for collision
+        :type other_spheres: list
         :param total_step: maximal step size. If dist for collision > total_step then dist_to_collision-->infty
         :param direction: in which sphere1 is to move
         :param boundaries: boundaries for the case some of them are cyclic boundary conditinos
         :type boundaries: list
         :return: distance for collision if the move is allowed, infty if move can not lead to collision
         """
-        # for sphere2 in other_spheres:
-        #     assert not Metric.overlap(sphere1, sphere2, boundaries), "Overlap between:\nSphere1: " + str(
-        #         sphere1.center) + "\nSphere2: " + str(sphere2.center) + "\nBoundaries are: " + str(boundaries)
-        c1 = sphere1.center
-        vectors = Metric.relevant_cyclic_transform_vecs(c1, boundaries, cut_off)
-        closest_sphere, closest_sphere_dist = [], float('inf')
-        for sphere2 in other_spheres:
-            c2 = sphere2.center
-            sig_sq = (sphere1.rad + sphere2.rad) ** 2
-            if direction.dim == 2:
-                dz = (c2[2] - c1[2]) * direction.sgn
-                if dz <= 0: continue
-                for v in vectors:
-                    discriminant = sig_sq - (c2[1] - c1[1] + v[1]) ** 2 - (c2[0] - c1[0] + v[0]) ** 2
-                    if discriminant <= 0: continue
-                    dist = dz - np.sqrt(discriminant)  # for non overlapping sphere dist>0 always, no need to check
-                    if dist <= total_step and dist < closest_sphere_dist:
-                        closest_sphere_dist = dist
-                        closest_sphere = sphere2
+        if len(other_spheres) == 0:
+            return float('inf'), []
+        centers2 = np.array([s.center for s in other_spheres])
+        rads2 = np.array([s.rad for s in other_spheres])
+        closest_sphere_dist, k = Metric.dist_to_collision_batch(sphere1.center, sphere1.rad, centers2, rads2,
+                                                                total_step, direction, boundaries, cut_off)
+        return closest_sphere_dist, (other_spheres[k] if k >= 0 else [])
+
+    @staticmethod
+    def dist_to_collision_batch(center1, rad1, centers2, rads2, total_step, direction: Direction, boundaries,
+                                cut_off=float('inf')):
+        """
+        Vectorized collision search, all the candidates and all their relevant cyclic images are handled in one numpy
+        expression. Ties are broken as in a loop over candidates and then over images.
+        For x and y directions every candidate has a single image: the distance along the direction is taken forward
+        modulo the system size and the distance across it is the minimal image, so candidates anywhere ahead are found
+        without cut_off, see ArrayOfCells.marching_stencil. Without boundaries centers2 are taken as they are, for
+        candidates that were already shifted to the right periodic image, see ArrayOfCells.direction_stencil_wraps.
+        :param center1: center of the sphere about to move
+        :param rad1: its radius
+        :param centers2: (n,3) array of the centers of the candidates for collision
+        :param rads2: scalar or (n,) array of the candidates radii
+        :param total_step: maximal step size, collisions further away are ignored
+        :param direction: in which sphere1 is to move
+        :type boundaries: list or None
+        :param cut_off: only cyclic images closer then cut_off to the boundaries are considered, for z directions
+        :return: distance for collision and the row of centers2 collided, (inf, -1) if there is no collision
+        """
+        centers2 = np.asarray(centers2, dtype=float).reshape((-1, 3))
+        if len(centers2) == 0:
+            return float('inf'), -1
+        c1 = np.asarray(center1, dtype=float)
+        sig_sq = (rad1 + np.asarray(rads2, dtype=float)) ** 2 * np.ones(len(centers2))
+        dr = centers2 - c1
+        if direction.dim == 2:
+            vectors = np.zeros((1, 2)) if boundaries is None else np.array(
+                Metric.relevant_cyclic_transform_vecs(c1, boundaries, cut_off), dtype=float)
+            dxy = dr[:, np.newaxis, :2] + vectors[np.newaxis, :, :]  # (n candidates, m images, xy)
+            dz = dr[:, 2] * direction.sgn
+            discriminant = sig_sq[:, np.newaxis] - dxy[:, :, 1] ** 2 - dxy[:, :, 0] ** 2
+            valid = (dz[:, np.newaxis] > 0) & (discriminant > 0)
+            dist = dz[:, np.newaxis] - np.sqrt(np.where(valid, discriminant, 0))
+        else:
+            vectors = [0]
+            i, j = direction.dim, 1 - direction.dim
+            # dx is in the direction of the step i, and dy in j direction
+            if boundaries is None:
+                dx, dy = dr[:, i], dr[:, j]
             else:
-                i, j = direction.dim, 1 - direction.dim
-                sig_xy_sq = sig_sq - (c2[2] - c1[2]) ** 2
-                if sig_xy_sq <= 0: continue
-                for v in vectors:
-                    # dx is in the direction of the step i, and dy in j direction
-                    dx = c2[i] - c1[i] + v[i]
-                    if dx <= 0: continue
-                    discriminant = sig_xy_sq - (c2[j] - c1[j] + v[j]) ** 2
-                    if discriminant <= 0: continue
-                    dist = dx - np.sqrt(discriminant)
-                    if dist <= total_step and dist < closest_sphere_dist:
-                        closest_sphere_dist = dist
-                        closest_sphere = sphere2
-        return closest_sphere_dist, closest_sphere
+                l_i, l_j = boundaries[i], boundaries[j]
+                dx = dr[:, i] % l_i
+                dy = dr[:, j] - l_j * np.round(dr[:, j] / l_j)
+            sig_xy_sq = sig_sq - dr[:, 2] ** 2
+            discriminant = sig_xy_sq - dy ** 2
+            valid = (sig_xy_sq > 0) & (dx > 0) & (discriminant > 0)
+            dist = dx - np.sqrt(np.where(valid, discriminant, 0))
+        dist = np.where(valid & (dist <= total_step), dist, np.inf)
+        k = int(np.argmin(dist))
+        closest_sphere_dist = float(dist.flat[k])
+        if closest_sphere_dist == float('inf'):
+            return closest_sphere_dist, -1
+        return closest_sphere_dist, k // len(vectors)
 
     @staticmethod
     def cyclic_vec(boundaries, sphere1, sphere2):
@@ -202,6 +281,123 @@ class Metric:
                 sphere1.center = sphere1.center + np.abs(delta) * dr_hat
                 return False
 
+    @staticmethod
+    def periodic_tree(centers, boundaries):
+        """
+        :param centers: (N,3) centers
+        :param boundaries: [l_x, l_y, l_z]
+        :return: copy of the centers wrapped into the box, with z shifted by l_z, and a cKDTree of them which is cyclic
+        in x and y
+        """
+        c = np.array(centers, dtype=float).reshape((-1, 3))
+        l = np.array(boundaries[:2], dtype=float)
+        c[:, :2] %= l
+        c[:, :2] = np.where(c[:, :2] >= l, 0.0, c[:, :2])  # x%l can round up to l
+        # z is not cyclic, it is shifted into the middle of a box big enough for its images to never be neighbors
+        l_z = boundaries[2]
+        c[:, 2] = np.clip(c[:, 2] + l_z, 0, 3 * l_z - epsilon)
+        return c, cKDTree(c, boxsize=[l[0], l[1], 3 * l_z])
+
+    @staticmethod
+    def compression_factors(centers, rad, boundaries, xy=True, min_factor=0.9, margin=100 * epsilon):
+        """
+        Smallest factor the xy (or z) separations of every pair of spheres can be multiplied by without overlap. Scaling
+        xy separations by f keeps a pair legal if f^2*dxy^2+dz^2>=sig^2, and only pairs closer than sig/min_factor can
+        require f>min_factor.
+        :param centers: (N,3) centers
+        :param boundaries: [l_x, l_y, l_z]
+        :param xy: True for scaling of the x and y separations, False for the z separations
+        :param min_factor: pairs which allow scaling by min_factor are not returned, the smaller it is the more pairs
+        are checked
+        :param margin: minimal gap between the surfaces of the spheres after scaling
+        :return: (M,2) array of the pairs i<j which require a factor larger than min_factor, (M,3) array of the
+        separations c_j-c_i through the cyclic boundaries, and the (M,) factors
+        """
+        sig = 2 * rad + margin
+        c, tree = Metric.periodic_tree(centers, boundaries)
+        pairs = tree.query_pairs(r=sig / min_factor, output_type='ndarray').reshape((-1, 2))
+        l = np.array(boundaries[:2], dtype=float)
+        dr = c[pairs[:, 1]] - c[pairs[:, 0]]
+        dr[:, :2] = (dr[:, :2] + l / 2) % l - l / 2  # shortest path through cyclic boundaries
+        dxy2 = dr[:, 0] ** 2 + dr[:, 1] ** 2
+        scaled, fixed = (dxy2, dr[:, 2] ** 2) if xy else (dr[:, 2] ** 2, dxy2)
+        factors = np.sqrt(np.clip(sig ** 2 - fixed, 0, None) / np.where(scaled > 0, scaled, np.inf))
+        need = factors > min_factor
+        return pairs[need], dr[need], factors[need]
+
+    @staticmethod
+    def allowed_z_intervals(center1, rad, centers2, l_z, margin=epsilon):
+        """
+        Heights a sphere of radius rad can be moved to in z, keeping its x and y, without overlapping the other spheres
+        or the walls. Every other sphere closer than sig in xy excludes the heights closer than sqrt(sig^2-dxy^2) to its
+        own height.
+        :param center1: center of the sphere
+        :param centers2: (M,3) centers of the other spheres, as the images closest in xy, no cyclic images are searched
+        :param l_z: distance between the walls
+        :param margin: minimal gap to the walls and to the other spheres
+        :return: (K,2) array of the disjoint intervals [z_low, z_high] of allowed heights, sorted
+        """
+        sig = 2 * rad
+        c2 = np.reshape(np.asarray(centers2, dtype=float), (-1, 3))
+        dxy2 = (c2[:, 0] - center1[0]) ** 2 + (c2[:, 1] - center1[1]) ** 2
+        near = dxy2 < sig ** 2
+        half = np.sqrt(sig ** 2 - dxy2[near]) + margin
+        order = np.argsort(c2[near, 2] - half)
+        z, z_max = rad + margin, l_z - rad - margin
+        intervals = []
+        for start, end in zip((c2[near, 2] - half)[order], (c2[near, 2] + half)[order]):
+            if start >= z_max:
+                break
+            if start > z:
+                intervals.append((z, start))
+            z = max(z, end)
+        if z < z_max:
+            intervals.append((z, z_max))
+        return np.array(intervals, dtype=float).reshape((-1, 2))
+
+    @staticmethod
+    def uniform_in_intervals(intervals, u):
+        """
+        :param intervals: (K,2) array of disjoint intervals, see allowed_z_intervals
+        :param u: uniform random number in [0,1)
+        :return: the point at fraction u of the total length of the intervals, uniformly distributed over them
+        """
+        lengths = intervals[:, 1] - intervals[:, 0]
+        cumulative = np.cumsum(lengths)
+        x = u * cumulative[-1]
+        k = min(int(np.searchsorted(cumulative, x, side='right')), len(intervals) - 1)
+        return float(intervals[k, 1] - (cumulative[k] - x))
+
+    @staticmethod
+    def overlaps(centers, rad, boundaries, sample=None, rng=None):
+        """
+        Find all the overlapping pairs of spheres of radius rad, cyclic in x and y, and the minimal gap between spheres.
+        Both checks use a periodic cKDTree, the sampled check queries it only for sample random spheres, which is
+        cheaper and meant for frequent sanity checks.
+        :param centers: (N,3) centers
+        :param boundaries: [l_x, l_y, l_z]
+        :param sample: number of spheres to check, None for all of them
+        :param rng: np.random.Generator for the sampled spheres
+        :return: (M,2) array of overlapping pairs i<j (pairs of sampled spheres i and any j for sampled check), and the
+        minimal distance between surfaces of spheres (negative for overlap)
+        """
+        n = len(np.reshape(centers, (-1, 3)))
+        sig = 2 * rad
+        tolerance = 1e3 * epsilon  # forgiving some penetration, as overlap
+        if n < 2:
+            return np.zeros((0, 2), dtype=int), np.inf
+        c, tree = Metric.periodic_tree(centers, boundaries)
+        if sample is not None and sample < n:
+            rng = rng if rng is not None else np.random.default_rng()
+            ids = rng.choice(n, size=sample, replace=False)
+            dist, _ = tree.query(c[ids], k=2)
+            neighbors = tree.query_ball_point(c[ids], r=sig - tolerance)
+            pairs = [(i, j) for i, near in zip(ids, neighbors) for j in near if j != i]
+            return np.array(pairs, dtype=int).reshape((-1, 2)), float(np.min(dist[:, 1]) - sig)
+        dist, _ = tree.query(c, k=2)
+        pairs = tree.query_pairs(r=sig - tolerance, output_type='ndarray')
+        return pairs, float(np.min(dist[:, 1]) - sig)
+
     @staticmethod
     def spheres_overlap(spheres, boundaries):
         """
@@ -238,6 +434,7 @@ class Metric:
 
 
 class Cell:
+    __slots__ = ('site', 'edges', 'ind', 'spheres')
 
     def __init__(self, site, edges, ind=(), spheres=[]):
         """
@@ -442,6 +639,64 @@ class ArrayOfCells:
         jm1 = int((j - 1) % n_columns)
         return ip1, jp1, im1, jm1
 
+    @staticmethod
+    def marching_bands(offset, total_step, sig, edge, n):
+        """
+        Number of cells ahead of its own cell a sphere moving in x or y should search, so it could go all of total_step
+        without leaving them. At least one, as in direction_stencils, and at most n-1 so no cell is searched twice.
+        :param offset: position of the sphere in its cell along the direction of motion
+        :param edge: edge of the cells along the direction of motion
+        :param n: number of cells along the direction of motion
+        """
+        return max(1, min(int(np.ceil((total_step + sig + offset) / edge)) - 1, n - 1))
+
+    @staticmethod
+    def marching_stencil(i, j, n_rows, n_columns, dim, bands):
+        """
+        Cells a sphere in cell (i,j) moving in x (dim=0) or y (dim=1) might collide with while marching bands cells
+        ahead: for every band from its own cell on, the cell on the line of motion and its two neighbors across it.
+        With bands=1 these are the cells of direction_stencils, in the same order.
+        :return: int array of the flat indices of the cells, and int array of their periodic wraps as in
+        direction_stencil_wraps
+        """
+        c = np.arange(3 * (bands + 1))
+        q, a = c // 3, (c + 1) % 3 - 1  # a is 0, 1, -1 in every band
+        rows, columns = (i + a, j + q) if dim == 0 else (i + q, j + a)
+        wraps = np.empty((len(c), 2), dtype=np.int64)
+        wraps[:, 0], wraps[:, 1] = columns // n_columns, rows // n_rows
+        return (rows % n_rows) * n_columns + columns % n_columns, wraps
+
+    @staticmethod
+    def direction_stencils(n_rows, n_columns):
+        """
+        Cells a sphere might collide with, for every cell and direction of motion. The +z and -z directions share the
+        same stencil.
+        :return: list of three int arrays, for direction.dim=0,1,2. Row k=i*n_columns+j of each array holds the flat
+        indices of cell (i,j) itself followed by its relevant neighbors: the 5 cells ahead for x and y steps and all 8
+        neighbors for z steps.
+        """
+        i, j = np.divmod(np.arange(n_rows * n_columns), n_columns)
+        return [np.array([((i + di) % n_rows) * n_columns + (j + dj) % n_columns for di, dj in offsets],
+                         dtype=np.int64).T for offsets in ArrayOfCells.stencil_offsets]
+
+    # (di, dj) of the cells of direction_stencils, x and y in the order of marching_stencil with one band
+    stencil_offsets = [[(0, 0), (1, 0), (-1, 0), (0, 1), (1, 1), (-1, 1)],
+                       [(0, 0), (0, 1), (0, -1), (1, 0), (1, 1), (1, -1)],
+                       [(0, 0), (1, -1), (1, 0), (1, 1), (0, 1), (0, -1), (-1, -1), (-1, 0), (-1, 1)]]
+
+    @staticmethod
+    def direction_stencil_wraps(n_rows, n_columns):
+        """
+        Periodic wraps of the cells of direction_stencils. A sphere in cell (i,j) sees the spheres of the n-th cell of
+        its stencil shifted by wx*l_x in x and wy*l_y in y, where (wx, wy) is entry [i*n_columns+j, n], so collisions
+        with them need no cyclic images.
+        :return: list of three int arrays of shape (n_rows*n_columns, stencil size, 2), for direction.dim=0,1,2
+        """
+        i, j = np.divmod(np.arange(n_rows * n_columns), n_columns)
+        return [np.stack([np.array([(j + dj) // n_columns for _, dj in offsets]).T,
+                          np.array([(i + di) // n_rows for di, _ in offsets]).T], axis=-1).astype(np.int64)
+                for offsets in ArrayOfCells.stencil_offsets]
+
     def neighbors(self, i, j):
         ip1, jp1, im1, jm1 = ArrayOfCells.cyclic_indices(i, j, self.n_rows, self.n_columns)
         neighbor_cells = [self.cells[ip1][jm1], self.cells[ip1][j],
@@ -452,30 +707,33 @@ class ArrayOfCells:
         # For efficient legal_configuration implementation
         return neighbor_cells
 
-    def legal_configuration(self):
+    def legal_configuration(self, sample=None):
         """
+        :param sample: check overlaps only for sample random spheres, see Metric.overlaps
         :return: True if there are no overlapping spheres in the configuration
         """
         if self.cells == []: return True
         if self.dim != 2:
             raise (Exception('Only d=2 supported!'))
-        n_rows, n_columns = self.n_rows, self.n_columns
-        for i in range(n_rows):
-            for j in range(n_columns):
+        spheres, sites, edges = [], [], []
+        for i in range(self.n_rows):
+            for j in range(self.n_columns):
                 cell = self.cells[i][j]
-                if Metric.spheres_overlap(cell.spheres, self.boundaries):
-                    return False
-                for sphere in cell.spheres:
-                    assert cell.center_in_cell(sphere), "sphere is missing from cell"
-                for sphere in cell.spheres:
-                    c_z = sphere.center[2]
-                    r = sphere.rad
-                    if c_z - r < -epsilon or c_z + r > self.boundaries[2] + epsilon:
-                        return False
-                for neighbor in self.neighbors(i, j):
-                    if self.overlap_2_cells(cell, neighbor):
-                        return False
-        return True
+                spheres += cell.spheres
+                sites += [cell.site] * len(cell.spheres)
+                edges += [cell.edges] * len(cell.spheres)
+        if len(spheres) == 0: return True
+        c = np.array([sphere.center for sphere in spheres], dtype=float)
+        sites, edges = np.array(sites, dtype=float), np.array(edges, dtype=float)
+        # same as Cell.center_in_cell for all the spheres, up to rounding of scaled sites and centers on the lower face,
+        # which is where cell_of_sphere bins them
+        assert np.all((c[:, :2] >= sites - epsilon) & (c[:, :2] <= sites + edges + epsilon)), \
+            "sphere is missing from cell"
+        r = spheres[0].rad
+        if np.any(c[:, 2] - r < -epsilon) or np.any(c[:, 2] + r > self.boundaries[2] + epsilon):
+            return False
+        pairs, _ = Metric.overlaps(c, r, self.boundaries, sample=sample)
+        return len(pairs) == 0
 
     def cell_from_ind(self, ind):
         """
@@ -523,39 +781,54 @@ class ArrayOfCells:
             # assert type(spheres) == Sphere
             spheres = [spheres]
         cells = []
-        for sphere in spheres:
-            sp_added_to_cell = False
-            for i in range(len(self.cells)):
-                for j in range(len(self.cells[i])):
-                    c = self.cells[i][j]
-                    if c.center_in_cell(sphere):
-                        c.append(sphere)
-                        cells.append(c)
-                        sp_added_to_cell = True
-                        break
-            if not sp_added_to_cell:
-                raise ValueError("A sphere was not added to any of the cells")
+        if len(spheres) == 0:
+            return cells
+        # guess the cell by integer division, as if all cells had the edges of the first, and scan only if it is wrong
+        first = self.cells[0][0]
+        centers = np.array([sphere.center[:2] for sphere in spheres], dtype=float)
+        guess = np.floor((centers - first.site[:2]) / first.edges[:2]).astype(int)
+        for sphere, (j, i) in zip(spheres, guess):
+            if 0 <= i < len(self.cells) and 0 <= j < len(self.cells[i]) and self.cells[i][j].center_in_cell(sphere):
+                c = self.cells[i][j]
+            else:
+                c = self.scan_for_cell(sphere)
+            c.append(sphere)
+            cells.append(c)
         if len(cells) == 1:
             return cells[0]
         return cells
 
+    def scan_for_cell(self, sphere):
+        """
+        :return: the cell sphere is in, by checking all cells
+        """
+        for i in range(len(self.cells)):
+            for j in range(len(self.cells[i])):
+                c = self.cells[i][j]
+                if c.center_in_cell(sphere):
+                    return c
+        raise ValueError("A sphere was not added to any of the cells")
+
     @staticmethod
     def spheres_in_triangular(n_row, n_col, rad, l_x, l_y):
+        return [Sphere(c, rad) for c in ArrayOfCells.triangular_centers(n_row, n_col, rad, l_x, l_y)]
+
+    @staticmethod
+    def triangular_centers(n_row, n_col, rad, l_x, l_y):
+        """
+        :return: (n_row*n_col,3) centers of the triangular lattice of spheres_in_triangular, row by row
+        """
         assert type(rad) != list, "list of different rads is not supported for initial condition triangular"
         ax = l_x / (n_col + 1 / 2)
         ay = l_y / (n_row + 1)
         assert ax >= 2 * rad and ay / np.cos(
             np.pi / 6) >= 2 * rad, "ferro triangle initial conditions are not defined for a<2*r, too many spheres"
-        spheres = []
-        for i in range(n_row):
-            for j in range(n_col):
-                if i % 2 == 0:
-                    xj = (1 + epsilon) * rad + ax * j
-                else:
-                    xj = (1 + epsilon) * rad + ax * (j + 1 / 2)  # cos(pi / 3) = 1 / 2
-                yi = (1 + epsilon) * rad + ay * i
-                spheres.append(Sphere([xj, yi, rad * (1 + epsilon)], rad))
-        return spheres
+        i, j = np.divmod(np.arange(n_row * n_col), n_col)
+        centers = np.empty((n_row * n_col, 3))
+        centers[:, 0] = (1 + epsilon) * rad + ax * (j + (i % 2) / 2)  # cos(pi / 3) = 1 / 2
+        centers[:, 1] = (1 + epsilon) * rad + ay * i
+        centers[:, 2] = rad * (1 + epsilon)
+        return centers
 
     def translate(self, vec):
         """
@@ -0,0 +1,115 @@
+import json
+import sys
+
+from EventChainActions import *
+
+
+class Telemetry:
+    # same order as the event constants of EventChainKernel
+    event_types = [EventType.FREE, EventType.COLLISION, EventType.WALL, EventType.PASS]
+    _event_index = {event_type: k for k, event_type in enumerate(event_types)}
+    prefix = "TELEMETRY "
+
+    def __init__(self, max_candidates=64, **labels):
+        """
+        Counters of the work done by perform_total_step, summarized and reset every flush. Pass it as the telemetry
+        argument of perform_total_step to count events and candidates, and report every chain with chain.
+        :param max_candidates: candidates histogram has a bin for every number of candidates up to max_candidates, the
+        last bin counts events with more candidates
+        :param labels: written with every summary, for example N, h, rhoH, backend and the phase of the run
+        """
+        self.max_candidates = max_candidates
+        self.labels = labels
+        self.reset()
+
+    def reset(self):
+        self.event_counts = np.zeros(len(Telemetry.event_types), dtype=np.int64)
+        self.candidates = 0
+        self.candidates_hist = np.zeros(self.max_candidates + 1, dtype=np.int64)
+        self.chains = 0
+        self.chain_events = 0
+        self.chain_length_hist = np.zeros(64, dtype=np.int64)  # bin b counts chains of 2^(b-1)<=events<2^b
+        self.chain_seconds = 0.0
+        self.max_chain_seconds = 0.0
+
+    def event(self, event_type, candidates):
+        """
+        Count one event ending a leg of a chain, after scanning candidates spheres for collisions
+        """
+        self.event_counts[Telemetry._event_index[event_type]] += 1
+        self.candidates += candidates
+        self.candidates_hist[min(candidates, self.max_candidates)] += 1
+
+    def kernel_events(self, stats):
+        """
+        Count the events of the compiled kernel, see EventChainKernel.chain, which has no per event candidates
+        """
+        self.event_counts += stats[:4]
+        self.candidates += int(stats[4])
+
+    def chain(self, events, seconds):
+        """
+        Count one chain of events legs which took seconds
+        """
+        self.chains += 1
+        self.chain_events += events
+        self.chain_length_hist[int(events).bit_length()] += 1
+        self.chain_seconds += seconds
+        self.max_chain_seconds = max(self.max_chain_seconds, seconds)
+
+    @staticmethod
+    def occupancy_hist(arr):
+        """
+        :type arr: Event2DCells or ArrayEvent2DCells
+        :return: histogram of the number of spheres in a cell, entry k is the number of cells with k spheres
+        """
+        if isinstance(arr, ArrayEvent2DCells):
+            counts = arr.cell_count
+        else:
+            counts = np.array([len(c.spheres) for row in arr.cells for c in row], dtype=np.int64)
+        return np.bincount(counts)
+
+    def summary(self, arr=None, **extra):
+        """
+        :return: dict of the counters since the last reset, with the labels, extra and the occupancy of arr
+        """
+        n_events = int(np.sum(self.event_counts))
+        result = dict(self.labels)
+        result.update(extra)
+        result.update({'chains': self.chains, 'events': n_events,
+                       'event_counts': {e.name: int(n) for e, n in zip(Telemetry.event_types, self.event_counts)},
+                       'candidates_per_event': self.candidates / n_events if n_events > 0 else None,
+                       'events_per_chain': self.chain_events / self.chains if self.chains > 0 else None,
+                       'seconds_per_chain': self.chain_seconds / self.chains if self.chains > 0 else None,
+                       'max_seconds_per_chain': self.max_chain_seconds,
+                       'events_per_sec': self.chain_events / self.chain_seconds if self.chain_seconds > 0 else None,
+                       'chain_length_hist_log2': np.trim_zeros(self.chain_length_hist, 'b').tolist()})
+        if np.any(self.candidates_hist):
+            result['candidates_hist'] = np.trim_zeros(self.candidates_hist, 'b').tolist()
+        if arr is not None:
+            result['occupancy_hist'] = Telemetry.occupancy_hist(arr).tolist()
+        return result
+
+    def flush(self, arr=None, file=None, **extra):
+        """
+        Write the summary as a single line 'TELEMETRY <json>' and reset the counters
+        :param file: default sys.stdout, which is the batch log during run_sim
+        :return: the summary
+        """
+        result = self.summary(arr, **extra)
+        print("\n" + Telemetry.prefix + json.dumps(result), file=sys.stdout if file is None else file, flush=True)
+        self.reset()
+        return result
+
+    @staticmethod
+    def parse(log_path):
+        """
+        :return: list of the summaries written by flush to the log in log_path, for example output_dir/batch
+        """
+        summaries = []
+        with open(log_path) as f:
+            for line in f:
+                k = line.find(Telemetry.prefix)
+                if k >= 0:
+                    summaries.append(json.loads(line[k + len(Telemetry.prefix):]))
+        return summaries
@@ -1,12 +1,17 @@
 from run_functions import *
 import matplotlib.pyplot as plt
 
+h, N, rho_H = 0.8, 900, 0.8
 t, d, r = [], [], []
 for iterations in [200, 400, 600]:
 # iterations = 500
+    engine = ECMCEngine(square_initial_arr(h, N, rho_H), *ECMCEngine.default_total_steps(N, h, rho_H))
+    realizations, displacements = [0], [0]
     initial_time = time.time()
-    realizations, displacements = run_square(0.8, 900, 0.8, record_displacements=True, iterations=iterations,
-                                                write=False)
+    while engine.chains < iterations:
+        engine.run(min(10, iterations - engine.chains))
+        realizations.append(engine.chains)
+        displacements.append(engine.events)
     t.append(time.time() - initial_time)
     d.append(displacements[-1])
     r.append(realizations[-1])
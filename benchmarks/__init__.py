@@ -0,0 +1,4 @@
+"""
+Benchmarks of the ECMC engine, run from the repository root with python -m benchmarks
+"""
+from benchmarks.engine import run_benchmarks, compare_to_baseline, benchmark_names
@@ -0,0 +1,39 @@
+import argparse
+import json
+import sys
+
+from benchmarks.engine import run_benchmarks, compare_to_baseline, benchmark_names, sizes
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Time the ECMC engine and compare to a stored baseline. Writes the "
+                                                 "report as JSON and exits with 1 if there are regressions.")
+    parser.add_argument('--benchmarks', nargs='+', default=benchmark_names, choices=benchmark_names)
+    parser.add_argument('--N', nargs='+', type=int, default=sizes)
+    parser.add_argument('--configurations', nargs='+', default=['0.8,0.5', '0.8,0.8', '1.0,0.8'],
+                        help="h,rhoH pairs")
+    parser.add_argument('--backends', nargs='+', default=['python', 'array'], choices=['python', 'array', 'numba'])
+    parser.add_argument('--seconds', type=float, default=2.0, help="time budget of every measurement")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--no-memory', action='store_true', help="skip the tracemalloc peak memory measurement")
+    parser.add_argument('--output', default='benchmark_results.json')
+    parser.add_argument('--baseline', default=None, help="JSON report to compare to")
+    parser.add_argument('--tolerance', type=float, default=0.2, help="allowed relative slow down or memory growth")
+    parser.add_argument('--save-baseline', default=None, help="also write the report as a new baseline to this path")
+    args = parser.parse_args()
+
+    configurations = [tuple(float(x) for x in c.split(',')) for c in args.configurations]
+    report = run_benchmarks(args.benchmarks, args.N, configurations, args.backends, seconds=args.seconds,
+                            seed=args.seed, memory=not args.no_memory, log=sys.stderr)
+    exit_code = 0
+    if args.baseline is not None:
+        with open(args.baseline) as f:
+            regressions = compare_to_baseline(report, json.load(f), tolerance=args.tolerance)
+        report['baseline'] = {'path': args.baseline, 'tolerance': args.tolerance, 'regressions': regressions}
+        for regression in regressions:
+            print("Regression: " + json.dumps(regression), file=sys.stderr)
+        exit_code = 1 if len(regressions) > 0 else 0
+    for path in [args.output, args.save_baseline]:
+        if path is not None:
+            with open(path, 'w') as f:
+                json.dump(report, f, indent=2)
+    sys.exit(exit_code)
@@ -0,0 +1,252 @@
+import contextlib
+import gc
+import io
+import json
+import platform
+import random
+import time
+import tracemalloc
+
+from run_functions import *
+
+sizes = [100, 900, 10 ** 4, 9 * 10 ** 4]
+configurations = [(0.8, 0.5), (0.8, 0.8), (1.0, 0.8)]  # (h, rhoH)
+benchmark_names = ['dist_to_collision', 'perform_total_step', 'legal_configuration', 'append_sphere', 'run_sim']
+
+
+def _timed(call, seconds, min_calls=1):
+    """
+    Call call() until seconds passed and at least min_calls were made
+    :return: (number of calls, total time, list of the returned values)
+    """
+    returns = []
+    initial_time = time.perf_counter()
+    elapsed = 0.0
+    while len(returns) < min_calls or elapsed < seconds:
+        returns.append(call())
+        elapsed = time.perf_counter() - initial_time
+    return len(returns), elapsed, returns
+
+
+def _peak_memory(call, memory=True):
+    """
+    :return: peak memory in bytes allocated by python and numpy during one call(), as traced by tracemalloc. None
+    without calling if memory is False.
+    """
+    if not memory:
+        return None
+    tracemalloc.start()
+    try:
+        call()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def _allocations(call, calls=200, memory=True):
+    """
+    :return: mean over calls calls of call() of the peak memory allocated during the call above the memory in use
+    before it, as traced by tracemalloc, and the mean number of garbage collections triggered by a call. (None, None)
+    without calling if memory is False.
+    """
+    if not memory:
+        return None, None
+    transient = 0
+    collections = sum(s['collections'] for s in gc.get_stats())
+    tracemalloc.start()
+    try:
+        for _ in range(calls):
+            tracemalloc.reset_peak()
+            before = tracemalloc.get_traced_memory()[0]
+            call()
+            transient += tracemalloc.get_traced_memory()[1] - before
+    finally:
+        tracemalloc.stop()
+    return transient / calls, (sum(s['collections'] for s in gc.get_stats()) - collections) / calls
+
+
+def _initial_arr(N, h, rho_H, backend, seed):
+    random.seed(seed)
+    np.random.seed(seed)
+    arr = square_initial_arr(h, N, rho_H)
+    return arr if backend == 'python' else ArrayEvent2DCells.from_cells(arr)
+
+
+def _random_step(arr, backend, xy_total_step, z_total_step, step=None):
+    """
+    Draw a step as in the main loop of run_sim
+    :param step: Step to reset, None for a new one
+    :return: i, j of the cell of the sphere and the step
+    """
+    if backend == 'python':
+        sphere = arr.all_spheres[random.randint(0, len(arr.all_spheres) - 1)]
+        i, j = arr.cell_of_sphere(sphere).ind[:2]
+    else:
+        sphere = random.randint(0, arr.n_spheres - 1)
+        i, j = arr.cell_of_sphere(sphere)
+    step = Step(None, 0.0, Direction.directions()[0], arr.boundaries) if step is None else step
+    direction = Direction.directions()[random.randint(0, 3)]
+    return i, j, step.reset(sphere, xy_total_step if direction.dim != 2 else z_total_step, direction, arr.boundaries)
+
+
+def bench_dist_to_collision(N, h, rho_H, backend, seconds, seed, memory=True):
+    arr = _initial_arr(N, h, rho_H, 'python', seed)
+    xy_total_step, z_total_step = ECMCEngine.default_total_steps(N, h, rho_H)
+    cases = []
+    for _ in range(100):
+        i, j, step = _random_step(arr, 'python', xy_total_step, z_total_step)
+        # the sphere itself and its ghosts in the halo are not candidates
+        others = [s for c in arr.marching_cells(i, j, step, bands=1)[0] for s in c.spheres if
+                  getattr(s, 'sphere', s) is not step.sphere]
+        cases.append((step.sphere, others, step.total_step, step.direction))
+
+    def call():
+        for sphere, others, total_step, direction in cases:
+            Metric.dist_to_collision(sphere, others, total_step, direction, None)
+
+    calls, elapsed, _ = _timed(call, seconds)
+    return {'calls': calls * len(cases), 'seconds': elapsed, 'calls_per_sec': calls * len(cases) / elapsed,
+            'peak_memory_bytes': _peak_memory(call, memory)}
+
+
+def bench_perform_total_step(N, h, rho_H, backend, seconds, seed, memory=True):
+    """
+    Chains of random spheres and directions, as run_sim. The 'array' backend, ArrayEvent2DCells without the compiled
+    kernel, is expected to be 1.3 to 2 times slower than 'python': its numpy calls on the few candidates of an event
+    cost more than the loops of Event2DCells. It is kept as the reference the kernel is checked against, and
+    select_backend falls back to 'python' without numba.
+    """
+    arr = _initial_arr(N, h, rho_H, backend, seed)
+    if backend != 'python':
+        arr.jit = backend == 'numba'
+    xy_total_step, z_total_step = ECMCEngine.default_total_steps(N, h, rho_H)
+    step = Step(None, 0.0, Direction.directions()[0], arr.boundaries)  # reused as in run_sim
+
+    def call():
+        i, j, _ = _random_step(arr, backend, xy_total_step, z_total_step, step)
+        return arr.perform_total_step(i, j, step, record_displacements=True)
+
+    call()  # compiles the kernel for numba
+    chains, elapsed, displacements = _timed(call, seconds)
+    chain_peak_bytes, gc_collections_per_chain = _allocations(call, memory=memory)
+    return {'calls': chains, 'seconds': elapsed, 'calls_per_sec': chains / elapsed,
+            'displacements_per_sec': sum(displacements) / elapsed, 'events_per_chain': sum(displacements) / chains,
+            'peak_memory_bytes': _peak_memory(call, memory), 'chain_peak_bytes': chain_peak_bytes,
+            'gc_collections_per_chain': gc_collections_per_chain}
+
+
+def bench_legal_configuration(N, h, rho_H, backend, seconds, seed, memory=True):
+    arr = _initial_arr(N, h, rho_H, backend, seed)
+
+    def call():
+        assert arr.legal_configuration()
+
+    calls, elapsed, _ = _timed(call, seconds)
+    return {'calls': calls, 'seconds': elapsed, 'calls_per_sec': calls / elapsed,
+            'peak_memory_bytes': _peak_memory(call, memory)}
+
+
+def bench_append_sphere(N, h, rho_H, backend, seconds, seed, memory=True):
+    arr = _initial_arr(N, h, rho_H, 'python', seed)
+    centers = np.array(arr.all_centers)
+    rad = arr.all_spheres[0].rad
+
+    def call():
+        if backend == 'python':
+            new_arr = Event2DCells(edge=arr.edge, n_rows=arr.n_rows, n_columns=arr.n_columns, l_z=arr.l_z,
+                                   edge_y=arr.edge_y)
+            new_arr.append_sphere([Sphere(tuple(c), rad) for c in centers])
+        else:
+            new_arr = ArrayEvent2DCells(edge=arr.edge, n_rows=arr.n_rows, n_columns=arr.n_columns, l_z=arr.l_z,
+                                        rad=rad, edge_y=arr.edge_y)
+            new_arr.append_sphere(centers)
+
+    calls, elapsed, _ = _timed(call, seconds)
+    return {'calls': calls, 'seconds': elapsed, 'calls_per_sec': calls / elapsed,
+            'spheres_per_sec': calls * N / elapsed, 'peak_memory_bytes': _peak_memory(call, memory)}
+
+
+def bench_run_sim(N, h, rho_H, backend, seconds, seed, memory=True, iterations=None):
+    """
+    :param iterations: chains of the run, by default as many as perform_total_step does in seconds
+    """
+    if iterations is None:
+        iterations = bench_perform_total_step(N, h, rho_H, backend, seconds, seed, memory=False)['calls']
+
+    def call(arr):
+        with contextlib.redirect_stdout(io.StringIO()):
+            return run_sim(arr, N, h, rho_H, 'benchmark', iterations=iterations, record_displacements=True,
+                           write=False, backend=backend)
+
+    arr = _initial_arr(N, h, rho_H, 'python', seed)
+    initial_time = time.perf_counter()
+    realizations, displacements = call(arr)
+    elapsed = time.perf_counter() - initial_time
+    arr = _initial_arr(N, h, rho_H, 'python', seed)
+    return {'calls': iterations, 'seconds': elapsed, 'calls_per_sec': iterations / elapsed,
+            'displacements_per_sec': displacements[-1] / elapsed, 'events_per_chain': displacements[-1] / iterations,
+            'peak_memory_bytes': _peak_memory(lambda: call(arr), memory)}
+
+
+def run_benchmarks(names=None, sizes=sizes, configurations=configurations, backends=('python', 'array'), seconds=2.0,
+                   seed=0, memory=True, log=None):
+    """
+    Run every benchmark for every N, (h, rhoH) and backend
+    :param names: benchmarks to run out of benchmark_names, None for all
+    :param seconds: time budget of every measurement
+    :param memory: measure peak memory with tracemalloc, in separate calls which are not timed, and for
+    perform_total_step also the transient memory and the garbage collections of a chain, see _allocations
+    :param log: file to print progress to, None for no progress
+    :return: dict with 'meta' describing the machine and 'results', a list of dicts with the benchmark, N, h, rho_H,
+    backend and the measurements
+    """
+    names = benchmark_names if names is None else names
+    results = []
+    for name in names:
+        for N in sizes:
+            for h, rho_H in configurations:
+                for backend in (['python'] if name == 'dist_to_collision' else backends):
+                    backend = select_backend(backend)
+                    result = {'benchmark': name, 'N': N, 'h': h, 'rho_H': rho_H, 'backend': backend}
+                    result.update(globals()['bench_' + name](N, h, rho_H, backend, seconds, seed, memory=memory))
+                    if not memory:
+                        for key in ['peak_memory_bytes', 'chain_peak_bytes', 'gc_collections_per_chain']:
+                            result.pop(key, None)
+                    results.append(result)
+                    if log is not None:
+                        print(json.dumps(result), file=log, flush=True)
+    meta = {'python': platform.python_version(), 'numpy': np.__version__, 'machine': platform.machine(),
+            'processor': platform.processor(), 'seconds': seconds, 'seed': seed, 'time': time.time()}
+    return {'meta': meta, 'results': results}
+
+
+def _key(result):
+    return result['benchmark'], result['N'], result['h'], result['rho_H'], result['backend']
+
+
+def compare_to_baseline(report, baseline, tolerance=0.2):
+    """
+    Compare rates and memory of report to baseline, both returned from run_benchmarks. A rate (calls_per_sec,
+    displacements_per_sec, spheres_per_sec) is a regression if it is lower than (1-tolerance) of the baseline, memory
+    (peak_memory_bytes, chain_peak_bytes) if it is higher than (1+tolerance) of the baseline. Results missing from the
+    baseline are skipped.
+    :return: list of dicts describing the regressions, empty if there are none
+    """
+    baseline_results = {_key(r): r for r in baseline['results']}
+    regressions = []
+    for result in report['results']:
+        base = baseline_results.get(_key(result))
+        if base is None:
+            continue
+        for metric in ['calls_per_sec', 'displacements_per_sec', 'spheres_per_sec', 'peak_memory_bytes',
+                       'chain_peak_bytes']:
+            if metric not in result or metric not in base:
+                continue
+            ratio = result[metric] / base[metric]
+            worse = ratio > 1 + tolerance if metric.endswith('_bytes') else ratio < 1 - tolerance
+            if worse:
+                regression = dict(zip(['benchmark', 'N', 'h', 'rho_H', 'backend'], _key(result)))
+                regression.update({'metric': metric, 'value': result[metric], 'baseline': base[metric],
+                                   'ratio': ratio})
+                regressions.append(regression)
+    return regressions
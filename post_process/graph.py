@@ -5,6 +5,7 @@ from scipy.spatial import Delaunay
 from sklearn.neighbors import kneighbors_graph, radius_neighbors_graph
 
 from EventChainActions import *
+from Profiling import profiled_region
 from bragg_structure import BraggStructure
 from order_parameter import OrderParameter
 from psi_mn import PsiMN
@@ -43,6 +44,7 @@ class Graph(OrderParameter):
         return os.path.join(self.graph_father_path,
                             "frustration_" + self.direc_str + "_" + str(self.spheres_ind) + ".txt")
 
+    @profiled_region('graph build')
     def calc_graph(self):
         if not os.path.exists(self.graph_father_path):
             os.mkdir(self.graph_father_path)
@@ -2,6 +2,7 @@ import sys
 import time
 
 from SnapShot import *
+from Profiling import profiled_region
 from graph import Graph
 from order_parameter import OrderParameter
 
@@ -27,7 +28,7 @@ class Ising(Graph):
                     if mat.shape[0] >= maxmatlen:
                         maxreal = r
                         maxmatlen = mat.shape[0]
-                self.update_centers(np.loadtxt(os.path.join(self.sim_path, str(maxreal))), maxreal)
+                self.update_centers(self.write_or_load.load_spheres(maxreal), maxreal)
         self.z_spins = [(1 if p[2] > self.l_z / 2 else -1) for p in self.spheres]
         self.J = J
 
@@ -70,6 +71,7 @@ class Ising(Graph):
         if u <= A:
             self.op_vec[i] *= -1
 
+    @profiled_region('anneal')
     def anneal(self, iterations, dJditer=None, diter_save=1):
         J, E, M = [], [], []
 
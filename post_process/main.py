@@ -1,6 +1,7 @@
 import sys
 from datetime import date
 
+from Profiling import Profiler, profile_requested
 from SnapShot import *
 from bragg_structure import BraggStructure
 from burger_field import BurgerField
@@ -25,6 +26,12 @@ def main(sim_name, calc_type):
     op_dir = os.path.join(sim_path, "OP")
     log = os.path.join(op_dir, "log")
     sys.stdout = open(log, "a")
+    # --profile after calc_type or ECMC_PROFILE=1 writes profile_<calc_type>.pstats and its summary next to log
+    with Profiler(op_dir, 'profile_' + calc_type, enable=profile_requested()):
+        calc(sim_path, calc_type, correlation_kwargs)
+
+
+def calc(sim_path, calc_type, correlation_kwargs):
     if calc_type.endswith("23"):
         m, n = 2, 3
     if calc_type.endswith("14"):
@@ -67,7 +74,7 @@ def main(sim_name, calc_type):
                 op.write(write_correlations=True, write_vec=False)
             else:
                 real = re.split('(_|real=)', calc_type)[-3]
-                centers = np.loadtxt(os.path.join(op.sim_path, str(real)))
+                centers = op.write_or_load.load_spheres(int(real))
                 op.update_centers(centers, real)
                 op.correlation(**correlation_kwargs)
                 op.write(write_correlations=True, write_vec=False)
@@ -1,6 +1,7 @@
 import time
 
 from SnapShot import *
+from Profiling import profiled_region
 
 epsilon = 1e-8
 day = 86400  # sec
@@ -60,6 +61,7 @@ class OrderParameter:
         """to be override by child class"""
         pass
 
+    @profiled_region('correlation')
     def correlation(self, bin_width=0.1, calc_upper_lower=False, low_memory=True, randomize=False,
                     realizations=int(1e7), time_limit=2 * day):
         if self.op_vec is None: self.calc_order_parameter()
@@ -178,10 +180,7 @@ class OrderParameter:
         while time.time() - init_time < 2 * day and i < len(realizations):
             print(f"Iteration {i} / {len(realizations)}")
             sp_ind = realizations[i]
-            if sp_ind != 0:
-                centers = np.loadtxt(os.path.join(self.sim_path, str(sp_ind)))
-            else:
-                centers = np.loadtxt(os.path.join(self.sim_path, 'Initial Conditions'))
+            centers = self.write_or_load.load_spheres(sp_ind)
             self.update_centers(centers, sp_ind)
             if calc_vec:
                 self.read_or_calc_write()
@@ -1,7 +1,14 @@
 #!/Local/ph_daniel/anaconda3/bin/python -u
+import signal
 import sys
 from EventChainActions import *
-from SnapShot import WriteOrLoad
+from EventChainKernel import select_backend, jit_available
+from OrderParameterMonitor import OrderParameterMonitor
+from Profiling import Profiler, profile_requested
+from ParallelECMC import ParallelECMC
+from PressureEstimator import PressureEstimator
+from SnapShot import WriteOrLoad, TimeSeriesRecorder
+from Telemetry import Telemetry
 from deploy_simulations_on_HTCondor.send_parametric_runs import *
 
 epsilon = 1e-8
@@ -19,27 +26,34 @@ def run_honeycomb(h, N, rho_H, **kwargs):
         return run_sim(np.nan, N, h, rho_H, sim_name, **kwargs)
         # when continuing from restart there shouldn't be use of initial arr
     else:
-        n_row = int(np.sqrt(N))
-        n_col = n_row
-        r = 1
-        sig = 2 * r
-        # build input parameters for cells
-        a_dest = sig * np.sqrt(2 / (rho_H * (1 + h) * np.sin(np.pi / 3)))
-        l_y_dest = a_dest * n_row / 2 * np.sin(np.pi / 3)
-        e = a_dest
-        n_col_cells = n_col
-        n_row_cells = int(round(l_y_dest / e))
-        l_x = n_col_cells * e
-        l_y = n_row_cells * e
-        a = np.sqrt(l_x * l_y / N)
-        rho_H_new = (sig ** 2) / ((a ** 2) * (h + 1))
+        initial_arr = honeycomb_initial_arr(h, N, rho_H)
+        return run_sim(initial_arr, N, h, rho_H, sim_name, **kwargs)
 
-        initial_arr = Event2DCells(edge=e, n_rows=n_row_cells, n_columns=n_col_cells, l_z=(h + 1) * sig)
-        initial_arr.generate_spheres_in_AF_triangular_structure(n_row, n_col, r)
-        initial_arr.scale_xy(np.sqrt(rho_H_new / rho_H))
-        assert initial_arr.edge > sig
 
-        return run_sim(initial_arr, N, h, rho_H, sim_name, **kwargs)
+def honeycomb_initial_arr(h, N, rho_H):
+    """
+    :return: Event2DCells with N spheres in the AF triangular initial condition
+    """
+    n_row = int(np.sqrt(N))
+    n_col = n_row
+    r = 1
+    sig = 2 * r
+    # build input parameters for cells
+    a_dest = sig * np.sqrt(2 / (rho_H * (1 + h) * np.sin(np.pi / 3)))
+    l_y_dest = a_dest * n_row / 2 * np.sin(np.pi / 3)
+    e = a_dest
+    n_col_cells = n_col
+    n_row_cells = int(round(l_y_dest / e))
+    l_x = n_col_cells * e
+    l_y = n_row_cells * e
+    a = np.sqrt(l_x * l_y / N)
+    rho_H_new = (sig ** 2) / ((a ** 2) * (h + 1))
+
+    initial_arr = Event2DCells(edge=e, n_rows=n_row_cells, n_columns=n_col_cells, l_z=(h + 1) * sig)
+    initial_arr.generate_spheres_in_AF_triangular_structure(n_row, n_col, r)
+    initial_arr.scale_xy(np.sqrt(rho_H_new / rho_H))
+    assert initial_arr.edge > sig
+    return initial_arr
 
 
 def run_square(h, N, rho_H, **kwargs):
@@ -50,21 +64,32 @@ def run_square(h, N, rho_H, **kwargs):
         return run_sim(np.nan, N, h, rho_H, sim_name, **kwargs)
         # when continuing from restart there shouldn't be use of initial arr
     else:
-        n_row = int(np.sqrt(N))
-        n_col = n_row  # Square initial condition for n_row!=n_col is not implemented...
-        r, sig = 1.0, 2.0
-        A = N * sig ** 2 / (rho_H * (1 + h))
-        a = np.sqrt(A / N)
-        n_row_cells, n_col_cells = int(np.sqrt(A) / (a * np.sqrt(2))), int(np.sqrt(A) / (a * np.sqrt(2)))
-        e = np.sqrt(A / (n_row_cells * n_col_cells))
-        assert e > sig, "Edge of cell is: " + str(e) + ", which is smaller than sigma."
-        initial_arr = Event2DCells(edge=e, n_rows=n_row_cells, n_columns=n_col_cells, l_z=(h + 1) * sig)
-        initial_arr.generate_spheres_in_AF_square(n_row, n_col, r)
-
+        initial_arr = square_initial_arr(h, N, rho_H)
         return run_sim(initial_arr, N, h, rho_H, sim_name, **kwargs)
 
 
-def run_z_quench(origin_sim, desired_h):
+def square_initial_arr(h, N, rho_H):
+    """
+    :return: Event2DCells with N spheres in the AF square initial condition
+    """
+    n_row = int(np.sqrt(N))
+    n_col = n_row  # Square initial condition for n_row!=n_col is not implemented...
+    r, sig = 1.0, 2.0
+    A = N * sig ** 2 / (rho_H * (1 + h))
+    a = np.sqrt(A / N)
+    n_row_cells, n_col_cells = int(np.sqrt(A) / (a * np.sqrt(2))), int(np.sqrt(A) / (a * np.sqrt(2)))
+    e = np.sqrt(A / (n_row_cells * n_col_cells))
+    assert e > sig, "Edge of cell is: " + str(e) + ", which is smaller than sigma."
+    initial_arr = Event2DCells(edge=e, n_rows=n_row_cells, n_columns=n_col_cells, l_z=(h + 1) * sig)
+    initial_arr.generate_spheres_in_AF_square(n_row, n_col, r)
+    return initial_arr
+
+
+def run_z_quench(origin_sim, desired_h, max_seconds=3600):
+    """
+    Start a simulation at height desired_h from the last configuration of origin_sim, lowering the walls with compress
+    :param max_seconds: time limit of the compression
+    """
     physical_info = re.split('[=_]', origin_sim)
     N, h, rho_H = int(physical_info[1]), float(physical_info[3]), float(physical_info[5])
     desired_rho = rho_H * (h + 1) / (desired_h + 1)
@@ -77,26 +102,28 @@ def run_z_quench(origin_sim, desired_h):
     origin_sim_path = prefix + origin_sim
     orig_sim_files_interface = WriteOrLoad(origin_sim_path, boundaries=[])
     l_x, l_y, l_z, rad, _, edge, n_row, n_col = orig_sim_files_interface.load_Input()
+    edge_y = orig_sim_files_interface.load_edge_y()
 
-    if (edge * n_row != l_y or edge * n_col != l_x) and (
-            np.abs(edge * n_row - l_y) < epsilon and np.abs(edge * n_col - l_x) < epsilon):
-        l_x, l_y = edge * n_col, edge * n_row
-    assert n_col * edge == l_x and n_row * edge == l_y, \
+    if (edge_y * n_row != l_y or edge * n_col != l_x) and (
+            np.abs(edge_y * n_row - l_y) < epsilon and np.abs(edge * n_col - l_x) < epsilon):
+        l_x, l_y = edge * n_col, edge_y * n_row
+    assert n_col * edge == l_x and n_row * edge_y == l_y, \
         "Did not recover consistence system size and cells size.\n Chosen parameters are:\n" \
-        + "edge=" + str(edge) + "\nn_row=" + str(n_row) + "\nn_col=" + str(
+        + "edge=" + str(edge) + "\nedge_y=" + str(edge_y) + "\nn_row=" + str(n_row) + "\nn_col=" + str(
             n_col) + "\nWhile system size is:\nl_x=" + str(l_x) + "\nl_y=" + str(l_y)
 
-    initial_arr = Event2DCells(edge=edge, n_rows=n_row, n_columns=n_col, l_z=l_z)
+    initial_arr = Event2DCells(edge=edge, n_rows=n_row, n_columns=n_col, l_z=l_z, edge_y=edge_y)
     initial_arr.boundaries = [l_x, l_y, l_z]
     centers, ind = orig_sim_files_interface.last_spheres()
-    assert initial_arr.edge > 2 * rad
+    assert min(initial_arr.edge, initial_arr.edge_y) > 2 * rad
     initial_arr.append_sphere([Sphere(c, rad) for c in centers])
     initial_arr.update_all_spheres()
     assert initial_arr.legal_configuration()
     assert len(initial_arr.all_spheres) == N, "Some spheres are missing. number of spheres added: " + str(
         len(initial_arr.all_spheres))
     try:
-        initial_arr.z_quench((desired_h + 1) * (2 * rad))
+        assert compress(initial_arr, desired_lz=(desired_h + 1) * (2 * rad), max_seconds=max_seconds, log=sys.stdout), \
+            "zQuench did not reach h=" + str(desired_h) + " in " + str(max_seconds) + " seconds"
     except:
         orig_sim_files_interface.boundaries = initial_arr.boundaries
         orig_sim_files_interface.dump_spheres(initial_arr.all_centers, 'z_quench_failed_lz=' + str(initial_arr.l_z))
@@ -130,45 +157,219 @@ def run_triangle(h, N, rho_H, **kwargs):
         return run_sim(initial_arr, N, h, rho_H, sim_name, **kwargs)
 
 
-def run_sim(initial_arr, N, h, rho_H, sim_name, iterations=None, record_displacements=False, write=True):
+def tune_total_steps(arr, xy_candidates, z_candidates, chains):
+    """
+    Run chains chains for every candidate total step, xy candidates with x and y directions and z candidates with +z and
+    -z directions, and choose the candidates that decorrelate the configuration fastest per CPU second. The
+    decorrelation proxy is the mean square displacement of the spheres (minimal image in xy) per second.
+    The configuration keeps evolving during tuning, which is valid sampling but is not counted as iterations.
+    :type arr: Event2DCells or ArrayEvent2DCells
+    :return: best xy total step, best z total step and a list of (direction, candidate, displacements per sec,
+    msd per sec) for all the candidates
+    """
+    l = np.array(arr.boundaries[:2])
+    results = []
+    engine = ECMCEngine(arr, None, None)
+    for dims, candidates in [((0, 1), xy_candidates), ((2, 3), z_candidates)]:
+        for total_step in candidates:
+            engine.total_steps = [total_step] * 4
+            engine.run(1, directions=dims)  # not measured, it might include compilation of the kernel
+            before = np.array(arr.all_centers, dtype=float)
+            init_time = time.time()
+            displacements = engine.run(chains, directions=dims)
+            elapsed = max(time.time() - init_time, epsilon)
+            dr = np.array(arr.all_centers, dtype=float) - before
+            dr[:, :2] = (dr[:, :2] + l / 2) % l - l / 2
+            msd = np.mean(np.sum(dr[:, :2] ** 2, axis=1)) if dims[0] == 0 else np.mean(dr[:, 2] ** 2)
+            results.append(('xy' if dims[0] == 0 else 'z', total_step, displacements / elapsed, msd / elapsed))
+    best_xy = max([r for r in results if r[0] == 'xy'], key=lambda r: r[3])[1]
+    best_z = max([r for r in results if r[0] == 'z'], key=lambda r: r[3])[1]
+    return best_xy, best_z, results
+
+
+def tune_cell_edges(arr, chains, xy_total_step, z_total_step, edge_multipliers=(1.05, 1.25, 1.5, 2, 2.5, 3)):
+    """
+    Choose the cells of arr by coordinate search, first the number of columns and then the number of rows, among the
+    grids whose x (y) edge is about edge_multipliers times sigma. Every candidate grid runs chains chains and the one
+    that scans the fewest candidate spheres per chain is kept. The cost is per chain and not per event, so grids that
+    need more events or march over more cells per event are not favoured.
+    The configuration keeps evolving during tuning, which is valid sampling but is not counted as iterations.
+    :type arr: Event2DCells or ArrayEvent2DCells
+    :return: best n_rows, best n_columns and a list of (n_rows, n_columns, edge, edge_y, candidates per event, events
+    per chain, candidates per chain) for all the candidates. arr is regridded to the best grid.
+    """
+    is_array = isinstance(arr, ArrayEvent2DCells)
+    sig = 2 * (arr.rad if is_array else arr.all_spheres[0].rad)
+    telemetry = Telemetry()
+    engine = ECMCEngine(arr, xy_total_step, z_total_step, telemetry=telemetry)
+    results, measured = [], {}
+
+    def measure(n_rows, n_columns):
+        if (n_rows, n_columns) in measured:
+            return measured[(n_rows, n_columns)]
+        arr.regrid(n_rows, n_columns)
+        telemetry.reset()
+        engine.run(chains)
+        events = int(np.sum(telemetry.event_counts))
+        cost = telemetry.candidates / chains
+        results.append((n_rows, n_columns, arr.edge, arr.edge_y, telemetry.candidates / max(events, 1),
+                        events / chains, cost))
+        measured[(n_rows, n_columns)] = cost
+        return cost
+
+    def options(l, current):
+        n = {max(1, int(l / (m * (sig + 100 * epsilon)))) for m in edge_multipliers}
+        return sorted(n | {current})
+
+    best_rows, best_columns = arr.n_rows, arr.n_columns
+    best_columns = min(options(arr.l_x, best_columns), key=lambda n: measure(best_rows, n))
+    best_rows = min(options(arr.l_y, best_rows), key=lambda n: measure(n, best_columns))
+    arr.regrid(best_rows, best_columns)
+    return best_rows, best_columns, results
+
+
+def run_sim(initial_arr, N, h, rho_H, sim_name, iterations=None, record_displacements=False, write=True,
+            backend='python', replicas=1, seed=None, workers=1, sweep_chains=1000, tune_steps=False, tune_chains=None,
+            checkpoint_iterations=None, checkpoint_time=3600, record_sweeps=None, record_keep_every=10, record_ring=100,
+            monitor_chains=None, telemetry_chains=None, pressure_chains=None, tune_cells=False, heat_bath_ratio=0.0):
+    """
+    The chains run in batches of an ECMCEngine, up to the next output, checkpoint or percent of progress, of about a
+    second each.
+    :param record_displacements: return (and write to output_dir/Displacement) the realizations at the end of every
+    chain, of every sweep if workers>1, and the number of events up to them. The chains then run one per batch.
+    :param backend: 'python' runs on Event2DCells, 'array' on ArrayEvent2DCells and 'numba' on ArrayEvent2DCells with
+    the compiled chain kernel (falls back to 'python' when numba is not installed, see select_backend). Without the
+    kernel ArrayEvent2DCells is slower than Event2DCells.
+    :param replicas: if >1 run an ensemble of independent replicas in this process, see run_ensemble. Only iterations,
+    write, backend, seed and the checkpoint intervals apply to ensembles, the other options raise ValueError.
+    :param seed: seed of the replicas or of the workers random streams, used only if replicas>1 or workers>1
+    :param workers: if >1 run the domain decomposed ParallelECMC on ArrayEvent2DCells over workers processes, requires
+    numba
+    :param sweep_chains: chains per worker in every parallel sweep, used only if workers>1
+    :param tune_steps: choose xy_total_step and z_total_step by tune_total_steps before the run, and save them in the
+    Input parameters so continuing runs use them too
+    :param tune_chains: chains per tuning candidate, default N/10 and at least 100
+    :param checkpoint_iterations: save a checkpoint every checkpoint_iterations chains, None for no iteration interval
+    :param checkpoint_time: save a checkpoint every checkpoint_time seconds, None for no time interval. A checkpoint is
+    also saved at the end of the run and when the job gets SIGTERM, and continuing runs start from it.
+    :param record_sweeps: record a configuration every record_sweeps sweeps (record_sweeps*N chains) with a
+    TimeSeriesRecorder, None for only the final configuration
+    :param record_keep_every: every record_keep_every-th recorded configuration is kept in the trajectory
+    :param record_ring: number of latest recorded configurations kept in the ring buffer
+    :param monitor_chains: log the order parameters of OrderParameterMonitor to output_dir/monitors every
+    monitor_chains chains, None for no monitoring
+    :param telemetry_chains: count events, candidates, chain lengths and times with a Telemetry, and flush its summary
+    to the batch log every telemetry_chains chains, None for no telemetry. Not counted in parallel sweeps.
+    :param pressure_chains: estimate the pressure from the chains with a PressureEstimator, in blocks of
+    pressure_chains chains written to output_dir/pressure, None for no estimate. Not estimated in parallel sweeps.
+    :param tune_cells: choose the x and y edges of the cells by tune_cell_edges before a new run, with tune_chains
+    chains per candidate grid, and save them in the Input parameters
+    :param heat_bath_ratio: heat bath z moves (Event2DCells.resample_z) per chain, mixed with the chains by the
+    ECMCEngine and not counted as iterations, 0 for none. Not performed in parallel sweeps.
+    """
+    if replicas > 1:
+        unsupported = {'record_displacements': record_displacements, 'workers': workers > 1, 'tune_steps': tune_steps,
+                       'tune_chains': tune_chains is not None, 'tune_cells': tune_cells,
+                       'record_sweeps': record_sweeps is not None, 'monitor_chains': monitor_chains is not None,
+                       'telemetry_chains': telemetry_chains is not None, 'pressure_chains': pressure_chains is not None,
+                       'heat_bath_ratio': heat_bath_ratio > 0}
+        if any(unsupported.values()):
+            raise ValueError("Not supported with replicas>1: " + ", ".join(k for k, v in unsupported.items() if v))
+        return run_ensemble(initial_arr, N, h, rho_H, sim_name, replicas, iterations=iterations, write=write,
+                            backend=backend, seed=seed, checkpoint_iterations=checkpoint_iterations,
+                            checkpoint_time=checkpoint_time)
     if iterations is None:
         iterations = int(N * 1e4)
+    if workers > 1 and not jit_available:
+        raise ValueError("workers > 1 runs ParallelECMC in the compiled kernel, which requires numba")
+    backend = select_backend(backend, array=workers > 1)
     rad = 1
-    a_free = (1 / rho_H - np.pi / 6) ** (1 / 3) * 2 * rad  # ((V-N*4/3*pi*r^3)/N)^(1/3)
-    xy_total_step = a_free * np.sqrt(N)
-    z_total_step = h * (2 * rad) * np.pi / 15  # irrational for the spheres to cover most of the z options
+    xy_total_step, z_total_step = ECMCEngine.default_total_steps(N, h, rho_H, rad)
     # Initialize View and folder, add spheres
     code_dir = os.getcwd()
-    output_dir = os.path.join(prefix, sim_name)
+    output_dir = os.path.abspath(os.path.join(prefix, sim_name))  # absolute, the run changes directory into it
     batch = os.path.join(output_dir, 'batch')
+    parallel_rng_state = None
     if os.path.exists(output_dir) and write:
         files_interface = WriteOrLoad(output_dir, np.nan)
         l_x, l_y, l_z, rad, rho_H, edge, n_row, n_col = files_interface.load_Input()
+        edge_y = files_interface.load_edge_y()
         boundaries = [l_x, l_y, l_z]
         files_interface.boundaries = boundaries
-        last_centers, last_ind = files_interface.last_spheres()
-        sp = [Sphere(tuple(c), rad) for c in last_centers]
-        # construct array of cells and fill with spheres
-        arr = Event2DCells(edge=edge, n_rows=n_row, n_columns=n_col, l_z=l_z)
-        arr.append_sphere(sp)
-        arr.update_all_spheres()
         sys.stdout = open(batch, "a")
         print("\n-----------\nSimulation with same parameters exist already, continuing from last file.\n",
               file=sys.stdout)
+        last_centers, last_ind = files_interface.last_spheres()
+        # construct array of cells and fill with spheres
+        checkpoint_ind = files_interface.checkpoint_iteration()
+        # realizations are named by the chain count, older runs named their final frame by the chain count + 1
+        if checkpoint_ind >= 0 and checkpoint_ind + 1 >= last_ind:
+            arr, last_ind, rng_state = files_interface.load_checkpoint(backend)
+            if isinstance(rng_state, dict):  # the generator of ParallelECMC, restored once it is constructed
+                parallel_rng_state = rng_state
+            else:
+                random.setstate(rng_state)
+            print("Continuing from checkpoint of iteration " + str(last_ind), file=sys.stdout)
+        elif backend == 'python':
+            sp = [Sphere(tuple(c), rad) for c in last_centers]
+            arr = Event2DCells(edge=edge, n_rows=n_row, n_columns=n_col, l_z=l_z, edge_y=edge_y)
+            arr.append_sphere(sp)
+            arr.update_all_spheres()
+        else:
+            arr = ArrayEvent2DCells(edge=edge, n_rows=n_row, n_columns=n_col, l_z=l_z, rad=rad, edge_y=edge_y)
+            arr.append_sphere(last_centers)
     else:
-        arr = initial_arr
+        arr = initial_arr if backend == 'python' else ArrayEvent2DCells.from_cells(initial_arr)
         if write:
             files_interface = WriteOrLoad(output_dir, initial_arr.boundaries)
             os.mkdir(output_dir)
             sys.stdout = open(batch, "a")
             files_interface.dump_spheres(arr.all_centers, 'Initial Conditions')
-            files_interface.save_Input(arr.all_spheres[0].rad, rho_H, arr.edge, arr.n_rows, arr.n_columns)
+            files_interface.save_Input(initial_arr.all_spheres[0].rad, rho_H, arr.edge, arr.n_rows, arr.n_columns,
+                                       edge_y=arr.edge_y)
             os.chdir(output_dir)
         # print simulation description
         print("\n\nSimulation: N=" + str(N) + ", rhoH=" + str(rho_H) + ", h=" + str(h), file=sys.stdout)
         print("N_iterations=" + str(iterations) +
               ", Lx=" + str(initial_arr.l_x) + ", Ly=" + str(initial_arr.l_y), file=sys.stdout)
-        last_ind = 0  # count starts from 1 so 0 means non exist yet and the first one will be i+1=1
+        last_ind = 0  # realizations are named by the chain count, 0 is the initial conditions
+    if backend != 'python':
+        arr.jit = backend == 'numba'
+    print("Backend: " + backend, file=sys.stdout)
+    saved_total_steps = files_interface.load_total_steps() if write else None
+    if saved_total_steps is not None:
+        xy_total_step, z_total_step = saved_total_steps
+        print("Using total steps from Input parameters: xy_total_step=" + str(xy_total_step) + ", z_total_step=" +
+              str(z_total_step), file=sys.stdout)
+    elif tune_steps:
+        xy_candidates = [xy_total_step * f for f in [1 / 8, 1 / 4, 1 / 2, 1, 2]]
+        z_candidates = [z_total_step * f for f in [1 / 4, 1 / 2, 1, 2, 4]]
+        chains = tune_chains if tune_chains is not None else max(100, N // 10)
+        xy_total_step, z_total_step, results = tune_total_steps(arr, xy_candidates, z_candidates, chains)
+        print("Tuning total steps, " + str(chains) + " chains per candidate:", file=sys.stdout)
+        for direction, candidate, displacements_per_sec, msd_per_sec in results:
+            print("tune direction=" + direction + " total_step=" + str(candidate) + " displacements_per_sec=" + str(
+                displacements_per_sec) + " msd_per_sec=" + str(msd_per_sec), file=sys.stdout)
+        print("Tuned xy_total_step=" + str(xy_total_step) + ", z_total_step=" + str(z_total_step), file=sys.stdout)
+        if write:
+            files_interface.update_Input(xy_total_step=xy_total_step, z_total_step=z_total_step)
+    if tune_cells and last_ind == 0:
+        chains = tune_chains if tune_chains is not None else max(100, N // 10)
+        n_row, n_col, results = tune_cell_edges(arr, chains, xy_total_step, z_total_step)
+        print("Tuning cells, " + str(chains) + " chains per candidate:", file=sys.stdout)
+        for n_rows, n_columns, edge, edge_y, per_event, events, per_chain in results:
+            print("tune n_rows=" + str(n_rows) + " n_columns=" + str(n_columns) + " edge=" + str(edge) + " edge_y=" +
+                  str(edge_y) + " candidates_per_event=" + str(per_event) + " events_per_chain=" + str(events) +
+                  " candidates_per_chain=" + str(per_chain), file=sys.stdout)
+        print("Tuned n_rows=" + str(n_row) + ", n_columns=" + str(n_col), file=sys.stdout)
+        if write:
+            files_interface.update_Input(edge=arr.edge, edge_y=arr.edge_y, n_row=n_row, n_col=n_col)
+    parallel = None
+    if workers > 1:
+        parallel = ParallelECMC(arr, workers, xy_total_step, z_total_step, seed=seed)
+        if parallel_rng_state is not None:
+            parallel.rng.bit_generator.state = parallel_rng_state
+        print("Parallel ECMC over " + str(workers) + " workers", file=sys.stdout)
 
     # Run loops
     day = 86400  # seconds
@@ -179,39 +380,108 @@ def run_sim(initial_arr, N, h, rho_H, sim_name, iterations=None, record_displace
         displacements = [0]
         realizations = [i]
     initial_time = time.time()
-    while (time.time() - initial_time < 2 * day) and (i < iterations):
-        # Choose sphere
-        spheres = arr.all_spheres
-        sphere = spheres[random.randint(0, len(spheres) - 1)]
-        cell = arr.cell_of_sphere(sphere)
-        # Choose direction
-        direction = Direction.directions()[random.randint(0, 3)]  # x,y,+z,-z
-        # perform step
-        step = Step(sphere, xy_total_step if direction.dim != 2 else z_total_step, direction, arr.boundaries)
-        i_cell, j_cell = cell.ind[:2]
-        try:
-            if record_displacements:
-                displacements.append(
-                    displacements[-1] + arr.perform_total_step(i_cell, j_cell, step, record_displacements=True))
-                realizations.append(i + 1)
-            else:
-                arr.perform_total_step(i_cell, j_cell, step)
-        except Exception as err:
-            if write:
-                files_interface.dump_spheres(arr.all_centers, str(i + 1) + '_err')
-            raise err
-        if (i + 1) % (iterations / 100) == 0:
-            print(str(100 * (i + 1) / iterations) + "%", end=", ", file=sys.stdout)
-        i += 1
+    terminated = []
+    if write:
+        # the scheduler sends SIGTERM before killing the job, stop after the current batch, which is kept to about
+        # batch_seconds, and save a checkpoint
+        signal.signal(signal.SIGTERM, lambda signum, frame: terminated.append(signum))
+    last_checkpoint_i, last_checkpoint_time = i, initial_time
+    batch_seconds, max_batch = 1.0, 100  # max_batch follows the measured chains per second
+    recorder = None
+    if write and record_sweeps is not None:
+        recorder = TimeSeriesRecorder(files_interface, int(record_sweeps * N), keep_every=record_keep_every,
+                                      ring_size=record_ring)
+    monitor = OrderParameterMonitor(output_dir, N) if (write and monitor_chains is not None) else None
+    telemetry = None
+    if telemetry_chains is not None and parallel is None:
+        telemetry = Telemetry(N=N, h=h, rho_H=rho_H, backend=backend, phase='run_sim')
+    pressure = None
+    if pressure_chains is not None and parallel is None:
+        pressure = PressureEstimator(output_dir if write else None, N, pressure_chains)
+    engine = ECMCEngine(arr, xy_total_step, z_total_step, telemetry=telemetry, pressure=pressure,
+                        heat_bath_ratio=heat_bath_ratio)
+    if heat_bath_ratio > 0 and parallel is None:
+        print("Heat bath z moves per chain: " + str(heat_bath_ratio), file=sys.stdout)
+    while (time.time() - initial_time < 2 * day) and (i < iterations) and not terminated:
+        if write and ((checkpoint_iterations is not None and i - last_checkpoint_i >= checkpoint_iterations) or (
+                checkpoint_time is not None and time.time() - last_checkpoint_time >= checkpoint_time)):
+            assert arr.legal_configuration(sample=100), "Illegal configuration at iteration " + str(i)
+            files_interface.save_checkpoint(arr, i, random.getstate() if parallel is None else
+                                            parallel.rng.bit_generator.state)
+            last_checkpoint_i, last_checkpoint_time = i, time.time()
+        if parallel is not None:
+            n_chains = int(min(workers * sweep_chains, iterations - i))
+            parallel.sweep(n_chains)
+        else:
+            # a batch runs up to the next output, checkpoint or percent of progress, and at most a sweep and about
+            # batch_seconds so the time limits and signals are still checked often. The chains do not depend on where
+            # the batches end.
+            due = [iterations, i + N, ((100 * i // iterations + 1) * iterations + 99) // 100]
+            if recorder is not None:
+                due.append((i // recorder.interval + 1) * recorder.interval)
+            if monitor is not None:
+                due.append((i // monitor_chains + 1) * monitor_chains)
+            if telemetry is not None:
+                due.append((i // telemetry_chains + 1) * telemetry_chains)
+            if pressure is not None:
+                due.append(i + pressure.block_chains - pressure.chains)
+            if write and checkpoint_iterations is not None:
+                due.append(last_checkpoint_i + checkpoint_iterations)
+            n_chains = max(1, min(min(due) - i, max_batch))
+            if record_displacements:  # a row of the Displacement file for every chain
+                n_chains = 1
+            chains = engine.chains
+            batch_start = time.time()
+            try:
+                engine.run(n_chains)
+            except Exception as err:
+                if write:
+                    files_interface.dump_spheres(arr.all_centers, str(i + engine.chains - chains + 1) + '_err')
+                raise err
+            max_batch = max(1, int(batch_seconds * n_chains / max(time.time() - batch_start, 1e-6)))
+        if record_displacements:
+            displacements.append(parallel.events if parallel is not None else engine.events)
+            realizations.append(i + n_chains)
+        if int(100 * (i + n_chains) / iterations) > int(100 * i / iterations):
+            print(str(int(100 * (i + n_chains) / iterations)) + "%", end=", ", file=sys.stdout)
+        if recorder is not None and recorder.due(i, i + n_chains):
+            recorder.record(arr.all_centers, i + n_chains)
+        if monitor is not None and (i + n_chains) // monitor_chains > i // monitor_chains:
+            monitor.measure(arr, i + n_chains)
+        if telemetry is not None and (i + n_chains) // telemetry_chains > i // telemetry_chains:
+            telemetry.flush(arr, iteration=i + n_chains)
+        if pressure is not None and pressure.block_done():
+            pressure.flush(arr, iteration=i + n_chains)
+        i += n_chains
 
     # save
+    if recorder is not None:
+        recorder.close()
+    if telemetry is not None and telemetry.chains > 0:
+        telemetry.flush(arr, iteration=i)
+    if pressure is not None:
+        # the last partial block is dropped, all the blocks have the same length for the error bars
+        blocks = PressureEstimator.load(output_dir) if write else pressure.blocks
+        print("\nPressure: " + str(PressureEstimator.summary(blocks)), file=sys.stdout)
+    if parallel is not None:
+        parallel.close()
+        print("\nParallel events: " + str(parallel.events), file=sys.stdout)
     if record_displacements and write:
         np.savetxt(os.path.join(output_dir, 'Displacement'), np.array([realizations, displacements]).T)
     assert arr.legal_configuration()
     if write:
-        files_interface.dump_spheres(arr.all_centers, str(i + 1))
+        if i not in files_interface.trajectory_index()[:, 0]:  # the recorder may have kept this frame already
+            files_interface.append_frame(arr.all_centers, i)
+        files_interface.save_checkpoint(arr, i, random.getstate() if parallel is None else
+                                        parallel.rng.bit_generator.state)
+        if terminated:
+            print("\nTerminated by signal, checkpoint saved at iteration " + str(i), file=sys.stdout)
 
-    os.chdir(os.path.join(prefix, sim_name))
+    if not write:
+        if record_displacements:
+            return realizations, displacements
+        return
+    os.chdir(output_dir)
     if i >= iterations:
         if write:
             os.system('echo \'Finished ' + str(iterations) + ' iterations\' > FINAL_MESSAGE')
@@ -222,6 +492,230 @@ def run_sim(initial_arr, N, h, rho_H, sim_name, iterations=None, record_displace
         sys.exit(7)  # any !=0 number
 
 
+def run_ensemble(initial_arr, N, h, rho_H, sim_name, replicas, iterations=None, write=True, backend='array', seed=None,
+                 batch_size=1000, checkpoint_iterations=None, checkpoint_time=3600):
+    """
+    Advance R independent replicas of the same system together in one process, each with its own random stream spawned
+    from seed. Replica r is written to output_dir/replica_r, which has the same layout as a single simulation folder so
+    post processing can run on it directly. Replicas always run on ArrayEvent2DCells, backend 'python' means 'array'.
+    With the numba backend every turn of a replica is a single compiled batch, see ECMCEngine.run.
+    :param replicas: number of replicas R
+    :param seed: entropy for np.random.SeedSequence, None for fresh entropy
+    :param batch_size: number of chains a replica performs before the next replica takes over
+    :param checkpoint_iterations: save a checkpoint of a replica every checkpoint_iterations of its chains, None for no
+    iteration interval
+    :param checkpoint_time: save a checkpoint of all the replicas every checkpoint_time seconds, None for no time
+    interval. Checkpoints are also saved at the end of the run and when the job gets SIGTERM. They hold the state of the
+    random stream of the replica, so continuing runs go on with the stream instead of replaying it.
+    """
+    if iterations is None:
+        iterations = int(N * 1e4)
+    backend = select_backend(backend, array=True)
+    rad = 1
+    xy_total_step, z_total_step = ECMCEngine.default_total_steps(N, h, rho_H, rad)
+    output_dir = os.path.join(prefix, sim_name)
+    if write:
+        if not os.path.exists(output_dir):
+            os.mkdir(output_dir)
+        sys.stdout = open(os.path.join(output_dir, 'batch'), "a")
+    arrs, files_interfaces, streams = [], [], []
+    counters = np.zeros(replicas, dtype=int)
+    seed_sequences = np.random.SeedSequence(seed).spawn(replicas)
+    for r in range(replicas):
+        replica_dir = os.path.join(output_dir, 'replica_' + str(r))
+        stream = np.random.default_rng(seed_sequences[r])
+        if write and os.path.exists(replica_dir):
+            files_interface = WriteOrLoad(replica_dir, np.nan)
+            l_x, l_y, l_z, rad, _, edge, n_row, n_col = files_interface.load_Input()
+            files_interface.boundaries = [l_x, l_y, l_z]
+            last_ind = files_interface.realizations()[0]
+            checkpoint_ind = files_interface.checkpoint_iteration()
+            # realizations are named by the chain count, older runs named their final frame by the chain count + 1
+            if checkpoint_ind >= 0 and checkpoint_ind + 1 >= last_ind:
+                arr, counters[r], rng_state = files_interface.load_checkpoint(backend)
+                stream.bit_generator.state = rng_state
+            else:
+                arr = ArrayEvent2DCells(edge=edge, n_rows=n_row, n_columns=n_col, l_z=l_z, rad=rad,
+                                        edge_y=files_interface.load_edge_y())
+                arr.append_sphere(files_interface.load_spheres(last_ind))
+                counters[r] = last_ind
+                # no saved stream, so start one the replica did not use yet
+                stream = np.random.default_rng(np.random.SeedSequence(
+                    seed_sequences[r].entropy, spawn_key=seed_sequences[r].spawn_key + (int(last_ind),)))
+        else:
+            assert isinstance(initial_arr, Event2DCells), "No initial conditions for new replica " + str(r)
+            arr = ArrayEvent2DCells.from_cells(initial_arr)
+            files_interface = WriteOrLoad(replica_dir, arr.boundaries)
+            if write:
+                os.mkdir(replica_dir)
+                files_interface.dump_spheres(arr.all_centers, 'Initial Conditions')
+                files_interface.save_Input(arr.rad, rho_H, arr.edge, arr.n_rows, arr.n_columns, edge_y=arr.edge_y)
+        arr.jit = backend == 'numba'
+        arrs.append(arr)
+        files_interfaces.append(files_interface)
+        streams.append(stream)
+    print("\n\nEnsemble of " + str(replicas) + " replicas: N=" + str(N) + ", rhoH=" + str(rho_H) + ", h=" + str(h) +
+          "\nN_iterations=" + str(iterations) + " per replica, starting from " + str(counters.tolist()) +
+          "\nBackend: " + backend, file=sys.stdout)
+
+    # Run loops, every replica performs batch_size chains in its turn
+    day = 86400  # seconds
+    initial_time = time.time()
+    terminated = []
+    if write:
+        # the scheduler sends SIGTERM before killing the job, stop after the current batch and save checkpoints
+        signal.signal(signal.SIGTERM, lambda signum, frame: terminated.append(signum))
+    last_checkpoint_counters, last_checkpoint_time = counters.copy(), initial_time
+    engines = [ECMCEngine(arr, xy_total_step, z_total_step) for arr in arrs]
+    while (time.time() - initial_time < 2 * day) and np.any(counters < iterations) and not terminated:
+        for r in np.nonzero(counters < iterations)[0]:
+            if terminated:
+                break
+            engine = engines[r]
+            n_chains = int(min(batch_size, iterations - counters[r]))
+            if write and checkpoint_iterations is not None:
+                n_chains = int(min(n_chains, last_checkpoint_counters[r] + checkpoint_iterations - counters[r]))
+            chains = engine.chains
+            try:
+                engine.run(n_chains, streams[r])
+            except Exception as err:
+                if write:
+                    files_interfaces[r].dump_spheres(engine.arr.all_centers,
+                                                     str(counters[r] + engine.chains - chains + 1) + '_err')
+                raise err
+            counters[r] += n_chains
+            if write and checkpoint_iterations is not None and (
+                    counters[r] - last_checkpoint_counters[r] >= checkpoint_iterations):
+                assert arrs[r].legal_configuration(sample=100), "Illegal configuration in replica " + str(r)
+                files_interfaces[r].save_checkpoint(arrs[r], counters[r], streams[r].bit_generator.state)
+                last_checkpoint_counters[r] = counters[r]
+        if write and checkpoint_time is not None and time.time() - last_checkpoint_time >= checkpoint_time:
+            for r in range(replicas):
+                files_interfaces[r].save_checkpoint(arrs[r], counters[r], streams[r].bit_generator.state)
+            last_checkpoint_counters, last_checkpoint_time = counters.copy(), time.time()
+        print(str(np.round(100 * np.mean(np.minimum(counters, iterations)) / iterations, 1)) + "%", end=", ",
+              file=sys.stdout)
+
+    # save
+    for arr, files_interface, stream, i in zip(arrs, files_interfaces, streams, counters):
+        assert arr.legal_configuration()
+        if write:
+            if i not in files_interface.trajectory_index()[:, 0]:  # also if the replica was finished already
+                files_interface.append_frame(arr.all_centers, i)
+            files_interface.save_checkpoint(arr, i, stream.bit_generator.state)
+    if terminated:
+        print("\nTerminated by signal, checkpoints saved at iterations " + str(counters.tolist()), file=sys.stdout)
+    if np.all(counters >= iterations):
+        if write:
+            with open(os.path.join(output_dir, 'FINAL_MESSAGE'), 'w') as f:
+                f.write('Finished ' + str(iterations) + ' iterations in each of ' + str(replicas) + ' replicas\n')
+        sys.exit(0)
+    else:
+        if write:
+            with open(os.path.join(output_dir, 'TIME_LOG'), 'a') as f:
+                f.write('\nElapsed time is ' + str(time.time() - initial_time) + '\n')
+        sys.exit(7)  # any !=0 number
+
+
+def run_npt(initial_arr, N, h, sim_name, pressures, sweeps=100, equilibration_sweeps=None, volume_moves=5,
+            max_log_change=None, backend='python', write=True):
+    """
+    Constant pressure ECMC, mapping the equation of state in a single run. For every betaP of pressures in turn, run
+    equilibration_sweeps and then sweeps sweeps of an ECMCEngine, every sweep followed by volume_moves xy box rescale
+    moves at betaP, see ECMCEngine.volume_move. The walls stay at distance l_z and the aspect ratio of the box is
+    kept. Every pressure starts from the last configuration of the previous one, so pressures should be monotonic.
+    One line per pressure is written to output_dir/npt, and the final configuration to output_dir/betaP=...
+    Equilibration is slow: compressions are rejected as soon as the closest pair would overlap, so max_log_change
+    adapts to about 1/N and the box follows the pressure only as fast as the sweeps reshuffle the closest pairs, more
+    volume moves per sweep help little. For N=100 at h=1 compressing from rhoH=0.5 to the rhoH=0.68 of betaP=4 takes
+    about 1000 sweeps with 5 volume moves each, while 30 sweeps leave the density almost unchanged. Check that
+    betaP_xy, measured from the chains alone, agrees with betaP within betaP_xy_err.
+    :param pressures: target betaP in units of kT/sig^3, as in PressureEstimator
+    :param equilibration_sweeps: sweeps before the measurement of every pressure, default sweeps
+    :param volume_moves: volume moves after every sweep
+    :param max_log_change: largest change of ln(V) of a volume move, by default ECMCEngine.default_max_log_change for
+    every pressure. During equilibration it is rescaled by acceptance/0.3, within [1/2, 2], every 100 volume moves.
+    :return: list of dicts for the pressures, see npt_columns. The error bars of rho_H and betaP_xy are from 10 blocks
+    of the sweeps.
+    """
+    npt_columns = ['betaP', 'rho_H', 'rho_H_err', 'betaP_xy', 'betaP_xy_err', 'acceptance', 'max_log_change', 'l_x',
+                   'l_y']
+    backend = select_backend(backend)
+    equilibration_sweeps = sweeps if equilibration_sweeps is None else equilibration_sweeps
+    target_acceptance, adapt_moves = 0.3, 100
+    # ln(V) decorrelates over tens of sweeps, and betaP_xy with it, so the error bars are from 10 blocks of a tenth of
+    # the sweeps each
+    block_sweeps = max(1, sweeps // 10)
+    log_change = max_log_change  # carried over from the previous pressure if given
+    arr = initial_arr if backend == 'python' else ArrayEvent2DCells.from_cells(initial_arr)
+    if backend != 'python':
+        arr.jit = backend == 'numba'
+    rad = initial_arr.all_spheres[0].rad
+    sig = 2 * rad
+    edge, edge_y = arr.edge, arr.edge_y  # the cells are refined back to about these after expansions
+    output_dir = os.path.abspath(os.path.join(prefix, sim_name))
+    if write:
+        files_interface = WriteOrLoad(output_dir, arr.boundaries)
+        if not os.path.exists(output_dir):
+            os.mkdir(output_dir)
+        sys.stdout = open(os.path.join(output_dir, 'batch'), "a")
+        files_interface.dump_spheres(arr.all_centers, 'Initial Conditions')
+        files_interface.save_Input(rad, N * sig ** 3 / (arr.l_x * arr.l_y * arr.l_z), arr.edge, arr.n_rows,
+                                   arr.n_columns, edge_y=arr.edge_y)
+        with open(os.path.join(output_dir, 'npt'), 'w') as f:
+            f.write('# ' + ' '.join(npt_columns) + '\n')
+    print("\n\nNPT simulation: N=" + str(N) + ", h=" + str(h) + ", betaP=" + str(list(pressures)) + ", sweeps=" +
+          str(sweeps) + "\nBackend: " + backend, file=sys.stdout)
+    results = []
+    for beta_p in pressures:
+        n_rows, n_columns = max(1, int(arr.l_y / edge_y)), max(1, int(arr.l_x / edge))
+        if n_rows > arr.n_rows or n_columns > arr.n_columns:
+            arr.regrid(max(n_rows, arr.n_rows), max(n_columns, arr.n_columns))
+        # the total steps of run_sim for the density the pressure starts from
+        rho_H = N * sig ** 3 / (arr.l_x * arr.l_y * arr.l_z)
+        pressure = PressureEstimator(None, N, block_sweeps * N)
+        engine = ECMCEngine(arr, *ECMCEngine.default_total_steps(N, h, rho_H, rad), pressure=pressure)
+        if max_log_change is None:
+            log_change = ECMCEngine.default_max_log_change(N, beta_p, rho_H)
+        for sweep in range(equilibration_sweeps):
+            engine.sweep()
+            for _ in range(volume_moves):
+                engine.volume_move(beta_p, log_change)
+            if engine.volume_moves >= adapt_moves:
+                acceptance = engine.accepted_volume_moves / engine.volume_moves
+                log_change *= min(2.0, max(0.5, acceptance / target_acceptance))
+                engine.volume_moves, engine.accepted_volume_moves = 0, 0
+        engine.volume_moves, engine.accepted_volume_moves = 0, 0
+        pressure.reset()
+        pressure.blocks = []
+        densities = []
+        for _ in range(sweeps):
+            engine.sweep()
+            for _ in range(volume_moves):
+                engine.volume_move(beta_p, log_change)
+            densities.append(N * sig ** 3 / (arr.l_x * arr.l_y * arr.l_z))
+            if pressure.block_done():
+                pressure.flush(arr)
+        assert arr.legal_configuration()
+        # error bars from the means of blocks of block_sweeps sweeps, the partial last block is dropped
+        block_densities = np.mean(np.reshape(densities[:len(densities) // block_sweeps * block_sweeps],
+                                             (-1, block_sweeps)), axis=1)
+        summary = PressureEstimator.summary(pressure.blocks)
+        result = {'betaP': beta_p, 'rho_H': float(np.mean(densities)),
+                  'rho_H_err': float(np.std(block_densities, ddof=1) / np.sqrt(len(block_densities))) if len(
+                      block_densities) > 1 else np.nan,
+                  'betaP_xy': summary['betaP_xy'], 'betaP_xy_err': summary['betaP_xy_err'],
+                  'acceptance': engine.accepted_volume_moves / max(engine.volume_moves, 1),
+                  'max_log_change': log_change, 'l_x': arr.l_x, 'l_y': arr.l_y}
+        results.append(result)
+        print("NPT " + ' '.join(c + '=' + str(result[c]) for c in npt_columns), file=sys.stdout, flush=True)
+        if write:
+            with open(os.path.join(output_dir, 'npt'), 'a') as f:
+                f.write(' '.join(str(result[c]) for c in npt_columns) + '\n')
+            files_interface.dump_spheres(arr.all_centers, 'betaP=' + str(beta_p))
+    return results
+
+
 def main():
     local_run = True
     if local_run:
@@ -229,12 +723,14 @@ def main():
     else:
         sim_name = sys.argv[1]
     N, h, rhoH, ic = params_from_name(sim_name)
-    if ic == 'square':
-        run_square(h, N, rhoH)
-    if ic == 'honeycomb':
-        run_honeycomb(h, N, rhoH)
-    if ic == 'triangle':
-        run_triangle(h, N, rhoH)
+    # --profile after sim_name or ECMC_PROFILE=1 writes profile.pstats and profile_profile.txt next to batch
+    with Profiler(os.path.join(prefix, sim_name), 'profile', enable=profile_requested()):
+        if ic == 'square':
+            run_square(h, N, rhoH)
+        if ic == 'honeycomb':
+            run_honeycomb(h, N, rhoH)
+        if ic == 'triangle':
+            run_triangle(h, N, rhoH)
 
 
 if __name__ == "__main__":
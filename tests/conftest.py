@@ -0,0 +1,22 @@
+import os
+import sys
+
+import pytest
+
+# the modules of the repository are imported by name, as the entry points do when run from its root
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import run_functions  # noqa: E402
+
+
+@pytest.fixture
+def results_dir(tmp_path, monkeypatch):
+    """
+    Run the drivers in tmp_path, and undo their redirection of sys.stdout and change of directory
+    """
+    monkeypatch.setattr(run_functions, 'prefix', str(tmp_path))
+    monkeypatch.chdir(tmp_path)
+    stdout = sys.stdout
+    yield tmp_path
+    if sys.stdout is not stdout:
+        sys.stdout.close()
+        sys.stdout = stdout
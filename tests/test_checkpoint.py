@@ -0,0 +1,63 @@
+import os
+import random
+
+import numpy as np
+import pytest
+
+import run_functions
+from EventChainActions import ArrayEvent2DCells
+from SnapShot import WriteOrLoad
+
+
+def _sim(name, iterations, backend):
+    np.random.seed(0)
+    random.seed(0)  # replaced by the state of the checkpoint when the run is continued
+    with pytest.raises(SystemExit):
+        run_functions.run_sim(run_functions.square_initial_arr(1.0, 100, 0.7), 100, 1.0, 0.7, name,
+                              iterations=iterations, backend=backend)
+
+
+@pytest.mark.parametrize('backend', ['python', 'array'])
+def test_checkpoint_round_trip(tmp_path, backend):
+    np.random.seed(1)
+    arr = run_functions.square_initial_arr(1.0, 100, 0.7)
+    if backend == 'array':
+        arr = ArrayEvent2DCells.from_cells(arr)
+    files_interface = WriteOrLoad(str(tmp_path), arr.boundaries)
+    rng = random.Random(1)
+    rng.gauss(0, 1)  # so gauss_next is saved as well
+    files_interface.save_checkpoint(arr, 123, rng.getstate())
+    loaded, iteration, rng_state = files_interface.load_checkpoint(backend)
+    assert iteration == 123 and files_interface.checkpoint_iteration() == 123
+    assert rng_state == rng.getstate()
+    for expected, actual in zip(arr.occupancy(), loaded.occupancy()):
+        assert np.array_equal(expected, actual)
+    generator = np.random.default_rng(1)
+    generator.random()
+    files_interface.save_checkpoint(loaded, 124, generator.bit_generator.state)
+    assert files_interface.load_checkpoint(backend)[2] == generator.bit_generator.state
+
+
+def test_torn_checkpoint_write_keeps_the_last_checkpoint(tmp_path):
+    np.random.seed(1)
+    arr = ArrayEvent2DCells.from_cells(run_functions.square_initial_arr(1.0, 100, 0.7))
+    files_interface = WriteOrLoad(str(tmp_path), arr.boundaries)
+    files_interface.save_checkpoint(arr, 5, random.getstate())
+    with open(files_interface.checkpoint_path + '.tmp', 'wb') as f:  # a job killed while writing the next one
+        f.write(b'PK\x03\x04 torn')
+    assert files_interface.checkpoint_iteration() == 5
+    assert np.array_equal(files_interface.load_checkpoint('array')[0].centers, arr.centers)
+    files_interface.save_checkpoint(arr, 6, random.getstate())
+    assert files_interface.checkpoint_iteration() == 6
+    assert not os.path.exists(files_interface.checkpoint_path + '.tmp')
+
+
+@pytest.mark.parametrize('backend', ['python', 'numba'])
+def test_continued_run_is_exact(results_dir, backend):
+    _sim('straight', 400, backend)
+    _sim('continued', 150, backend)
+    _sim('continued', 400, backend)
+    straight, straight_ind = WriteOrLoad(os.path.join(str(results_dir), 'straight')).last_spheres()
+    continued, continued_ind = WriteOrLoad(os.path.join(str(results_dir), 'continued')).last_spheres()
+    assert straight_ind == continued_ind == 400
+    assert np.array_equal(straight, continued)
@@ -0,0 +1,89 @@
+import itertools
+import random
+
+import numpy as np
+import pytest
+
+import run_functions
+from EventChainActions import ArrayEvent2DCells, compress, fit_cells_to_scale
+from Structure import Metric
+
+
+def _arr(backend, rho_H, seed=0):
+    np.random.seed(seed)
+    random.seed(seed)
+    arr = run_functions.square_initial_arr(1.0, 100, rho_H)
+    return arr if backend == 'python' else ArrayEvent2DCells.from_cells(arr)
+
+
+def _assert_spheres_in_cells(arr, n_spheres):
+    if isinstance(arr, ArrayEvent2DCells):
+        assert np.array_equal(arr.sphere_cell, arr.cells_ind(arr.centers))
+        assert np.sum(arr.cell_count) == n_spheres
+        for k, count in enumerate(arr.cell_count):
+            assert np.all(arr.sphere_cell[arr.cell_spheres[k, :count]] == k)
+        return
+    spheres = [s for row in arr.cells for cell in row for s in cell.spheres]
+    assert len(spheres) == n_spheres
+    for row in arr.cells:
+        for cell in row:
+            assert all(cell.center_in_cell(s) for s in cell.spheres)
+
+
+@pytest.mark.parametrize('backend', ['python', 'array'])
+def test_compress_reaches_the_targets(backend):
+    arr = _arr(backend, 0.5)
+    assert compress(arr, desired_rho=0.6, desired_lz=3.8, max_seconds=60)
+    sig = 2.0
+    assert arr.l_z == pytest.approx(3.8)
+    assert 100 * sig ** 3 / (arr.l_x * arr.l_y * arr.l_z) == pytest.approx(0.6)
+    assert arr.legal_configuration()
+    _assert_spheres_in_cells(arr, 100)
+
+
+def _brute_force_factors(centers, rad, boundaries, xy, min_factor, margin):
+    sig = 2 * rad + margin
+    l = np.array(boundaries[:2])
+    factors = {}
+    for i, j in itertools.combinations(range(len(centers)), 2):
+        dr = centers[j] - centers[i]
+        dr[:2] -= l * np.round(dr[:2] / l)  # the closest image in x and y
+        dxy2, dz2 = dr[0] ** 2 + dr[1] ** 2, dr[2] ** 2
+        scaled, fixed = (dxy2, dz2) if xy else (dz2, dxy2)
+        factor = np.sqrt(max(sig ** 2 - fixed, 0) / scaled)
+        if factor > min_factor:
+            factors[(i, j)] = factor, dr
+    return factors
+
+
+@pytest.mark.parametrize('xy', [True, False])
+def test_compression_factors_match_all_pairs(xy):
+    rng = np.random.default_rng(1)
+    rad, boundaries, margin = 0.5, [6.0, 5.0, 3.0], 1e-6
+    # random centers, overlapping or not, many pairs are closer than sig through the cyclic boundaries
+    centers = rng.random((60, 3)) * boundaries
+    centers[:, 2] = rad + centers[:, 2] * (boundaries[2] - 2 * rad) / boundaries[2]
+    pairs, dr, factors = Metric.compression_factors(centers, rad, boundaries, xy=xy, min_factor=0.6, margin=margin)
+    expected = _brute_force_factors(centers, rad, boundaries, xy, 0.6, margin)
+    assert len(expected) > 0
+    assert sorted(map(tuple, pairs)) == sorted(expected)
+    for (i, j), r, factor in zip(pairs, dr, factors):
+        assert factor == pytest.approx(expected[(i, j)][0])
+        assert np.allclose(r, expected[(i, j)][1])
+
+
+@pytest.mark.parametrize('backend', ['python', 'array'])
+def test_fit_cells_to_scale_regrids_with_spheres_in_their_cells(backend):
+    arr = _arr(backend, 0.7)
+    sig = 2.0
+    n_rows, n_columns, edge = arr.n_rows, arr.n_columns, arr.edge
+    # a scale the cells can take is left to scale_xy
+    assert fit_cells_to_scale(arr, 0.95, sig) == pytest.approx(sig / edge)
+    assert (arr.n_rows, arr.n_columns) == (n_rows, n_columns)
+    factor = 0.8 * sig / edge
+    allowed = fit_cells_to_scale(arr, factor, sig)
+    assert arr.n_rows < n_rows and arr.n_columns < n_columns
+    assert allowed <= factor
+    assert min(arr.edge, arr.edge_y) * factor > sig
+    _assert_spheres_in_cells(arr, 100)
+    assert arr.legal_configuration()
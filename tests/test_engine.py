@@ -0,0 +1,68 @@
+import os
+import random
+
+import numpy as np
+import pytest
+
+import run_functions
+from EventChainActions import ArrayEvent2DCells, ECMCEngine
+from Structure import Direction, Sphere
+
+
+def _engine(backend, seed=4):
+    np.random.seed(seed)
+    arr = run_functions.square_initial_arr(1.0, 100, 0.7)
+    if backend != 'python':
+        arr = ArrayEvent2DCells.from_cells(arr)
+        arr.jit = backend == 'numba'
+    return ECMCEngine(arr, *ECMCEngine.default_total_steps(100, 1.0, 0.7))
+
+
+@pytest.mark.parametrize('backend', ['python', 'array', 'numba'])
+def test_run_draws_as_the_loop_of_chains(backend):
+    engine = _engine(backend)
+    rng = random.Random(5)
+    events = engine.run(150, rng)
+    # the draws of the baseline run_sim: the sphere and then the direction of every chain
+    loop_engine = _engine(backend)
+    loop_rng = random.Random(5)
+    loop_events = 0
+    for _ in range(150):
+        sphere = loop_rng.randint(0, 99)
+        loop_events += loop_engine.chain(sphere, loop_rng.randint(0, 3))
+    assert events == loop_events == engine.events
+    assert engine.chains == loop_engine.chains == 150
+    assert rng.getstate() == loop_rng.getstate()
+    assert np.array_equal(engine.arr.all_centers, loop_engine.arr.all_centers)
+
+
+def test_sweep_is_a_run_of_n_chains():
+    engine, run_engine = _engine('numba'), _engine('numba')
+    engine.sweep(random.Random(6))
+    run_engine.run(100, random.Random(6))
+    assert engine.chains == 100
+    assert np.array_equal(engine.arr.all_centers, run_engine.arr.all_centers)
+
+
+def test_displacements_are_recorded_for_every_chain(results_dir):
+    np.random.seed(0)
+    random.seed(0)
+    with pytest.raises(SystemExit):
+        run_functions.run_sim(run_functions.square_initial_arr(1.0, 100, 0.7), 100, 1.0, 0.7, 'displacements',
+                              iterations=50, backend='numba', record_displacements=True)
+    realizations, displacements = np.loadtxt(os.path.join(str(results_dir), 'displacements', 'Displacement')).T
+    assert realizations.tolist() == list(range(51))
+    assert displacements[0] == 0 and np.all(np.diff(displacements) >= 1)
+
+
+@pytest.mark.parametrize('backend', ['python', 'array'])
+def test_chains_reuse_the_step_and_keep_the_directions(backend):
+    engine = _engine(backend)
+    step, event = engine.step, engine.step.event
+    for sphere in range(20):
+        engine.chain(sphere, 2 + sphere % 2, 10 * engine.arr.l_z)  # many wall events flip the direction
+        assert engine.step is step and step.event is event and step.wall_events > 0
+    assert [(d.dim, d.sgn) for d in Direction.directions()] == [(0, 1), (1, 1), (2, 1), (2, -1)]
+    assert Direction.directions()[2].opposite() is Direction.directions()[3]
+    for value in [Direction(0), step, event, Sphere((0.0, 0.0, 1.0), 1.0)]:
+        assert not hasattr(value, '__dict__')
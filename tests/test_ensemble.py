@@ -0,0 +1,38 @@
+import os
+
+import numpy as np
+import pytest
+
+import run_functions
+from SnapShot import WriteOrLoad
+
+
+def _ensemble(name, iterations):
+    np.random.seed(0)
+    with pytest.raises(SystemExit):
+        run_functions.run_ensemble(run_functions.square_initial_arr(1.0, 100, 0.7), 100, 1.0, 0.7, name, 2,
+                                   iterations=iterations, backend='numba', seed=7, batch_size=100)
+
+
+def _last_centers(results_dir, name, replica):
+    return WriteOrLoad(os.path.join(str(results_dir), name, 'replica_' + str(replica))).last_spheres()
+
+
+def test_continued_ensemble_goes_on_with_the_streams(results_dir):
+    _ensemble('straight', 400)
+    _ensemble('continued', 200)
+    _ensemble('continued', 400)
+    for r in range(2):
+        straight, straight_ind = _last_centers(results_dir, 'straight', r)
+        continued, continued_ind = _last_centers(results_dir, 'continued', r)
+        assert straight_ind == continued_ind
+        assert np.array_equal(straight, continued)
+    # the replicas have different streams
+    assert not np.array_equal(_last_centers(results_dir, 'straight', 0)[0],
+                              _last_centers(results_dir, 'straight', 1)[0])
+
+
+def test_ensemble_rejects_options_it_does_not_support(results_dir):
+    with pytest.raises(ValueError, match='heat_bath_ratio'):
+        run_functions.run_sim(run_functions.square_initial_arr(1.0, 100, 0.7), 100, 1.0, 0.7, 'unsupported',
+                              replicas=2, heat_bath_ratio=0.5)
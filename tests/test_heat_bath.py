@@ -0,0 +1,100 @@
+import random
+
+import numpy as np
+import pytest
+
+import run_functions
+from EventChainActions import ArrayEvent2DCells, ECMCEngine
+from Structure import Metric
+
+
+def _brute_force_allowed(z, center1, rad, centers2, l_z, margin):
+    """Heights z of the sphere at the xy of center1 which are allowed, checked against every other sphere"""
+    allowed = (z >= rad + margin) & (z <= l_z - rad - margin)
+    for c in centers2:
+        dxy2 = (c[0] - center1[0]) ** 2 + (c[1] - center1[1]) ** 2
+        if dxy2 < (2 * rad) ** 2:
+            allowed &= np.abs(z - c[2]) >= np.sqrt((2 * rad) ** 2 - dxy2) + margin
+    return allowed
+
+
+def _assert_intervals(center1, rad, centers2, l_z, margin=1e-8):
+    intervals = Metric.allowed_z_intervals(center1, rad, centers2, l_z, margin=margin)
+    assert np.all(intervals[:, 0] < intervals[:, 1]) and np.all(intervals[1:, 0] > intervals[:-1, 1])
+    z = np.linspace(-0.5, l_z + 0.5, 20001)
+    inside = np.zeros_like(z, dtype=bool)
+    near_end = np.zeros_like(z, dtype=bool)
+    for low, high in intervals:
+        inside |= (z >= low) & (z <= high)
+        near_end |= (np.abs(z - low) < 1e-6) | (np.abs(z - high) < 1e-6)
+    allowed = _brute_force_allowed(z, center1, rad, centers2, l_z, margin)
+    assert np.array_equal(inside[~near_end], allowed[~near_end])
+    return intervals
+
+
+def test_allowed_z_intervals_overlapping_touching_and_clipped_exclusions():
+    rad, l_z = 0.5, 4.0
+    center1 = np.array([0.0, 0.0, 2.0])
+    dx = 0.6  # every exclusion is of half width sqrt(1-0.36)=0.8 around the other height
+    centers2 = [[dx, 0, 1.0], [0, dx, 1.5],  # overlapping exclusions, [0.2, 2.3]
+                [-dx, 0, 3.1],  # touching the one above, [2.3, 3.9], up to the top wall at 3.5
+                [0, -dx, 0.4],  # clipped by the bottom wall at 0.5
+                [1.5, 0, 2.0]]  # farther than sig in xy, excludes nothing
+    assert len(_assert_intervals(center1, rad, centers2, l_z)) == 0
+    intervals = _assert_intervals(center1, rad, centers2[2:], l_z)
+    assert np.allclose(intervals, [[1.2, 2.3]], atol=1e-6)
+    intervals = _assert_intervals(center1, rad, [centers2[0], centers2[3]], l_z)
+    assert np.allclose(intervals, [[1.8, 3.5]], atol=1e-6)
+
+
+def test_allowed_z_intervals_random_neighbors():
+    rng = np.random.default_rng(0)
+    rad, l_z = 0.5, 5.0
+    for _ in range(200):
+        n = rng.integers(0, 7)
+        centers2 = np.column_stack([rng.uniform(-1.2, 1.2, (n, 2)), rng.uniform(0, l_z, n)])
+        _assert_intervals(np.array([0.0, 0.0, 0.0]), rad, centers2, l_z)
+
+
+def test_uniform_in_intervals_is_uniform():
+    intervals = np.array([[0.0, 1.0], [2.0, 4.0], [4.5, 4.75]])
+    u = (np.arange(1000) + 0.5) / 1000
+    x = np.array([Metric.uniform_in_intervals(intervals, v) for v in u])
+    # the inverse of the cumulative length of the intervals
+    length = u * 3.25
+    expected = np.where(length < 1, length, np.where(length < 3, length + 1, length + 1.5))
+    assert np.allclose(x, expected)
+    assert Metric.uniform_in_intervals(intervals, 0.0) == 0.0
+    assert Metric.uniform_in_intervals(intervals, 1 - 1e-16) == pytest.approx(4.75)
+    draws = np.array([Metric.uniform_in_intervals(intervals, v) for v in np.random.default_rng(1).random(20000)])
+    counts = [np.sum((draws >= low) & (draws <= high)) for low, high in intervals]
+    assert sum(counts) == len(draws)
+    assert np.allclose(np.array(counts) / len(draws), [1 / 3.25, 2 / 3.25, 0.25 / 3.25], atol=0.01)
+
+
+def _engine(backend, heat_bath_ratio=0.0):
+    np.random.seed(2)
+    arr = run_functions.square_initial_arr(1.0, 100, 0.7)
+    if backend != 'python':
+        arr = ArrayEvent2DCells.from_cells(arr)
+        arr.jit = backend == 'numba'
+    return ECMCEngine(arr, *ECMCEngine.default_total_steps(100, 1.0, 0.7), heat_bath_ratio=heat_bath_ratio)
+
+
+def test_python_and_array_heights_agree():
+    python_engine, array_engine = _engine('python'), _engine('array')
+    python_rng, array_rng = random.Random(3), random.Random(3)
+    spheres = random.Random(4).choices(range(100), k=300)
+    for sphere in spheres:
+        assert python_engine.resample_z(sphere, python_rng) == array_engine.resample_z(sphere, array_rng)
+    assert np.array_equal(python_engine.arr.all_centers, array_engine.arr.all_centers)
+
+
+@pytest.mark.parametrize('backend', ['python', 'array', 'numba'])
+def test_run_with_heat_bath_is_legal(backend):
+    engine = _engine(backend, heat_bath_ratio=0.5)
+    heights = np.array(engine.arr.all_centers)[:, 2]
+    engine.run(300, random.Random(5))
+    assert engine.heat_bath_moves == 150 and engine.chains == 300
+    assert not np.array_equal(np.array(engine.arr.all_centers)[:, 2], heights)
+    assert engine.arr.legal_configuration()
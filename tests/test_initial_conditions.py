@@ -0,0 +1,124 @@
+import numpy as np
+import pytest
+
+import run_functions
+from EventChainActions import ArrayEvent2DCells, Event2DCells
+from Structure import ArrayOfCells, Sphere, epsilon
+
+
+def _square_arr(rho_H=0.7, N=100):
+    """Empty cells of square_initial_arr"""
+    np.random.seed(3)
+    arr = run_functions.square_initial_arr(1.0, N, rho_H)
+    return Event2DCells(edge=arr.edge, n_rows=arr.n_rows, n_columns=arr.n_columns, l_z=arr.l_z)
+
+
+def _baseline_af_square(arr, n_sp_row, n_sp_col, rad):
+    """The per-sphere loop of generate_spheres_in_AF_square before the centers were built in bulk"""
+    sig = 2 * rad
+    ax, ay = arr.l_x / n_sp_col, arr.l_y / n_sp_row
+    dz_max = np.sqrt(max(sig ** 2 - min(ax, ay) ** 2, 0))
+    dr_max = arr.l_z / 2 - rad - dz_max / 2
+    centers = []
+    for i in range(n_sp_row):
+        for j in range(n_sp_col):
+            sign = (-1) ** (i + j)
+            dr = np.random.random() * dr_max
+            centers.append([(j + 1 / 2) * ax, (i + 1 / 2) * ay, sign * (rad + 100 * epsilon + dr) + arr.l_z * (
+                    1 - sign) / 2])
+    return centers
+
+
+def _baseline_triangular(n_row, n_col, rad, l_x, l_y):
+    ax, ay = l_x / (n_col + 1 / 2), l_y / (n_row + 1)
+    centers = []
+    for i in range(n_row):
+        for j in range(n_col):
+            xj = (1 + epsilon) * rad + ax * j if i % 2 == 0 else (1 + epsilon) * rad + ax * (j + 1 / 2)
+            centers.append([xj, (1 + epsilon) * rad + ay * i, rad * (1 + epsilon)])
+    return centers
+
+
+def _baseline_af_triangular(arr, n_row, n_col, rad):
+    """The per-sphere loop of generate_spheres_in_AF_triangular_structure"""
+    l_x, l_y, l_z = arr.boundaries
+    ay = 2 * l_y / n_row
+    down = _baseline_triangular(n_row // 2, n_col, rad, l_x, l_y)
+    up = _baseline_triangular(n_row // 2, n_col, rad, l_x, l_y)
+    dz_max = np.sqrt(max((2 * rad) ** 2 - (2.0 / 3.0 * ay) ** 2, 0))
+    dr_max = (l_z / 2 - rad - dz_max / 2) / 2
+    for c in down:
+        c[2] = rad + dr_max * np.random.random()
+    for c in up:
+        c[1] += ay * 2.0 / 3
+        c[2] = l_z - rad - dr_max * np.random.random()
+        for d in range(3):
+            c[d] %= arr.boundaries[d]
+    return down + up
+
+
+def _baseline_binning(arr, centers, rad):
+    """Sphere by sphere into the first cell of a scan over the cells, as the baseline ArrayOfCells.append_sphere"""
+    for c in centers:
+        sphere = Sphere(tuple(c), rad)
+        cell = next(cell for row in arr.cells for cell in row if cell.center_in_cell(sphere))
+        arr.append_sphere(sphere)
+        assert arr.cell_of_sphere(sphere) is cell
+    arr.update_all_spheres()
+    return arr
+
+
+def _cell_centers(arr):
+    return [[list(s.center) for s in cell.spheres] for row in arr.cells for cell in row]
+
+
+def test_af_square_centers_match_the_per_sphere_loop():
+    arr = _square_arr()
+    np.random.seed(5)
+    centers = arr.AF_square_centers(10, 10, 1.0)
+    np.random.seed(5)
+    assert np.array_equal(centers, _baseline_af_square(arr, 10, 10, 1.0))
+
+
+def test_af_triangular_centers_match_the_per_sphere_loop():
+    arr = Event2DCells(edge=4.0, n_rows=5, n_columns=10, l_z=4.0)
+    np.random.seed(5)
+    centers = arr.AF_triangular_centers(10, 10, 1.0)
+    np.random.seed(5)
+    assert np.array_equal(centers, _baseline_af_triangular(arr, 10, 10, 1.0))
+    assert np.array_equal(ArrayOfCells.triangular_centers(5, 10, 1.0, 40.0, 20.0),
+                          _baseline_triangular(5, 10, 1.0, 40.0, 20.0))
+
+
+@pytest.mark.parametrize('initial_arr', ['square', 'honeycomb'])
+def test_bulk_builders_fill_the_cells_of_the_per_sphere_path(initial_arr):
+    np.random.seed(3)
+    arr = getattr(run_functions, initial_arr + '_initial_arr')(1.0, 100, 0.5)
+    baseline = Event2DCells(edge=arr.edge, n_rows=arr.n_rows, n_columns=arr.n_columns, l_z=arr.l_z,
+                            edge_y=arr.edge_y)
+    _baseline_binning(baseline, arr.all_centers, 1.0)
+    assert _cell_centers(arr) == _cell_centers(baseline)
+    assert np.array_equal(arr.all_centers, baseline.all_centers)
+    for k in range(len(arr.flat_cells)):  # and the ghosts of the halo
+        assert [[list(g.center) for g in ghost_cell.spheres] for ghost_cell, _ in arr.cell_ghosts[k]] == \
+               [[list(g.center) for g in ghost_cell.spheres] for ghost_cell, _ in baseline.cell_ghosts[k]]
+    # the generic ArrayOfCells.append_sphere, which guesses the cell before scanning for it
+    guessed = Event2DCells(edge=arr.edge, n_rows=arr.n_rows, n_columns=arr.n_columns, l_z=arr.l_z,
+                           edge_y=arr.edge_y)
+    ArrayOfCells.append_sphere(guessed, [Sphere(tuple(c), 1.0) for c in arr.all_centers])
+    assert _cell_centers(guessed) == _cell_centers(baseline)
+
+
+def test_array_bulk_insert_matches_sphere_by_sphere():
+    np.random.seed(3)
+    arr = run_functions.square_initial_arr(1.0, 100, 0.85)
+    bulk = ArrayEvent2DCells.from_cells(arr, capacity=1)
+    sequential = ArrayEvent2DCells(arr.edge, arr.n_rows, arr.n_columns, arr.l_z, rad=1.0, capacity=1,
+                                   edge_y=arr.edge_y)
+    for c in arr.all_centers:
+        sequential.append_sphere(c)
+    assert np.array_equal(bulk.centers, sequential.centers)
+    for name in ['sphere_cell', 'sphere_slot', 'cell_count', 'cell_spheres']:
+        assert np.array_equal(getattr(bulk, name), getattr(sequential, name)), name
+    bulk.rebin()
+    assert np.array_equal(bulk.cell_spheres, sequential.cell_spheres)
@@ -0,0 +1,70 @@
+import random
+
+import numpy as np
+
+import EventChainKernel
+from EventChainActions import ArrayEvent2DCells, ECMCEngine, Step
+from Structure import Direction
+from run_functions import square_initial_arr
+
+
+def _consistent(arr):
+    """
+    :return: True if no cell is full and cell_spheres, cell_count, sphere_cell and sphere_slot agree
+    """
+    ids = np.arange(arr.n_spheres)
+    return arr.cell_count.max() < arr.cell_spheres.shape[1] and np.all(
+        arr.cell_spheres[arr.sphere_cell, arr.sphere_slot] == ids) and np.all(
+        np.bincount(arr.sphere_cell, minlength=len(arr.cell_count)) == arr.cell_count) and np.all(
+        arr.sphere_cell == arr.cells_ind(arr.centers))
+
+
+def test_free_step_filling_a_cell_grows_it():
+    arr = ArrayEvent2DCells(edge=5.0, n_rows=3, n_columns=3, l_z=10.0, capacity=2)
+    arr.append_sphere([[4.0, 1.0, 1.0], [7.0, 3.0, 8.0]])  # far apart in z, cells 0 and 1
+    assert arr.cell_spheres.shape[1] == 2
+    arr.jit = True
+    step = Step(0, 2.0, Direction.directions()[0], arr.boundaries)
+    # a single free step into cell 1, which becomes full at the end of the chain
+    assert EventChainKernel.perform_total_step(arr, step, record_displacements=True) == 1
+    assert arr.sphere_cell[0] == 1
+    assert _consistent(arr)
+
+
+def _run(backend, seed, chains, batch=False):
+    np.random.seed(seed)
+    arr = ArrayEvent2DCells.from_cells(square_initial_arr(1.0, 100, 0.7))
+    arr.jit = backend == 'numba'
+    # as small as allowed, so cells keep getting full and growing
+    arr.cell_spheres = np.array(arr.cell_spheres[:, :arr.cell_count.max() + 1])
+    engine = ECMCEngine(arr, *ECMCEngine.default_total_steps(100, 1.0, 0.7))
+    rng = random.Random(seed)
+    if batch:  # EventChainKernel.run_chains for numba
+        engine.run(chains, rng)
+    else:
+        for _ in range(chains):
+            sphere = rng.randint(0, arr.n_spheres - 1)
+            engine.chain(sphere, rng.randint(0, 3))
+            assert _consistent(arr)
+    assert _consistent(arr)
+    return arr, engine
+
+
+def _same(arr, other):
+    return np.array_equal(arr.centers, other.centers) and np.array_equal(arr.sphere_cell, other.sphere_cell) and \
+        np.array_equal(arr.sphere_slot, other.sphere_slot)
+
+
+def test_kernel_matches_array_backend():
+    array_arr, array_engine = _run('array', 1, 300)
+    numba_arr, numba_engine = _run('numba', 1, 300)
+    assert array_engine.events == numba_engine.events
+    assert _same(array_arr, numba_arr)
+    assert numba_arr.legal_configuration()
+
+
+def test_batch_of_chains_matches_single_chains():
+    chain_arr, chain_engine = _run('numba', 2, 2000)
+    batch_arr, batch_engine = _run('numba', 2, 2000, batch=True)
+    assert chain_engine.events == batch_engine.events
+    assert _same(chain_arr, batch_arr)
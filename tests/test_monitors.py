@@ -0,0 +1,104 @@
+import itertools
+
+import numpy as np
+import pytest
+
+import run_functions
+from EventChainActions import ArrayEvent2DCells
+from OrderParameterMonitor import OrderParameterMonitor
+
+
+def _brute_force(centers, rad, boundaries, N, cutoff):
+    """The order parameters of OrderParameterMonitor.measure, with the neighbors found among all the pairs"""
+    l = np.array(boundaries[:2])
+    spins = (centers[:, 2] - boundaries[2] / 2) / (boundaries[2] / 2 - rad)
+    q = np.pi * np.sqrt(N) / l
+    bonds = [[] for _ in centers]
+    for i, j in itertools.permutations(range(len(centers)), 2):
+        dxy = (centers[j, :2] - centers[i, :2] + l / 2) % l - l / 2
+        if dxy @ dxy < cutoff ** 2:
+            bonds[i].append((j, np.arctan2(dxy[1], dxy[0])))
+    result = {'m_stag': np.abs(np.sum(spins * np.exp(1j * centers[:, :2] @ q))) / len(centers),
+              'af_fraction': np.mean([(spins[i] > 0) != (spins[j] > 0) for i in range(len(centers)) for j, _ in
+                                      bonds[i]])}
+    for n in [4, 6]:
+        result['psi_' + str(n)] = np.abs(np.mean([np.mean([np.exp(1j * n * theta) for _, theta in b]) for b in bonds]))
+    return result
+
+
+def _perfect_honeycomb(a=2.2, n_x=5, n_y=5):
+    """
+    AF honeycomb lattice of bond a, in n_x x n_y rectangular unit cells of 4 spheres, the two triangular sublattices on
+    the two walls
+    """
+    l_x, l_y, l_z, rad = np.sqrt(3) * a * n_x, 3 * a * n_y, 4.0, 1.0
+    basis = [(0, 0, rad), (np.sqrt(3) / 2 * a, a / 2, l_z - rad), (np.sqrt(3) / 2 * a, 3 * a / 2, rad),
+             (0, 2 * a, l_z - rad)]
+    centers = np.array([(x + np.sqrt(3) * a * i + 0.1, y + 3 * a * j + 0.1, z) for i in range(n_x) for j in range(n_y)
+                        for x, y, z in basis])
+    arr = ArrayEvent2DCells(edge=l_x / 6, n_rows=10, n_columns=6, l_z=l_z, rad=rad, edge_y=l_y / 10)
+    arr.append_sphere(centers)
+    assert arr.legal_configuration()
+    return arr
+
+
+@pytest.mark.parametrize('backend', ['python', 'array'])
+def test_perfect_af_square_lattice(backend):
+    np.random.seed(0)
+    arr = run_functions.square_initial_arr(1.0, 100, 0.7)
+    if backend == 'array':
+        arr = ArrayEvent2DCells.from_cells(arr)
+    centers = np.array(arr.all_centers)
+    spins = (centers[:, 2] - arr.l_z / 2) / (arr.l_z / 2 - 1.0)
+    result = OrderParameterMonitor(None, 100).measure(arr)
+    # the heights are random but their signs alternate, so every spin adds |s| to the staggered magnetization
+    assert result['m_stag'] == pytest.approx(np.mean(np.abs(spins)))
+    assert result['af_fraction'] == 1.0
+    assert result['psi_4'] == pytest.approx(1.0)
+    assert result['psi_6'] == pytest.approx(0.0, abs=1e-12)
+
+
+def test_af_square_lattice_on_the_walls_is_fully_staggered():
+    np.random.seed(0)
+    arr = ArrayEvent2DCells.from_cells(run_functions.square_initial_arr(1.0, 100, 0.7))
+    arr.centers[:, 2] = np.where(arr.centers[:, 2] > arr.l_z / 2, arr.l_z - 1.0, 1.0)
+    result = OrderParameterMonitor(None, 100).measure(arr)
+    assert result['m_stag'] == pytest.approx(1.0)
+    arr.centers[:, 2] = 1.0  # all the spins down, ferromagnetic
+    result = OrderParameterMonitor(None, 100).measure(arr)
+    assert result['m_stag'] == pytest.approx(0.0, abs=1e-12) and result['af_fraction'] == 0.0
+
+
+def test_perfect_honeycomb_lattice():
+    arr = _perfect_honeycomb()
+    result = OrderParameterMonitor(None, 100).measure(arr)
+    assert OrderParameterMonitor(None, 100).neighbor_bonds(arr)[0].tolist() == np.repeat(np.arange(100), 3).tolist()
+    assert result['af_fraction'] == 1.0
+    assert result['psi_6'] == pytest.approx(1.0)
+    assert result['psi_4'] == pytest.approx(0.0, abs=1e-12)
+
+
+@pytest.mark.parametrize('initial_arr', ['square', 'honeycomb'])
+@pytest.mark.parametrize('backend', ['python', 'array'])
+def test_measure_matches_all_pairs(initial_arr, backend):
+    np.random.seed(1)
+    arr = getattr(run_functions, initial_arr + '_initial_arr')(1.0, 100, 0.4)
+    if backend == 'array':
+        arr = ArrayEvent2DCells.from_cells(arr)
+    monitor = OrderParameterMonitor(None, 100)
+    cutoff = min(1.2 * np.sqrt(arr.l_x * arr.l_y / 100), arr.edge, arr.edge_y)
+    expected = _brute_force(np.array(arr.all_centers), 1.0, arr.boundaries, 100, cutoff)
+    result = monitor.measure(arr)
+    for name, value in expected.items():
+        assert result[name] == pytest.approx(value, abs=1e-12)
+
+
+def test_measurements_are_logged(tmp_path):
+    np.random.seed(0)
+    arr = run_functions.square_initial_arr(1.0, 100, 0.7)
+    monitor = OrderParameterMonitor(str(tmp_path), 100)
+    results = [monitor.measure(arr, iteration) for iteration in [10, 20]]
+    monitor.measure(arr)  # not logged without an iteration
+    logged = np.loadtxt(str(tmp_path / 'monitors'))
+    assert logged[:, 0].tolist() == [10, 20]
+    assert np.allclose(logged[:, 1:], [[r[k] for k in ['m_stag', 'af_fraction', 'psi_4', 'psi_6']] for r in results])
@@ -0,0 +1,101 @@
+import itertools
+import random
+
+import numpy as np
+import pytest
+
+import run_functions
+from EventChainActions import ArrayEvent2DCells, ECMCEngine
+from Structure import Direction, Metric, epsilon
+
+
+def _brute_force_collision(center, others, rad, total_step, direction, boundaries):
+    """
+    First collision of a sphere at center moving total_step in direction, over every sphere of others and all their
+    periodic images a step of up to total_step can reach
+    :return: distance and row of others collided, (inf, -1) if there is none
+    """
+    l_x, l_y = boundaries[:2]
+    images = int(np.ceil(total_step / min(l_x, l_y))) + 1
+    e = np.zeros(3)
+    e[direction.dim] = direction.sgn
+    shifts = [(nx * l_x, ny * l_y, 0) for nx, ny in itertools.product(range(-1, images + 1), repeat=2)]
+    dr = np.reshape(others, (-1, 1, 3)) + np.array(shifts, dtype=float) - center  # (others, images, xyz)
+    along = dr @ e
+    perp_sq = np.sum(dr ** 2, axis=2) - along ** 2
+    valid = (along > 0) & (perp_sq < (2 * rad) ** 2)
+    dist = np.where(valid, along - np.sqrt(np.where(valid, (2 * rad) ** 2 - perp_sq, 0)), np.inf)
+    dist = np.where(dist <= total_step, dist, np.inf).min(axis=1)
+    k = int(np.argmin(dist)) if len(dist) > 0 else -1
+    return (float('inf'), -1) if k < 0 or dist[k] == np.inf else (float(dist[k]), k)
+
+
+def _brute_force_chain(centers, rad, boundaries, sphere, d, total_step):
+    """Chain of sphere with the first event of every step found among all the spheres, on a copy of centers"""
+    centers = np.array(centers, dtype=float)
+    direction = Direction.directions()[d]
+    while total_step > 0:
+        others = np.delete(np.arange(len(centers)), sphere)
+        dist, k = _brute_force_collision(centers[sphere], centers[others], rad, total_step, direction, boundaries)
+        wall = float('inf')
+        if direction.dim == 2:
+            wall = boundaries[2] - centers[sphere, 2] - rad - epsilon if direction.sgn == 1 else \
+                centers[sphere, 2] - rad - epsilon
+        step = min(dist, wall, total_step)
+        centers[sphere, direction.dim] += direction.sgn * step
+        centers[sphere, :2] %= boundaries[:2]
+        total_step -= step
+        if step == dist:
+            sphere = others[k]
+        elif step == wall:
+            direction = direction.opposite()
+        else:
+            return centers
+    return centers
+
+
+def _engine(backend):
+    np.random.seed(0)
+    arr = run_functions.square_initial_arr(1.0, 100, 0.7)
+    if backend != 'python':
+        arr = ArrayEvent2DCells.from_cells(arr)
+        arr.jit = backend == 'numba'
+    engine = ECMCEngine(arr, *ECMCEngine.default_total_steps(100, 1.0, 0.7))
+    engine.run(500, random.Random(1))  # away from the lattice
+    return engine
+
+
+def test_dist_to_collision_batch_matches_all_images():
+    rng = np.random.default_rng(0)
+    rad, boundaries = 0.5, [5.0, 4.0, 3.0]
+    for _ in range(300):
+        center = rng.random(3) * boundaries
+        others = rng.random((8, 3)) * boundaries
+        d = int(rng.integers(0, 4))
+        direction = Direction.directions()[d]
+        total_step = rng.uniform(0, 1.5 * min(boundaries[:2])) if d < 2 else rng.uniform(0, boundaries[2])
+        dist, k = Metric.dist_to_collision_batch(center, rad, others, rad, total_step, direction, boundaries)
+        expected_dist, expected_k = _brute_force_collision(center, others, rad, total_step, direction, boundaries)
+        assert k == expected_k
+        assert dist == pytest.approx(expected_dist)
+
+
+@pytest.mark.parametrize('backend', ['python', 'array', 'numba'])
+def test_chains_match_the_brute_force_chain(backend):
+    engine = _engine(backend)
+    arr = engine.arr
+    rad = 1.0
+    rng = random.Random(2)
+    crossed = 0
+    for _ in range(60):
+        sphere, d = rng.randrange(100), rng.randrange(4)
+        # steps of up to the size of the system in xy, the chains cross the cyclic boundaries
+        total_step = rng.uniform(0, arr.l_x) if d < 2 else rng.uniform(0, 3 * arr.l_z)
+        centers = np.array(arr.all_centers)
+        expected = _brute_force_chain(centers, rad, arr.boundaries, sphere, d, total_step)
+        engine.chain(sphere, d, total_step)
+        actual = np.array(arr.all_centers)
+        crossed += np.any(np.abs(actual[:, :2] - centers[:, :2]) > np.array(arr.boundaries[:2]) / 2)
+        assert np.allclose(actual, expected, rtol=0, atol=1e-9)
+    assert crossed > 0
+    assert arr.legal_configuration()
@@ -0,0 +1,75 @@
+import random
+
+import numpy as np
+import pytest
+
+import run_functions
+from EventChainActions import ArrayEvent2DCells, ECMCEngine
+
+
+class _Draws:
+    """Stands for the rng of volume_move: d=(2*u-1)*max_log_change for the first draw, the acceptance for the second"""
+
+    def __init__(self, *draws):
+        self.draws = list(draws)
+
+    def random(self):
+        return self.draws.pop(0)
+
+
+def _engine(backend, rho_H=0.7, seed=4):
+    np.random.seed(seed)
+    arr = run_functions.square_initial_arr(1.0, 100, rho_H)
+    if backend != 'python':
+        arr = ArrayEvent2DCells.from_cells(arr)
+        arr.jit = backend == 'numba'
+    return ECMCEngine(arr, *ECMCEngine.default_total_steps(100, 1.0, rho_H))
+
+
+def _box(engine):
+    return list(engine.arr.boundaries), np.array(engine.arr.all_centers)
+
+
+@pytest.mark.parametrize('backend', ['python', 'array'])
+def test_rejected_moves_leave_the_box(backend):
+    engine = _engine(backend)
+    boundaries, centers = _box(engine)
+    # an expansion at a pressure high enough that its acceptance is zero in double precision
+    assert engine.volume_log_acceptance(1e6, 0.05) < -700
+    assert not engine.volume_move(1e6, 0.05, _Draws(1.0, 0.0))
+    # a compression always accepted by the pressure, which overlaps the square lattice of rhoH=0.7
+    assert engine.volume_log_acceptance(1e6, -0.2) > 0
+    assert not engine.volume_move(1e6, 0.2, _Draws(0.0))
+    assert engine.volume_moves == 2 and engine.accepted_volume_moves == 0
+    assert list(engine.arr.boundaries) == boundaries
+    assert np.array_equal(engine.arr.all_centers, centers)
+    assert engine.arr.legal_configuration()
+
+
+@pytest.mark.parametrize('backend', ['python', 'array'])
+def test_volume_moves_are_reversible(backend):
+    engine = _engine(backend, rho_H=0.5)
+    boundaries, centers = _box(engine)
+    d = 0.02
+    forward = engine.volume_log_acceptance(4.0, d)
+    assert engine.volume_move(4.0, d, _Draws(1.0, 0.0))
+    assert engine.arr.l_x * engine.arr.l_y == pytest.approx(boundaries[0] * boundaries[1] * np.exp(d))
+    assert engine.volume_log_acceptance(4.0, -d) == pytest.approx(-forward)
+    assert engine.volume_move(4.0, d, _Draws(0.0, 0.0))
+    assert engine.accepted_volume_moves == 2
+    assert np.allclose(engine.arr.boundaries, boundaries)
+    assert np.allclose(engine.arr.all_centers, centers)
+    assert engine.arr.legal_configuration()
+
+
+def test_equation_of_state_matches_the_chains():
+    np.random.seed(0)
+    random.seed(0)
+    # rhoH=0.5 is close to the density of betaP=2, a shorter equilibration than a compression, see run_npt
+    results = run_functions.run_npt(run_functions.square_initial_arr(1.0, 100, 0.5), 100, 1.0, 'npt', [2.0],
+                                    sweeps=500, equilibration_sweeps=300, backend='numba', write=False)
+    result, = results
+    assert 0.1 < result['acceptance'] < 0.7
+    assert result['rho_H_err'] < 0.01 and result['betaP_xy_err'] < 0.1
+    assert abs(result['betaP_xy'] - 2.0) < 3 * result['betaP_xy_err']
+    assert abs(result['rho_H'] - 0.5) < 0.05
@@ -0,0 +1,94 @@
+import itertools
+
+import numpy as np
+import pytest
+
+from EventChainActions import ArrayEvent2DCells, Event2DCells
+from Structure import Metric, Sphere, epsilon
+
+RAD, BOUNDARIES = 0.5, [8.0, 6.0, 3.0]
+
+
+def _brute_force_distances(centers):
+    """Distances of all the pairs i<j through the cyclic boundaries, with the baseline Metric.cyclic_dist"""
+    spheres = [Sphere(tuple(c), RAD) for c in centers]
+    return {(i, j): Metric.cyclic_dist(BOUNDARIES, spheres[i], spheres[j]) for i, j in
+            itertools.combinations(range(len(spheres)), 2)}
+
+
+def _random_centers(rng, n):
+    centers = rng.random((n, 3)) * BOUNDARIES
+    centers[:, 2] = RAD + centers[:, 2] * (BOUNDARIES[2] - 2 * RAD) / BOUNDARIES[2]
+    # pairs overlapping only through the boundaries in x, in y, and in both
+    centers[0], centers[1] = [0.1, 2.0, 1.0], [BOUNDARIES[0] - 0.3, 2.1, 1.2]
+    centers[2], centers[3] = [4.0, 0.2, 2.0], [4.2, BOUNDARIES[1] - 0.4, 1.9]
+    centers[4], centers[5] = [0.05, 0.05, 0.6], [BOUNDARIES[0] - 0.2, BOUNDARIES[1] - 0.3, 0.9]
+    return centers
+
+
+def _legal_centers(rng, n):
+    """Random sequential addition of n spheres, legal with the boundaries"""
+    centers = []
+    while len(centers) < n:
+        c = rng.random(3) * BOUNDARIES
+        c[2] = RAD + c[2] * (BOUNDARIES[2] - 2 * RAD) / BOUNDARIES[2]
+        if all(Metric.cyclic_dist(BOUNDARIES, Sphere(tuple(c), RAD), Sphere(tuple(o), RAD)) > 2 * RAD + 1e-6 for o in
+               centers):
+            centers.append(c)
+    return np.array(centers)
+
+
+@pytest.mark.parametrize('seed', range(5))
+def test_overlaps_match_all_pairs(seed):
+    centers = _random_centers(np.random.default_rng(seed), 60)
+    distances = _brute_force_distances(centers)
+    pairs, gap = Metric.overlaps(centers, RAD, BOUNDARIES)
+    expected = {pair for pair, d in distances.items() if d - 2 * RAD < -1e3 * epsilon}
+    assert {(0, 1), (2, 3), (4, 5)} <= expected
+    assert set(map(tuple, pairs)) == expected
+    assert gap == pytest.approx(min(distances.values()) - 2 * RAD)
+
+
+@pytest.mark.parametrize('seed', range(5))
+def test_sampled_overlaps_match_the_pairs_of_the_sample(seed):
+    centers = _random_centers(np.random.default_rng(seed), 60)
+    distances = _brute_force_distances(centers)
+    pairs, gap = Metric.overlaps(centers, RAD, BOUNDARIES, sample=20, rng=np.random.default_rng(seed))
+    ids = np.random.default_rng(seed).choice(60, size=20, replace=False)
+    expected = {(i, j) for i in ids for j in range(60) if
+                j != i and distances[min(i, j), max(i, j)] - 2 * RAD < -1e3 * epsilon}
+    assert set(map(tuple, pairs)) == expected
+    assert gap == pytest.approx(min(d for pair, d in distances.items() if set(pair) & set(ids)) - 2 * RAD)
+
+
+def _arr(backend, centers):
+    edge, edge_y = BOUNDARIES[0] / 4, BOUNDARIES[1] / 3
+    if backend == 'python':
+        arr = Event2DCells(edge=edge, n_rows=3, n_columns=4, l_z=BOUNDARIES[2], edge_y=edge_y)
+        arr.append_sphere([Sphere(tuple(c), RAD) for c in centers])
+        return arr
+    arr = ArrayEvent2DCells(edge=edge, n_rows=3, n_columns=4, l_z=BOUNDARIES[2], rad=RAD, edge_y=edge_y)
+    arr.append_sphere(centers)
+    return arr
+
+
+@pytest.mark.parametrize('backend', ['python', 'array'])
+@pytest.mark.parametrize('seed', range(3))
+def test_legal_configuration_matches_all_pairs(backend, seed):
+    rng = np.random.default_rng(seed)
+    centers = _legal_centers(rng, 25)
+    assert _arr(backend, centers).legal_configuration()
+    assert _arr(backend, centers).legal_configuration(sample=5)
+    # translate the legal configuration in xy so sphere 0 is next to the lower faces of the box
+    centers[:, :2] = (centers[:, :2] - centers[0, :2] + 0.1) % BOUNDARIES[:2]
+    assert _arr(backend, centers).legal_configuration()
+    for shift in [[-0.3, 0, 0], [0, -0.3, 0], [-0.2, -0.2, 0.1]]:
+        # sphere 1 moved onto sphere 0 from across the boundaries
+        illegal = centers.copy()
+        illegal[1] = centers[0] + shift
+        illegal[1, :2] %= BOUNDARIES[:2]
+        assert min(_brute_force_distances(illegal).values()) < 2 * RAD
+        assert not _arr(backend, illegal).legal_configuration()
+    illegal = centers.copy()
+    illegal[0, 2] = RAD / 2  # into the bottom wall
+    assert not _arr(backend, illegal).legal_configuration()
@@ -0,0 +1,80 @@
+import os
+
+import numpy as np
+import pytest
+
+import EventChainKernel
+from EventChainActions import ArrayEvent2DCells, ECMCEngine
+from ParallelECMC import ParallelECMC
+from SnapShot import WriteOrLoad
+from run_functions import square_initial_arr, run_sim
+
+pytestmark = pytest.mark.skipif(not EventChainKernel.jit_available, reason="ParallelECMC requires numba")
+
+
+def _arr(seed):
+    np.random.seed(seed)
+    arr = ArrayEvent2DCells.from_cells(square_initial_arr(1.0, 100, 0.7))
+    while arr.cell_spheres.shape[1] <= 2 * arr.cell_count.max():
+        arr._grow()
+    return arr
+
+
+def _chain(arr, owned, sphere, dim, sgn, total_step):
+    return EventChainKernel.chain(arr.centers, arr.cell_spheres, arr.cell_count, arr.sphere_cell, arr.sphere_slot,
+                                  tuple(arr.stencils), tuple(arr.stencil_wraps), owned, sphere, dim, sgn, total_step,
+                                  float(arr.l_x), float(arr.l_y), float(arr.l_z), float(arr.edge), float(arr.edge_y),
+                                  arr.n_columns, float(arr.rad), np.zeros(5, dtype=np.int64))
+
+
+@pytest.mark.parametrize('frozen', [False, True])
+def test_reversed_chain_undoes_the_chain(frozen):
+    arr = _arr(3)
+    owned = np.ones(len(arr.cell_count), dtype=np.bool_)
+    if frozen:  # every third row is frozen, as the halo lines of ParallelECMC
+        owned[(np.arange(len(owned)) // arr.n_columns) % 3 == 2] = False
+    owned_spheres = np.nonzero(owned[arr.sphere_cell])[0]
+    rng = np.random.default_rng(3)
+    for _ in range(200):
+        dim, sgn = int(rng.integers(0, 3)), int(rng.choice([-1, 1]))
+        total_step = 5.0 if dim < 2 else 1.0
+        start = arr.centers.copy()
+        sphere, end_sgn, left, _, _, full = _chain(arr, owned, int(rng.choice(owned_spheres)), dim, sgn, total_step)
+        assert left == 0 and not full
+        _chain(arr, owned, sphere, dim, -end_sgn, total_step)
+        assert np.allclose(arr.centers, start, rtol=0, atol=1e-9)
+    assert arr.legal_configuration()
+
+
+def _sweeps(seed):
+    arr = _arr(5)
+    with ParallelECMC(arr, 2, *ECMCEngine.default_total_steps(100, 1.0, 0.7), seed=seed) as parallel:
+        for _ in range(5):
+            parallel.sweep(200)
+        return arr, parallel.events
+
+
+def test_parallel_sweeps_are_legal_and_reproducible():
+    arr, events = _sweeps(11)
+    assert events > 1000
+    assert arr.legal_configuration()
+    assert np.array_equal(arr.sphere_cell, arr.cells_ind(arr.centers))
+    same_arr, same_events = _sweeps(11)
+    assert events == same_events and np.array_equal(arr.centers, same_arr.centers)
+
+
+def _parallel_sim(name, iterations):
+    np.random.seed(0)
+    with pytest.raises(SystemExit):
+        run_sim(square_initial_arr(1.0, 100, 0.7), 100, 1.0, 0.7, name, iterations=iterations, backend='numba',
+                seed=7, workers=2, sweep_chains=100)
+
+
+def test_continued_parallel_run_goes_on_with_the_generator(results_dir):
+    _parallel_sim('straight', 1000)
+    _parallel_sim('continued', 600)
+    _parallel_sim('continued', 1000)
+    straight, straight_ind = WriteOrLoad(os.path.join(str(results_dir), 'straight')).last_spheres()
+    continued, continued_ind = WriteOrLoad(os.path.join(str(results_dir), 'continued')).last_spheres()
+    assert straight_ind == continued_ind
+    assert np.array_equal(straight, continued)
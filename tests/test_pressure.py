@@ -0,0 +1,69 @@
+import random
+
+import numpy as np
+import pytest
+
+import run_functions
+from EventChainActions import ArrayEvent2DCells, ECMCEngine
+from PressureEstimator import PressureEstimator
+
+
+def _dilute_pressure(rho_H, blocks=10, block_chains=2000):
+    np.random.seed(0)
+    arr = ArrayEvent2DCells.from_cells(run_functions.square_initial_arr(1.0, 100, rho_H))
+    arr.jit = True
+    pressure = PressureEstimator(None, 100, block_chains)
+    engine = ECMCEngine(arr, *ECMCEngine.default_total_steps(100, 1.0, rho_H), pressure=pressure)
+    engine.run(block_chains, random.Random(0))  # away from the lattice
+    pressure.reset()
+    for block in range(blocks):
+        engine.run(block_chains, random.Random(block + 1))
+        pressure.flush(arr)
+    return PressureEstimator.summary(pressure.blocks), arr.l_z
+
+
+def test_dilute_gas_is_ideal():
+    (low, l_z), (high, _) = _dilute_pressure(0.02), _dilute_pressure(0.05)
+    # the spheres reach heights in l_z-sig only, so the ideal gas presses the walls with rhoH*l_z/(l_z-sig)
+    zz = l_z / (l_z - 2.0)
+    for name, ideal in [('betaP_xy', 1.0), ('betaP_zz', zz)]:
+        ratios = np.array([low[name] / 0.02, high[name] / 0.05]) / ideal
+        assert np.all(ratios > 1) and ratios[1] > ratios[0]  # repulsion raises the pressure, more at higher density
+        # the first virial correction is linear in rho_H, so it extrapolates to the ideal gas at rho_H=0
+        intercept = ratios[0] - 0.02 * (ratios[1] - ratios[0]) / 0.03
+        assert intercept == pytest.approx(1.0, abs=0.05 if name == 'betaP_zz' else 0.01)
+        assert low[name] == pytest.approx(0.02 * ideal, rel=0.1)
+
+
+def test_summary_and_load_of_known_blocks(tmp_path):
+    arr = ArrayEvent2DCells(edge=4.0, n_rows=2, n_columns=2, l_z=4.0, rad=1.0)  # rhoH=16*8/(8*8*4)=0.5 for N=16
+    pressure = PressureEstimator(str(tmp_path), 16, 10)
+    counters = [(10.0, 5.0, 12.0, 3), (10.0, 10.0, 12.0, 6), (10.0, 2.0, 0.0, 0)]
+    for iteration, (xy_displacement, xy_lift, z_displacement, wall_events) in enumerate(counters):
+        pressure.chains = 10
+        pressure.xy_displacement, pressure.xy_lift = xy_displacement, xy_lift
+        pressure.z_displacement, pressure.wall_events = z_displacement, wall_events
+        assert pressure.block_done()
+        pressure.flush(arr, iteration=100 * iteration)
+        assert pressure.chains == 0 and pressure.xy_lift == 0.0
+    pressure.flush(arr)  # not written without an iteration
+    betaP_xy = [0.5 * 1.5, 0.5 * 2, 0.5 * 1.2]
+    betaP_zz = [16 / 64 * 8 * 3 / 12, 16 / 64 * 8 * 6 / 12]  # no z chains in the third block
+    blocks = PressureEstimator.load(str(tmp_path))
+    assert len(blocks) == 3 and len(pressure.blocks) == 4
+    for block, expected in zip(blocks, pressure.blocks):
+        assert block['iteration'] == expected['iteration']
+        assert block['rho_H'] == pytest.approx(0.5)
+        assert np.allclose([block['betaP_xy'], block['betaP_zz']], [expected['betaP_xy'], expected['betaP_zz']],
+                           equal_nan=True)
+    assert [b['betaP_xy'] for b in blocks] == pytest.approx(betaP_xy)
+    summary = PressureEstimator.summary(blocks)
+    assert summary['blocks'] == 3
+    assert summary['betaP_xy'] == pytest.approx(np.mean(betaP_xy))
+    assert summary['betaP_xy_err'] == pytest.approx(np.std(betaP_xy, ddof=1) / np.sqrt(3))
+    assert summary['betaP_zz'] == pytest.approx(np.mean(betaP_zz))
+    assert summary['betaP_zz_err'] == pytest.approx(np.std(betaP_zz, ddof=1) / np.sqrt(2))
+    single = PressureEstimator.summary(blocks[2:])
+    assert single['betaP_xy'] == pytest.approx(betaP_xy[2])
+    assert np.isnan(single['betaP_xy_err']) and np.isnan(single['betaP_zz']) and np.isnan(single['betaP_zz_err'])
+    assert PressureEstimator.load(str(tmp_path / 'missing')) == []
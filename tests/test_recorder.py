@@ -0,0 +1,32 @@
+import os
+
+import numpy as np
+import pytest
+
+import run_functions
+from SnapShot import WriteOrLoad
+
+
+def _sim(name, iterations, **kwargs):
+    np.random.seed(0)
+    with pytest.raises(SystemExit):
+        run_functions.run_sim(run_functions.square_initial_arr(1.0, 100, 0.7), 100, 1.0, 0.7, name,
+                              iterations=iterations, backend='numba', **kwargs)
+
+
+def test_frames_are_named_by_the_chain_count(results_dir):
+    _sim('recorded', 2000, record_sweeps=5, record_keep_every=2, record_ring=3)
+    files_interface = WriteOrLoad(os.path.join(str(results_dir), 'recorded'))
+    # the final frame is the one the recorder kept at 2000, not a copy of it
+    assert files_interface.trajectory_index()[:, 0].tolist() == [1000, 2000]
+    assert sorted(files_interface.ring_index()[:, 0].tolist()) == [1000, 1500, 2000]
+    assert files_interface.realizations() == [2000, 1500, 1000]
+    assert files_interface.checkpoint_iteration() == 2000
+
+
+def test_final_frame_is_named_by_the_chain_count(results_dir):
+    _sim('unrecorded', 300)
+    _sim('unrecorded', 500)
+    files_interface = WriteOrLoad(os.path.join(str(results_dir), 'unrecorded'))
+    assert files_interface.trajectory_index()[:, 0].tolist() == [300, 500]
+    assert files_interface.realizations() == [500, 300]
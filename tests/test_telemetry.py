@@ -0,0 +1,66 @@
+import io
+import os
+import random
+
+import numpy as np
+import pytest
+
+import run_functions
+from EventChainActions import ArrayEvent2DCells, ECMCEngine, EventType
+from Telemetry import Telemetry
+
+
+def _engine(backend, telemetry):
+    np.random.seed(0)
+    arr = run_functions.square_initial_arr(1.0, 100, 0.7)
+    if backend != 'python':
+        arr = ArrayEvent2DCells.from_cells(arr)
+        arr.jit = backend == 'numba'
+    return ECMCEngine(arr, *ECMCEngine.default_total_steps(100, 1.0, 0.7), telemetry=telemetry)
+
+
+@pytest.mark.parametrize('backend', ['python', 'array', 'numba'])
+def test_counters_add_up(backend):
+    telemetry = Telemetry(N=100, backend=backend)
+    engine = _engine(backend, telemetry)
+    engine.run(200, random.Random(1))
+    summary = telemetry.summary(engine.arr)
+    assert summary['chains'] == engine.chains == 200
+    assert summary['events'] == sum(summary['event_counts'].values()) == engine.events
+    assert summary['events_per_chain'] == pytest.approx(engine.events / 200)
+    assert summary['event_counts'][EventType.FREE.name] == 200  # every chain ends with a free step
+    assert sum(summary['chain_length_hist_log2']) == 200
+    occupancy = summary['occupancy_hist']
+    assert sum(occupancy) == engine.arr.n_rows * engine.arr.n_columns
+    assert np.dot(occupancy, np.arange(len(occupancy))) == 100
+    if backend != 'numba':  # the kernel has no per event candidates
+        assert sum(summary['candidates_hist']) == summary['events']
+
+
+def test_flush_reads_back_through_parse(tmp_path):
+    telemetry = Telemetry(N=100, h=1.0, phase='test')
+    engine = _engine('python', telemetry)
+    log_path = str(tmp_path / 'batch')
+    flushed = []
+    with open(log_path, 'w') as log:
+        for iteration in [100, 200]:
+            print("not a telemetry line", file=log)
+            engine.run(100, random.Random(iteration))
+            flushed.append(telemetry.flush(engine.arr, file=log, iteration=iteration))
+            assert telemetry.chains == 0 and not np.any(telemetry.event_counts)
+    assert Telemetry.parse(log_path) == flushed
+    assert [s['iteration'] for s in flushed] == [100, 200]
+    assert flushed[0]['phase'] == 'test' and flushed[0]['chains'] == 100
+    empty = Telemetry().flush(file=io.StringIO())
+    assert empty['events_per_chain'] is None and 'candidates_hist' not in empty
+
+
+def test_run_sim_telemetry_is_in_the_batch_log(results_dir):
+    np.random.seed(0)
+    random.seed(0)
+    with pytest.raises(SystemExit):
+        run_functions.run_sim(run_functions.square_initial_arr(1.0, 100, 0.7), 100, 1.0, 0.7, 'telemetry',
+                              iterations=300, backend='numba', telemetry_chains=100)
+    summaries = Telemetry.parse(os.path.join(str(results_dir), 'telemetry', 'batch'))
+    assert [s['iteration'] for s in summaries] == [100, 200, 300]
+    assert all(s['chains'] == 100 and s['backend'] == 'numba' and s['phase'] == 'run_sim' for s in summaries)
@@ -0,0 +1,56 @@
+import os
+
+import numpy as np
+
+from SnapShot import WriteOrLoad
+
+
+def _frame(realization, n_spheres=100):
+    return np.random.default_rng(realization).random((n_spheres, 3))
+
+
+def test_torn_frame_is_ignored_and_overwritten(tmp_path):
+    files_interface = WriteOrLoad(str(tmp_path), [1.0, 1.0, 1.0])
+    for realization in [100, 200]:
+        files_interface.append_frame(_frame(realization), realization)
+    # a job killed while appending 300: part of its centers, and half of its index entry
+    with open(files_interface.trajectory_path, 'ab') as f:
+        f.write(_frame(300)[:10].tobytes())
+    with open(files_interface.trajectory_index_path, 'ab') as f:
+        f.write(np.array([300], dtype=np.int64).tobytes())
+    assert files_interface.trajectory_index()[:, 0].tolist() == [100, 200]
+    assert files_interface.realizations() == [200, 100]
+    assert np.array_equal(files_interface.load_spheres(200), _frame(200))
+    files_interface.append_frame(_frame(300), 300)
+    assert files_interface.trajectory_index().tolist() == [[100, 100], [200, 100], [300, 100]]
+    assert os.path.getsize(files_interface.trajectory_path) == 3 * 100 * 3 * 8
+    assert np.array_equal(files_interface.trajectory()[2], _frame(300))
+    assert np.array_equal(files_interface.load_spheres(100), _frame(100))
+
+
+def test_slot_torn_in_the_ring_is_ignored(tmp_path):
+    files_interface = WriteOrLoad(str(tmp_path), [1.0, 1.0, 1.0])
+    for slot, realization in enumerate([100, 200, 300]):
+        files_interface.write_ring_frame(_frame(realization), realization, slot, 3)
+    # a job killed while overwriting slot 0 with 400, the slot is marked empty until its frame is written
+    with open(files_interface.ring_index_path, 'r+b') as f:
+        f.write(np.array([-1, 100], dtype=np.int64).tobytes())
+    with open(files_interface.ring_path, 'r+b') as f:
+        f.write(_frame(400)[:10].tobytes())
+    assert files_interface.realizations() == [300, 200]
+    assert np.array_equal(files_interface.load_spheres(200), _frame(200))
+    files_interface.write_ring_frame(_frame(400), 400, 0, 3)
+    assert files_interface.realizations() == [400, 300, 200]
+    assert np.array_equal(files_interface.load_spheres(400), _frame(400))
+
+
+def test_realizations_from_last_to_first(tmp_path):
+    files_interface = WriteOrLoad(str(tmp_path), [1.0, 1.0, 1.0])
+    np.savetxt(os.path.join(str(tmp_path), '50'), _frame(50))  # a text realization of an older run
+    for realization in [100, 300]:
+        files_interface.append_frame(_frame(realization), realization)
+    for slot, realization in enumerate([200, 300, 400]):
+        files_interface.write_ring_frame(_frame(realization), realization, slot, 3)
+    assert files_interface.realizations() == [400, 300, 200, 100, 50]
+    assert files_interface.last_spheres()[1] == 400
+    assert np.allclose(files_interface.load_spheres(50), _frame(50))
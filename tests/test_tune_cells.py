@@ -0,0 +1,51 @@
+import random
+
+import numpy as np
+import pytest
+
+import run_functions
+from EventChainActions import ArrayEvent2DCells, ECMCEngine
+
+
+@pytest.mark.parametrize('backend', ['python', 'numba'])
+@pytest.mark.parametrize('rho_H', [0.5, 0.85])
+def test_tuned_cells_stay_wider_than_a_sphere(backend, rho_H):
+    np.random.seed(0)
+    random.seed(0)
+    arr = run_functions.square_initial_arr(1.0, 100, rho_H)
+    if backend != 'python':
+        arr = ArrayEvent2DCells.from_cells(arr)
+        arr.jit = True
+    total_steps = ECMCEngine.default_total_steps(100, 1.0, rho_H)
+    n_rows, n_columns, results = run_functions.tune_cell_edges(arr, 50, *total_steps)
+    sig = 2.0
+    assert (arr.n_rows, arr.n_columns) == (n_rows, n_columns)
+    assert arr.edge == pytest.approx(arr.l_x / n_columns) and arr.edge_y == pytest.approx(arr.l_y / n_rows)
+    assert all(edge > sig and edge_y > sig for _, _, edge, edge_y, _, _, _ in results)
+    assert any(edge != edge_y for _, _, edge, edge_y, _, _, _ in results)  # rectangular cells are candidates
+    assert min(arr.edge, arr.edge_y) > sig
+    assert arr.legal_configuration()
+    engine = ECMCEngine(arr, *total_steps)
+    engine.run(200, random.Random(1))
+    assert arr.legal_configuration()
+
+
+def test_backends_agree_on_rectangular_cells():
+    np.random.seed(0)
+    arr = run_functions.square_initial_arr(1.0, 100, 0.7)
+    regridded = ArrayEvent2DCells.from_cells(arr)
+    arr.regrid(6, 4)
+    regridded.regrid(6, 4)
+    assert arr.edge_y != arr.edge
+    # the python regrid renumbers all_spheres cell by cell, the array one keeps the ids, the cells are the same
+    for k, cell in enumerate(arr.flat_cells):
+        ids = regridded.cell_spheres[k, :regridded.cell_count[k]]
+        assert sorted(map(tuple, regridded.centers[ids])) == sorted(tuple(s.center) for s in cell.spheres)
+    arrs = [arr]
+    for backend in ['array', 'numba']:
+        arrs.append(ArrayEvent2DCells.from_cells(arr))
+        arrs[-1].jit = backend == 'numba'
+    for a in arrs:
+        ECMCEngine(a, *ECMCEngine.default_total_steps(100, 1.0, 0.7)).run(200, random.Random(2))
+    for a in arrs[1:]:
+        assert np.array_equal(arrs[0].all_centers, a.all_centers)